@@ -2,6 +2,9 @@ class QubesDB:
     def read(self, key):
         return b'testvm'
 
+    def multiread(self, prefix):
+        return {}
+
     def rm(self, key):
         pass
 
@@ -7,7 +7,8 @@ import os
 import re
 import string
 import subprocess
-from typing import Optional, List
+import time
+from typing import Dict, Optional, List, Set, Tuple
 
 import qubes.device_protocol
 import qubes.ext
@@ -20,6 +21,59 @@ name_re = re.compile(r"\A[a-z0-9-]{1,12}\Z")
 device_re = re.compile(r"\A[a-z0-9/-]{1,64}\Z")
 connected_to_re = re.compile(rb"^[a-zA-Z][a-zA-Z0-9_.-]*$")
 format_re = re.compile(r"\A^[1-9][0-9]{0,3}x[1-9][0-9]{0,3}x[1-9][0-9]{0,2}\Z")
+#: Printed by qvc.WebcamAttach: the duration of the attach phases in the qube
+attach_phases_re = re.compile(
+    rb"\Aattach: device ([0-9]{1,7}) ms, header ([0-9]{1,7}) ms, "
+    rb"ready ([0-9]{1,7}) ms\n?\Z"
+)
+
+#: Attributes of the devices of every backend qube, read from QubesDB on
+#: first use and dropped only when the /webcam-devices entries of their port
+#: change, so that repeated listings don't reach QubesDB
+attribute_cache = {}  # type: Dict[str, Dict[str, dict]]
+
+
+def invalidate_attributes(backend_name: str,
+                          port_ids: Optional[Set[str]] = None) -> None:
+    """Drop the cached attributes of some or all ports of a qube"""
+    if port_ids is None:
+        attribute_cache.pop(backend_name, None)
+        return
+    ports = attribute_cache.get(backend_name, {})
+    for port_id in port_ids:
+        ports.pop(port_id, None)
+
+
+def parse_connected_to(backend_domain, port_id: str,
+                       untrusted_connected_to: Optional[bytes]) -> list:
+    """Return the qubes listed in the connected-to entry of a device"""
+    if not untrusted_connected_to:
+        return []
+    attachments = []
+    for untrusted_name in untrusted_connected_to.split(b" "):
+        if not connected_to_re.match(untrusted_name):
+            backend_domain.log.warning(
+                f"Device {port_id} has invalid chars in connected-to "
+                "property"
+            )
+            continue
+        untrusted_name = untrusted_name.decode("ascii", errors="strict")
+        try:
+            attachments.append(backend_domain.app.domains[untrusted_name])
+        except KeyError:
+            backend_domain.log.warning(
+                f"Device {port_id} has invalid VM name in "
+                f"connected-to property: {untrusted_name}"
+            )
+    return attachments
+
+
+def shares_capture(backend_domain) -> bool:
+    """Whether a qube streams one capture to several qubes (qvc-fanout)"""
+    return backend_domain.features.check_with_template(
+        "service.qvc-fanout", False
+    )
+
 
 class WebcamDevice(qubes.device_protocol.DeviceInfo):
     def __init__(self, port: qubes.device_protocol.Port):
@@ -35,6 +89,15 @@ class WebcamDevice(qubes.device_protocol.DeviceInfo):
 
         self._formats = None
 
+    def _cached(self, name: str, compute):
+        """Return an attribute from attribute_cache, computing it if needed"""
+        port_cache = attribute_cache.setdefault(
+            self.backend_domain.name, {}
+        ).setdefault(self.port_id, {})
+        if name not in port_cache:
+            port_cache[name] = compute()
+        return port_cache[name]
+
     @property
     def interfaces(self) -> List[DeviceInterface]:
         return [DeviceInterface("u0e0200")]
@@ -125,55 +188,52 @@ class WebcamDevice(qubes.device_protocol.DeviceInfo):
         The parent device, if any.
         """
         if self._parent is None:
-            self._parent = self._get_parent_device(self.port)
+            self._parent = self._cached(
+                "parent", lambda: self._get_parent_device(self.port)
+            )
         return self._parent
 
     @property
     def attachment(self):
+        """The first qube the device is streamed to"""
+        attachments = self.attachments
+        return attachments[0] if attachments else None
+
+    @property
+    def attachments(self) -> list:
+        """
+        All qubes the device is streamed to; with the qvc-fanout service
+        enabled in the backend, one capture is shared by several qubes
+        """
         if not self.backend_domain.is_running():
-            return None
-        untrusted_connected_to = self.backend_domain.untrusted_qdb.read(
-            self._qdb_path + "/connected-to"
-        )
-        if not untrusted_connected_to:
-            return None
-        if not connected_to_re.match(untrusted_connected_to):
-            self.backend_domain.log.warning(
-                f"Device {self.port_id} has invalid chars in connected-to "
-                "property"
-            )
-            return None
-        untrusted_connected_to = untrusted_connected_to.decode(
-            "ascii", errors="strict"
-        )
-        try:
-            connected_to = self.backend_domain.app.domains[
-                untrusted_connected_to
-            ]
-        except KeyError:
-            self.backend_domain.log.warning(
-                f"Device {self.port_id} has invalid VM name in connected-to "
-                f"property: {untrusted_connected_to}"
-            )
-            return None
-        return connected_to
+            return []
+        return list(self._cached("attachments", lambda: parse_connected_to(
+            self.backend_domain,
+            self.port_id,
+            self.backend_domain.untrusted_qdb.read(
+                self._qdb_path + "/connected-to"
+            ),
+        )))
 
     @property
     def formats(self):
         if self._formats is None:
-            untrusted_formats = self.backend_domain.untrusted_qdb.multiread(
-                self._qdb_path + "/formats/"
-            )
-            formats = []
-            for _, untrusted_format in untrusted_formats.items():
-                untrusted_format = untrusted_format.decode("ascii", errors="strict")
-                if not format_re.match(untrusted_format):
-                    self.backend_domain.log.warning("Invalid format")
-                    continue
-                formats.append(untrusted_format)
-            self._formats = " ".join(formats)
+            self._formats = self._cached("formats", self._read_formats)
         return self._formats
 
+    def _read_formats(self) -> str:
+        untrusted_formats = self.backend_domain.untrusted_qdb.multiread(
+            self._qdb_path + "/formats/"
+        )
+        formats = []
+        for _, untrusted_format in untrusted_formats.items():
+            untrusted_format = untrusted_format.decode("ascii", errors="strict")
+            if not format_re.match(untrusted_format):
+                self.backend_domain.log.warning("Invalid format")
+                continue
+            formats.append(untrusted_format)
+        return " ".join(formats)
+
     @property
     def data(self):
         """Return extra attributes for serialization"""
@@ -207,6 +267,17 @@ def allow_qrexec_call(service, arg, source, dest):
 
 
 class WebcamDeviceExtension(qubes.ext.Extension):
+    def __init__(self):
+        super().__init__()
+        #: the /webcam-devices/ entries of every qube, grouped by port, as
+        #: they were when devices_cache was last updated
+        self.qdb_entries_cache = {}
+        #: the qubes every port of every qube is streamed to
+        self.attachments_cache = {}  # type: Dict[str, Dict[str, List[str]]]
+        #: the reverse of attachments_cache: the (backend qube, port_id) of
+        #: every device streamed to a qube
+        self.attached_index = {}  # type: Dict[str, Set[Tuple[str, str]]]
+
     @qubes.ext.handler("domain-init", "domain-load")
     def on_domain_init_load(self, vm, event):
         """Initialize watching for changes"""
@@ -218,13 +289,12 @@ class WebcamDeviceExtension(qubes.ext.Extension):
         if event == "domain-load":
             # avoid building a cache on domain-init, as it isn't fully set yet,
             # and definitely isn't running yet
-            current_devices = {
-                dev.port_id: dev.attachment
-                for dev in self.on_device_list_webcam(vm, None)
-            }
-            self.devices_cache[vm.name] = current_devices
+            self.devices_cache[vm.name] = self.current_devices(vm)
         else:
             self.devices_cache[vm.name] = {}
+            self.qdb_entries_cache.pop(vm.name, None)
+            self.update_attachments(vm.name, {})
+            invalidate_attributes(vm.name)
 
     async def attach_and_notify(self, vm, assignment):
         # bypass DeviceCollection logic preventing double attach
@@ -255,11 +325,147 @@ class WebcamDeviceExtension(qubes.ext.Extension):
     def on_qdb_change(self, vm, event, path):
         """A change in QubesDB means a change in a device list."""
         # pylint: disable=unused-argument
-        current_devices = dict(
-            (dev.port_id, dev.attachment)
-            for dev in self.on_device_list_webcam(vm, None)
-        )
+        previous = self.attachments_snapshot(vm.name)
+        current_devices = self.current_devices(vm)
+        self.fire_attachment_changes(vm, previous, False)
         utils.device_list_change(self, current_devices, vm, path, WebcamDevice)
+        self.fire_attachment_changes(vm, previous, True)
+
+    @staticmethod
+    def read_device_entries(vm) -> Dict[str, Dict[str, bytes]]:
+        """
+        Read all of /webcam-devices/ of a qube at once, and return its
+        entries grouped by port
+        """
+        if not vm.is_running() or not hasattr(vm, "untrusted_qdb"):
+            return {}
+        untrusted_entries = vm.untrusted_qdb.multiread("/webcam-devices/")
+        devices = {}
+        unsafe = False
+        for untrusted_path, untrusted_value in untrusted_entries.items():
+            untrusted_ident, _, untrusted_key = untrusted_path[
+                len("/webcam-devices/"):
+            ].partition("/")
+            if not name_re.match(untrusted_ident):
+                unsafe = True
+                continue
+            devices.setdefault(untrusted_ident, {})[untrusted_key] = \
+                untrusted_value
+        if unsafe:
+            vm.log.warning(
+                "%s vm's device path name contains unsafe characters. "
+                "Skipping it.", vm.name
+            )
+        return devices
+
+    def current_devices(self, vm) -> dict:
+        """
+        Return the ports of a qube, for devices_cache
+
+        A port may be streamed to several qubes, which devices_cache cannot
+        express: it maps every port to None, and the qubes are kept in
+        attachments_cache instead.  Only the ports whose entries changed since
+        the last call are parsed again, the others keep their cached
+        attachments.
+        """
+        entries = self.read_device_entries(vm)
+        previous_entries = self.qdb_entries_cache.get(vm.name, {})
+        cached_attachments = self.attachments_cache.get(vm.name, {})
+        current_devices = {}
+        attachments = {}
+        invalidate_attributes(vm.name, {
+            port_id for port_id in set(entries) | set(previous_entries)
+            if entries.get(port_id) != previous_entries.get(port_id)
+        })
+        for port_id, port_entries in entries.items():
+            current_devices[port_id] = None
+            if previous_entries.get(port_id) == port_entries:
+                attachments[port_id] = cached_attachments.get(port_id, [])
+                continue
+            frontends = parse_connected_to(
+                vm, port_id, port_entries.get("connected-to")
+            )
+            attachments[port_id] = [frontend.name for frontend in frontends]
+        self.qdb_entries_cache[vm.name] = entries
+        self.update_attachments(vm.name, attachments)
+        return current_devices
+
+    def attachments_snapshot(self, backend_name: str) -> Dict[str, List[str]]:
+        """Return a copy of the attachments of a backend qube"""
+        return {
+            port_id: list(frontend_names) for port_id, frontend_names
+            in self.attachments_cache.get(backend_name, {}).items()
+        }
+
+    def fire_attachment_changes(self, vm, previous: Dict[str, List[str]],
+                                attached: bool) -> None:
+        """
+        Fire device-attach (or device-detach) for every qube a port of a
+        backend qube started (or stopped) streaming to since previous
+        """
+        current = self.attachments_cache.get(vm.name, {})
+        old, new = (previous, current) if attached else (current, previous)
+        for port_id, frontend_names in new.items():
+            port = Port(vm, port_id, "webcam")
+            for frontend_name in frontend_names:
+                if frontend_name in old.get(port_id, []):
+                    continue
+                try:
+                    frontend = vm.app.domains[frontend_name]
+                except KeyError:
+                    continue
+                if attached:
+                    # options are unknown, device already attached
+                    asyncio.ensure_future(frontend.fire_event_async(
+                        "device-attach:webcam", device=WebcamDevice(port),
+                        options={},
+                    ))
+                else:
+                    asyncio.ensure_future(frontend.fire_event_async(
+                        "device-detach:webcam", port=port,
+                    ))
+
+    def update_attachments(self, backend_name: str,
+                           attachments: Dict[str, List[str]]) -> None:
+        """Replace the attachments of a backend qube in both indexes"""
+        old = self.attachments_cache.get(backend_name, {})
+        for port_id, frontend_names in old.items():
+            for frontend_name in frontend_names:
+                self.index_attachment(frontend_name, backend_name, port_id,
+                                      False)
+        for port_id, frontend_names in attachments.items():
+            for frontend_name in frontend_names:
+                self.index_attachment(frontend_name, backend_name, port_id,
+                                      True)
+        if attachments:
+            self.attachments_cache[backend_name] = attachments
+        else:
+            self.attachments_cache.pop(backend_name, None)
+
+    def record_attachment(self, frontend_name: str, backend_name: str,
+                          port_id: str, attached: bool) -> None:
+        """Record a device attached to or detached from a qube"""
+        # read connected-to again until the QubesDB watch fires
+        invalidate_attributes(backend_name, {port_id})
+        frontend_names = self.attachments_cache.setdefault(
+            backend_name, {}
+        ).setdefault(port_id, [])
+        if attached and frontend_name not in frontend_names:
+            frontend_names.append(frontend_name)
+        elif not attached and frontend_name in frontend_names:
+            frontend_names.remove(frontend_name)
+        self.index_attachment(frontend_name, backend_name, port_id, attached)
+
+    def index_attachment(self, frontend_name: str, backend_name: str,
+                         port_id: str, attached: bool) -> None:
+        """Add a device to the index of a qube, or remove it"""
+        devices = self.attached_index.setdefault(frontend_name, set())
+        if attached:
+            devices.add((backend_name, port_id))
+            return
+        devices.discard((backend_name, port_id))
+        if not devices:
+            del self.attached_index[frontend_name]
 
     @staticmethod
     def device_get(vm, port_id):
@@ -276,26 +482,18 @@ class WebcamDeviceExtension(qubes.ext.Extension):
 
     @qubes.ext.handler("device-list:webcam")
     def on_device_list_webcam(self, vm, event):
-        if not vm.is_running() or not hasattr(vm, "untrusted_qdb"):
-            return
-        untrusted_devices = vm.untrusted_qdb.list("/webcam-devices/")
-
-        untrusted_idents = set(untrusted_path.split("/", 3)[2]
-                               for untrusted_path in untrusted_devices)
-        for untrusted_ident in untrusted_idents:
-            if not name_re.match(untrusted_ident):
-                msg = (
-                    "%s vm's device path name contains unsafe characters. "
-                    "Skipping it."
+        # pylint: disable=unused-argument
+        # every port with entries is a device, so one read lists them all;
+        # once the QubesDB watch has seen them, not even that is needed
+        entries = self.qdb_entries_cache.get(vm.name)
+        if entries is None:
+            entries = self.read_device_entries(vm)
+        for port_id in entries:
+            yield WebcamDevice(
+                qubes.device_protocol.Port(
+                    backend_domain=vm, port_id=port_id, devclass="webcam"
                 )
-                vm.log.warning(msg)
-                continue
-
-            port_id = untrusted_ident
-
-            device_info = self.device_get(vm, port_id)
-            if device_info:
-                yield device_info
+            )
 
     @qubes.ext.handler("device-get:webcam")
     def on_device_get_webcam(self, vm, event, port_id):
@@ -322,9 +520,19 @@ class WebcamDeviceExtension(qubes.ext.Extension):
         if not vm.is_running():
             return
 
-        for dev in self.get_all_devices(vm.app):
-            if dev.attachment == vm:
-                yield (dev, {})
+        for backend_name, port_id in sorted(
+            self.attached_index.get(vm.name, ())
+        ):
+            try:
+                backend = vm.app.domains[backend_name]
+            except KeyError:
+                continue
+            if not backend.is_running():
+                continue
+            yield (
+                WebcamDevice(Port(backend, port_id, "webcam")),
+                {},
+            )
 
     @qubes.ext.handler("device-pre-attach:webcam")
     async def on_device_pre_attach_webcam(self, vm, event, device, options):
@@ -348,9 +556,12 @@ class WebcamDeviceExtension(qubes.ext.Extension):
 
         assert isinstance(device, WebcamDevice)
 
-        if device.attachment:
+        attachment = device.attachment
+        if vm in device.attachments or (
+            attachment and not shares_capture(device.backend_domain)
+        ):
             raise qubes.exc.DeviceAlreadyAttached(
-                f"Device {device} already attached to {device.attachment}"
+                f"Device {device} already attached to {attachment}"
             )
 
         if not vm.features.check_with_template("supported-rpc.qvc.WebcamAttach", False):
@@ -358,13 +569,15 @@ class WebcamDeviceExtension(qubes.ext.Extension):
 
         # update the cache before the call, to avoid sending duplicated events
         # (one on qubesdb watch and the other by the caller of this method)
-        self.devices_cache[device.backend_domain.name][device.port_id] = vm
+        self.record_attachment(vm.name, device.backend_domain.name,
+                               device.port_id, True)
 
+        start = time.monotonic()
         # set qrexec policy to allow this device
         with allow_qrexec_call("qvc.Webcam", "+" + arg, f"uuid:{vm.uuid}", f"uuid:{device.backend_domain.uuid}"):
             # and actual attach
             try:
-                await vm.run_service_for_stdio(
+                untrusted_stdout, _ = await vm.run_service_for_stdio(
                     "qvc.WebcamAttach",
                     user="root",
                     input=f"{device.backend_domain.name} "
@@ -372,12 +585,35 @@ class WebcamDeviceExtension(qubes.ext.Extension):
                 )
             except subprocess.CalledProcessError as e:
                 # pylint: disable=raise-missing-from
+                self.record_attachment(vm.name, device.backend_domain.name,
+                                       device.port_id, False)
                 if e.returncode == 127:
                     raise QVCNotInstalled("qubes-video-companion not installed in the VM")
                 raise QubesException(
                     f"Device attach failed: {sanitize_stderr_for_log(e.output)}"
                     f" {sanitize_stderr_for_log(e.stderr)}"
                 )
+        self.log_attach_phases(vm, device, untrusted_stdout,
+                               (time.monotonic() - start) * 1000)
+
+    @staticmethod
+    def log_attach_phases(vm, device, untrusted_stdout: bytes,
+                          total_ms: float) -> None:
+        """Log how long each phase of an attach took"""
+        match = attach_phases_re.match(untrusted_stdout or b"")
+        if not match:
+            # an older version in the qube
+            vm.log.info(f"Attached webcam {device.port_id} from "
+                        f"{device.backend_domain.name} in {total_ms:.0f} ms")
+            return
+        device_ms, header_ms, ready_ms = map(int, match.groups())
+        vm.log.info(
+            f"Attached webcam {device.port_id} from "
+            f"{device.backend_domain.name} in {total_ms:.0f} ms: "
+            f"{max(total_ms - ready_ms, 0):.0f} ms to start the receiver, "
+            f"then {device_ms} ms to set up the loopback device while the "
+            f"sender started and sent its header in {header_ms} ms"
+        )
 
     @qubes.ext.handler("device-pre-detach:webcam")
     async def on_device_detach_webcam(self, vm, event, port):
@@ -396,15 +632,21 @@ class WebcamDeviceExtension(qubes.ext.Extension):
         # update the cache before the call, to avoid sending duplicated events
         # (one on qubesdb watch and the other by the caller of this method)
         backend = attached.backend_domain
-        self.devices_cache[backend.name][attached.port_id] = None
+        arg = attached.port_id
+        if len(attached.attachments) > 1:
+            # stop only the stream to this qube, the capture is shared
+            arg += "+" + vm.name
+        self.record_attachment(vm.name, backend.name, attached.port_id, False)
 
         try:
             await backend.run_service_for_stdio(
-                f"qvc.WebcamDetach+{attached.port_id}",
+                f"qvc.WebcamDetach+{arg}",
                 user="root",
             )
         except subprocess.CalledProcessError as e:
             # pylint: disable=raise-missing-from
+            self.record_attachment(vm.name, backend.name, attached.port_id,
+                                   True)
             raise QubesException(
                 f"Device detach failed: {sanitize_stderr_for_log(e.output)}"
                 f" {sanitize_stderr_for_log(e.stderr)}"
@@ -432,7 +674,8 @@ class WebcamDeviceExtension(qubes.ext.Extension):
             for device in assignment.devices:
                 if isinstance(device, qubes.device_protocol.UnknownDevice):
                     continue
-                if device.attachment:
+                if device.attachment and \
+                        not shares_capture(device.backend_domain):
                     continue
                 if not assignment.matches(device):
                     vm.log.warning(
@@ -456,9 +699,18 @@ class WebcamDeviceExtension(qubes.ext.Extension):
     async def on_domain_shutdown(self, vm, _event, **_kwargs):
         # pylint: disable=unused-argument
         vm.fire_event("device-list-change:webcam")
+        previous = self.attachments_snapshot(vm.name)
+        self.qdb_entries_cache.pop(vm.name, None)
+        self.update_attachments(vm.name, {})
+        self.fire_attachment_changes(vm, previous, False)
         utils.device_list_change(self, {}, vm, None, WebcamDevice)
+        invalidate_attributes(vm.name)
 
     @qubes.ext.handler("qubes-close", system=True)
     def on_qubes_close(self, app, event):
         # pylint: disable=unused-argument
         self.devices_cache.clear()
+        self.qdb_entries_cache.clear()
+        self.attachments_cache.clear()
+        self.attached_index.clear()
+        attribute_cache.clear()
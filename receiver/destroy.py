@@ -4,39 +4,85 @@
 #                            <marmarek@invisiblethingslab.com>
 # Licensed under the MIT License. See LICENSE file for details.
 
+import ctypes
 import errno
+import select
 import sys
 import os
 import fcntl
 import time
 import subprocess
 
+import setup
+
 
 # V4L2LOOPBACK_CTL_REMOVE = 0x40487e02
 # use legacy numbers since the change was recent
 V4L2LOOPBACK_CTL_REMOVE = 0x4C81
 
+# see inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_CLOEXEC = os.O_CLOEXEC
+
+#: Seconds between two notifications asking to close the device
+NOTIFY_INTERVAL_SECONDS = 60
+#: Seconds to wait for a close event before trying again anyway, in case the
+#: device is busy for another reason
+RETRY_SECONDS = 10
+
+
+def watch_closes(path):
+    """
+    Return an inotify file descriptor that becomes readable whenever a file
+    descriptor of path is closed, or None if inotify is not available
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path.encode(),
+                              IN_CLOSE_WRITE | IN_CLOSE_NOWRITE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
 
 def unregister_device(dev_nr):
     ctrl_fd = os.open("/dev/v4l2loopback", os.O_RDWR)
+    # watched before the first try, so that no close is missed
+    watch_fd = watch_closes(f"/dev/video{dev_nr}")
     try:
         message = ("Please close any window that has an open video stream "
             "so kernel modules can be securely unloaded...")
+        last_notification = None
 
         while True:
             try:
                 fcntl.ioctl(ctrl_fd, V4L2LOOPBACK_CTL_REMOVE, dev_nr)
                 break
             except OSError as e:
-                if e.errno == errno.EBUSY:
-                    print(message, file=sys.stderr)
-                    subprocess.call(
-                        ["notify-send", "Qubes Video Companion", message]
-                    )
-                    time.sleep(10)
-                else:
+                if e.errno != errno.EBUSY:
                     raise
+            now = time.monotonic()
+            if last_notification is None or \
+                    now - last_notification >= NOTIFY_INTERVAL_SECONDS:
+                last_notification = now
+                print(message, file=sys.stderr)
+                subprocess.call(
+                    ["notify-send", "Qubes Video Companion", message]
+                )
+            if watch_fd is None:
+                time.sleep(RETRY_SECONDS)
+                continue
+            # try again as soon as any program closes the device
+            readable, _, _ = select.select([watch_fd], [], [],
+                                           RETRY_SECONDS)
+            if readable:
+                os.read(watch_fd, 4096)
     finally:
+        if watch_fd is not None:
+            os.close(watch_fd)
         os.close(ctrl_fd)
 
 
@@ -44,6 +90,12 @@ def main(argv):
     if len(argv) != 2 or not argv[1].startswith("/dev/video"):
         raise RuntimeError("Wrong arguments, expected /dev/video* path")
     dev_nr = int(argv[1][len("/dev/video") :])
+    if setup.pool_enabled():
+        name = setup.device_name(dev_nr)
+        if name is not None and name.startswith("QVC - ") and \
+                len(setup.devices_named(name)) <= setup.POOL_SIZE:
+            # kept for the next stream, which skips registering a device
+            return
     unregister_device(dev_nr)
 
 
@@ -4,11 +4,61 @@
 # Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
 # Licensed under the MIT License. See LICENSE file for details.
 
+import atexit
+import re
 import sys
 import socket
 import struct
 import os
-from typing import NoReturn
+import threading
+import time
+import traceback
+from typing import NoReturn, Tuple
+
+import i420
+import rledec
+import tiledec
+import v4l2out
+
+EXTENDED_HEADER_MAGIC = 0xFFFF
+
+# Version 1 is the legacy header, see sender/service.py
+PROTOCOL_VERSION = 4
+
+TRANSPORT_RAW = 0
+TRANSPORT_TILES = 1
+TRANSPORT_RLE = 2
+
+frame_header = struct.Struct("=IQI")
+format_struct = struct.Struct("=HHH")
+
+#: Set in the payload length of a frame header that announces a new format
+FORMAT_CHANGE = 0x80000000
+
+#: The first request of a version 4 stream: the receiver follows format
+#: changes, or the sender has to keep the format of the header.  The sender
+#: does not change the format before it got one of them.
+FORMATS_FOLLOWED = b"\xff" * format_struct.size
+FORMATS_FIXED = bytes(format_struct.size)
+
+#: Pixel format codes of the version 3 header, with the name of the format
+#: in GStreamer and its V4L2 pixel format.  Only these are ever accepted.
+PIXEL_FORMATS = {
+    0: ("I420", v4l2out.V4L2_PIX_FMT_YUV420),
+    1: ("YUY2", v4l2out.V4L2_PIX_FMT_YUYV),
+    2: ("NV12", v4l2out.V4L2_PIX_FMT_NV12),
+}
+
+STATS_INTERVAL_SECONDS = 10
+
+#: mmap writes frames straight into the buffers of the loopback device, gst
+#: hands them to v4l2sink in a gst-launch-1.0 pipeline
+ENGINES = ("mmap", "gst")
+
+#: Exit code when the sender ends the stream before sending any header, as
+#: senders that predate protocol version 2 do when their argument carries a
+#: version, so that the wrapper can retry with the legacy argument
+NO_HEADER_EXIT_CODE = 3
 
 
 def sdnotify(msg):
@@ -21,23 +71,130 @@ def sdnotify(msg):
     sock.close()
 
 
+class DeviceSetup:
+    """
+    Register the loopback device in a thread, while the sender starts and
+    probes its formats
+    """
+
+    def __init__(self, video_source: str, device_file: str):
+        self.path = None
+        self.seconds = 0.0
+        self._error = None
+        self._device_file = device_file
+        self._thread = threading.Thread(target=self._run,
+                                        args=(video_source,), daemon=True)
+        self._thread.start()
+
+    def _run(self, video_source: str) -> None:
+        import setup  # pylint: disable=import-outside-toplevel
+
+        start = time.monotonic()
+        try:
+            self.path = setup.setup_device(f"QVC - {video_source}")
+            # the wrapper removes the device when the stream ends
+            with open(self._device_file, "w",
+                      encoding="ascii") as device_file:
+                device_file.write(self.path + "\n")
+        except BaseException as e:  # pylint: disable=broad-except
+            self._error = e
+        self.seconds = time.monotonic() - start
+
+    def join(self) -> None:
+        self._thread.join()
+
+    def wait(self) -> str:
+        """Return the path of the device once it is registered"""
+        self.join()
+        if self._error is not None:
+            raise RuntimeError("cannot set up the video device") \
+                from self._error
+        return self.path
+
+
 def main(argv) -> NoReturn:
+    start = time.monotonic()
     dev_path = "/dev/video0"
-    if len(argv) == 2:
+    engine = "mmap"
+    setup_source = device_file = None
+    argv = list(argv)
+    while len(argv) >= 2 and argv[1].startswith("--"):
+        option = argv.pop(1)
+        if option.startswith("--engine="):
+            engine = option[len("--engine="):]
+            if engine not in ENGINES:
+                raise RuntimeError("unknown engine " + engine)
+        elif option.startswith("--setup="):
+            setup_source = option[len("--setup="):]
+        elif option.startswith("--device-file="):
+            device_file = option[len("--device-file="):]
+        else:
+            raise RuntimeError("unknown option " + option)
+    if (setup_source is None) != (device_file is None):
+        raise RuntimeError("--setup and --device-file go together")
+    if len(argv) == 2 and setup_source is None:
         dev_path = argv[1]
     elif len(argv) != 1:
         raise RuntimeError(
-            "wrong arguments - expected only optional device path"
+            "wrong arguments - expected only options and device path"
         )
 
-    width, height, fps = read_video_parameters()
+    # the device is registered while the sender starts, which is most of
+    # the attach time
+    device_setup = None
+    if setup_source is not None:
+        device_setup = DeviceSetup(setup_source, device_file)
+
+    try:
+        width, height, fps, version, transport, pixel_format = \
+            read_video_parameters()
+    finally:
+        if device_setup is not None:
+            # a device registered after exiting would never be removed
+            device_setup.join()
+    header_seconds = time.monotonic() - start
+    if device_setup is not None:
+        dev_path = device_setup.wait()
+    # the device setup and the stream header overlap, ready is when both
+    # are done
+    status = "device {:.0f} ms, header {:.0f} ms, ready {:.0f} ms".format(
+        device_setup.seconds * 1000 if device_setup is not None else 0,
+        header_seconds * 1000,
+        (time.monotonic() - start) * 1000,
+    )
+    print("Attach phases:", status, file=sys.stderr)
 
     if "NOTIFY_SOCKET" in os.environ:
-        sdnotify(b"READY=1")
+        sdnotify(b"READY=1\nSTATUS=attach: " + status.encode("ascii"))
     print(
         "Receiving video stream at {}x{} {} FPS...".format(width, height, fps),
         file=sys.stderr,
     )
+    if engine == "mmap":
+        output = open_loopback(dev_path, width, height, pixel_format)
+        if output is not None:
+            if version >= 4:
+                os.write(1, FORMATS_FOLLOWED)
+                watch_requests(dev_path)
+            try:
+                receive_frames((width, height, fps), version, transport,
+                               pixel_format, output=output)
+            finally:
+                output.close()
+            sys.exit(0)
+    if version >= 4:
+        # the pipeline below cannot follow a format change, so ask the sender
+        # to keep the current one
+        os.write(1, FORMATS_FIXED)
+    if version >= 2:
+        start_relay((width, height, fps), transport, pixel_format)
+    if os.environ.get("QVC_TRACE") == "verbose":
+        # per-element latencies from GStreamer's own tracer: a line for
+        # every buffer and element, so not part of the summaries
+        os.environ.setdefault("GST_TRACERS", "latency(flags=element)")
+        os.environ.setdefault("GST_DEBUG", "GST_TRACER:7")
+    # standard output goes to the sender, which reads format requests from it
+    os.dup2(2, 1)
     os.execv(
         "/usr/bin/gst-launch-1.0",
         (
@@ -51,13 +208,14 @@ def main(argv) -> NoReturn:
             "width={0},"
             "height={1},"
             "framerate={2}/1,"
-            "format=I420,"
+            "format={3},"
             "colorimetry=2:4:7:1,"
             "chroma-site=none,"
             "interlace-mode=progressive,"
             "pixel-aspect-ratio=1/1,"
             "max-framerate={2}/1,"
-            "views=1".format(width, height, fps),
+            "views=1".format(width, height, fps,
+                             PIXEL_FORMATS[pixel_format][0]),
             "!",
             "rawvideoparse",
             "use-sink-caps=true",
@@ -69,26 +227,442 @@ def main(argv) -> NoReturn:
     )
 
 
-def read_video_parameters() -> (int, int, int):
-    input_size = 6
+class StreamStats:
+    """Count missing frames and measure how late frames arrive"""
 
-    sstruct = struct.Struct("=HHH")
-    if sstruct.size != input_size:
-        raise AssertionError("bug")
+    def __init__(self):
+        self.next_sequence = None
+        self.frames = 0
+        self.missing = 0
+        self.lag_total = 0
+        self.lag_max = 0
+        self.last_report = time.monotonic()
+
+    def frame(self, sequence: int, capture_time: int) -> None:
+        """Account for a received frame"""
+        if self.next_sequence is not None:
+            self.missing += (sequence - self.next_sequence) & 0xFFFFFFFF
+        self.next_sequence = (sequence + 1) & 0xFFFFFFFF
+        # the clocks of the two qubes are synchronized by Qubes OS, but not
+        # precisely enough to trust a negative lag
+        lag = max(time.time_ns() - capture_time, 0)
+        self.frames += 1
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        if time.monotonic() - self.last_report >= STATS_INTERVAL_SECONDS:
+            self.report()
+
+    def report(self) -> None:
+        """Print and reset the statistics"""
+        if self.frames:
+            print(
+                "Received {} frames, {} missing, lag avg {:.1f} ms, "
+                "max {:.1f} ms".format(
+                    self.frames,
+                    self.missing,
+                    self.lag_total / self.frames / 1e6,
+                    self.lag_max / 1e6,
+                ),
+                file=sys.stderr,
+            )
+        self.frames = self.missing = self.lag_total = self.lag_max = 0
+        self.last_report = time.monotonic()
+
+
+class StageTracer:
+    """
+    Time the stages of the frame relay when QVC_TRACE is set, and print a
+    summary every STATS_INTERVAL_SECONDS
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.last_frame = None
+        self.last_report = time.monotonic()
+
+    def instrument(self, output, decoder) -> None:
+        """Time the calls to output and decoder, either may be None"""
+        if output is not None:
+            output.frame_buffer = self.timed("buffer", output.frame_buffer)
+            output.queue = self.timed("output", output.queue, frame=True)
+            output.write = self.timed("output", output.write, frame=True)
+        if decoder is not None:
+            decoder.decode = self.timed("decode", decoder.decode)
+
+    def timed(self, name: str, func, frame: bool = False):
+        def wrapper(*args):
+            start = time.monotonic_ns()
+            result = func(*args)
+            end = time.monotonic_ns()
+            self.record(name, end - start)
+            if frame:
+                self.frame(end)
+            return result
+        return wrapper
+
+    def record(self, name: str, duration: int) -> None:
+        stage = self.stages.setdefault(name, [0, 0, 0])
+        stage[0] += 1
+        stage[1] += duration
+        stage[2] = max(stage[2], duration)
+
+    def frame(self, now: int) -> None:
+        """Account for a frame passed on to the output"""
+        if self.last_frame is not None:
+            self.record("interval", now - self.last_frame)
+        self.last_frame = now
+        if time.monotonic() - self.last_report >= STATS_INTERVAL_SECONDS:
+            self.report()
+
+    def report(self) -> None:
+        """Print and reset the timings"""
+        for name, (count, total, longest) in self.stages.items():
+            print(
+                "Trace: {}: {} frames, time avg {:.2f} ms, max {:.2f} ms"
+                .format(name, count, total / count / 1e6, longest / 1e6),
+                file=sys.stderr,
+            )
+        self.stages = {}
+        self.last_report = time.monotonic()
+
+
+def read_into(stream, buf) -> bool:
+    """
+    Fill buf from stream.  Return False on a clean end of stream, raise if
+    the stream ends in the middle of buf.
+    """
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(view):
+        count = stream.readinto(view[pos:])
+        if not count:
+            if pos == 0:
+                return False
+            raise RuntimeError("stream truncated")
+        pos += count
+    return True
+
+
+def watch_requests(dev_path: str) -> None:
+    """
+    Pass the formats written to $XDG_RUNTIME_DIR/qvc-<device>.request, one
+    WIDTHxHEIGHTxFPS per line, on to the sender
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        return
+    path = os.path.join(runtime_dir,
+                        "qvc-{}.request".format(os.path.basename(dev_path)))
+    try:
+        os.mkfifo(path, 0o600)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        print("Cannot create {}: {}".format(path, e), file=sys.stderr)
+        return
+    atexit.register(os.unlink, path)
+    format_re = re.compile(
+        rb"\A([1-9][0-9]{0,3})x([1-9][0-9]{0,3})x([1-9][0-9]{0,3})\s*\Z"
+    )
+
+    def run() -> None:
+        while True:
+            with open(path, "rb") as fifo:
+                for line in fifo:
+                    match = format_re.match(line)
+                    if match is None:
+                        print("Ignoring format request {!r}, expected "
+                              "WIDTHxHEIGHTxFPS".format(line), file=sys.stderr)
+                        continue
+                    os.write(1, format_struct.pack(*map(int, match.groups())))
+
+    threading.Thread(target=run, daemon=True).start()
 
+
+class PipeOutput:
+    """Write raw frames to a file descriptor"""
+
+    def __init__(self, fd: int, frame_size: int):
+        self.output = os.fdopen(fd, "wb", buffering=0)
+        self.frame = bytearray(frame_size)
+
+    def frame_buffer(self) -> memoryview:
+        """Return the buffer to fill with the next frame"""
+        return memoryview(self.frame)
+
+    def queue(self) -> None:
+        """Write the frame filled in frame_buffer()"""
+        self.output.write(self.frame)
+
+    def write(self, frame) -> None:
+        """Write a complete frame"""
+        self.output.write(frame)
+
+    def reconfigure(self, *_args) -> None:
+        raise RuntimeError("format changes need the mmap engine")
+
+    def close(self) -> None:
+        self.output.close()
+
+
+def frame_layout(pixel_format: int, width: int, height: int):
+    """
+    Return the stride of the first plane and the size of a frame, as laid out
+    by GStreamer when no explicit layout is negotiated
+    """
+    if PIXEL_FORMATS[pixel_format][0] == "YUY2":
+        stride = (width * 2 + 3) & ~3
+        return stride, stride * height
+    if PIXEL_FORMATS[pixel_format][0] == "NV12":
+        stride = (width + 3) & ~3
+        return stride, stride * ((height + 1) & ~1) * 3 // 2
+    _offsets, strides, size = i420.i420_layout(width, height)
+    return strides[0], size
+
+
+def open_loopback(dev_path: str, width: int, height: int,
+                  pixel_format: int):
+    """
+    Return a LoopbackOutput for the device, or None if the gst-launch-1.0
+    pipeline must be used instead
+    """
+    stride, frame_size = frame_layout(pixel_format, width, height)
+    try:
+        fd = os.open(dev_path, os.O_RDWR | os.O_CLOEXEC)
+    except OSError as e:
+        print("Cannot open {}: {}, falling back to GStreamer".format(
+            dev_path, e), file=sys.stderr)
+        return None
+    try:
+        return v4l2out.LoopbackOutput(
+            fd, width, height, frame_size,
+            pixelformat=PIXEL_FORMATS[pixel_format][1],
+            bytesperline=stride,
+        )
+    except (OSError, v4l2out.UnsupportedFormat) as e:
+        os.close(fd)
+        print("Cannot map {}: {}, falling back to GStreamer".format(
+            dev_path, e), file=sys.stderr)
+        return None
+
+
+def receive_frames(fmt: Tuple[int, int, int], version: int, transport: int,
+                   pixel_format: int, *, output) -> None:
+    """
+    Pass the frames on standard input, of the (width, height, fps) format of
+    the header, to output until the end of stream
+    """
+    if version >= 2:
+        relay_frames(fmt, transport, pixel_format, output)
+        return
+    # legacy stream: raw frames without headers
+    tracer = StageTracer() if os.environ.get("QVC_TRACE") else None
+    if tracer is not None:
+        tracer.instrument(output, None)
+    stdin = os.fdopen(0, "rb")
+    while read_into(stdin, output.frame_buffer()):
+        output.queue()
+    if tracer is not None:
+        tracer.report()
+
+
+def relay_frames(fmt: Tuple[int, int, int], transport: int,
+                 pixel_format: int, output) -> None:
+    """
+    Check and strip the frame headers of the stream on standard input,
+    decode the payload if needed, and pass raw frames to output.  A format
+    that output cannot take is refused: output keeps the previous format,
+    the sender is asked to go back to it, and the frames are dropped until
+    the next format change.
+    """
+    width, height, _ = fmt
+    tracer = StageTracer() if os.environ.get("QVC_TRACE") else None
+
+    def configure(width: int, height: int):
+        frame_size = frame_layout(pixel_format, width, height)[1]
+        if transport in (TRANSPORT_TILES, TRANSPORT_RLE):
+            if transport == TRANSPORT_TILES:
+                decoder = tiledec.TileDecoder(width, height)
+            else:
+                decoder = rledec.RowDecoder(width, height)
+            max_payload_size = decoder.max_payload_size
+            payload = memoryview(bytearray(max_payload_size))
+        else:
+            decoder = None
+            max_payload_size = frame_size
+            payload = None
+        if tracer is not None and decoder is not None:
+            tracer.instrument(None, decoder)
+        return frame_size, decoder, max_payload_size, payload
+
+    frame_size, decoder, max_payload_size, payload = configure(width, height)
+    if tracer is not None:
+        tracer.instrument(output, None)
+    header = bytearray(frame_header.size)
+    new_format = bytearray(format_struct.size)
+    # the format of output, and where frames of a refused format are read to
+    output_format = fmt
+    dropped = None
+    stats = StreamStats()
+    stdin = os.fdopen(0, "rb")
+    while read_into(stdin, header):
+        (
+            untrusted_sequence,
+            untrusted_capture_time,
+            untrusted_length,
+        ) = frame_header.unpack(header)
+        if untrusted_length & FORMAT_CHANGE:
+            if untrusted_length != FORMAT_CHANGE | format_struct.size:
+                raise RuntimeError("invalid format change length")
+            if not read_into(stdin, new_format):
+                raise RuntimeError("stream truncated")
+            width, height, fps = check_format(
+                *format_struct.unpack(new_format)
+            )
+            if not (width and height and fps):
+                raise RuntimeError("empty format")
+            print("Format changed to {}x{} {} FPS".format(width, height, fps),
+                  file=sys.stderr)
+            frame_size, decoder, max_payload_size, payload = \
+                configure(width, height)
+            dropped = None
+            if (width, height, fps) == output_format:
+                continue
+            old_width, old_height = output_format[:2]
+            try:
+                output.reconfigure(width, height, frame_size,
+                                   frame_layout(pixel_format, width, height)[0])
+            except v4l2out.UnsupportedFormat as e:
+                print("Refusing format {}x{} {} FPS: {}".format(
+                    width, height, fps, e), file=sys.stderr)
+                stride, old_size = frame_layout(pixel_format, old_width,
+                                                old_height)
+                output.reconfigure(old_width, old_height, old_size, stride)
+                os.write(1, format_struct.pack(*output_format))
+                dropped = bytearray(max_payload_size)
+                continue
+            output_format = (width, height, fps)
+            continue
+        if untrusted_length > max_payload_size or (
+            decoder is None and untrusted_length != frame_size
+        ):
+            raise RuntimeError("invalid frame length")
+        if dropped is not None:
+            untrusted_payload = memoryview(dropped)[:untrusted_length]
+        elif decoder is None:
+            # raw frames are read straight into the output
+            untrusted_payload = output.frame_buffer()
+        else:
+            untrusted_payload = payload[:untrusted_length]
+        del untrusted_length
+        if not read_into(stdin, untrusted_payload):
+            raise RuntimeError("stream truncated")
+        if dropped is not None:
+            continue
+        # only used for statistics, so any value is acceptable
+        stats.frame(untrusted_sequence, untrusted_capture_time)
+        if decoder is None:
+            output.queue()
+        else:
+            decoder.decode(untrusted_payload)
+            output.write(decoder.frame)
+    stats.report()
+    if tracer is not None:
+        tracer.report()
+
+
+def start_relay(fmt: Tuple[int, int, int], transport: int,
+                pixel_format: int) -> None:
+    """
+    Fork a child that turns the stream on standard input into raw frames and
+    feeds them to the rest of the pipeline through a pipe, which replaces
+    standard input of this process.
+    """
+    read_fd, write_fd = os.pipe()
+    if os.fork() == 0:
+        os.close(read_fd)
+        output = PipeOutput(write_fd,
+                            frame_layout(pixel_format, *fmt[:2])[1])
+        try:
+            relay_frames(fmt, transport, pixel_format, output)
+        except BrokenPipeError:
+            pass
+        except BaseException:  # pylint: disable=broad-except
+            traceback.print_exc()
+            os._exit(1)  # pylint: disable=protected-access
+        os._exit(0)  # pylint: disable=protected-access
+    os.close(write_fd)
+    os.dup2(read_fd, 0)
+    os.close(read_fd)
+
+
+def read_exact(input_size: int, canceled_exit_code: int = 1) -> bytes:
     untrusted_input = os.read(0, input_size)
 
     if len(untrusted_input) == 0:
         print("Operation canceled by sender", file=sys.stderr)
-        sys.exit(1)
+        sys.exit(canceled_exit_code)
 
     if len(untrusted_input) != input_size:
         raise RuntimeError("wrong number of bytes read")
-    untrusted_width, untrusted_height, untrusted_fps = sstruct.unpack(
-        untrusted_input
+    return untrusted_input
+
+
+def read_video_parameters() -> (int, int, int, int, int, int):
+    input_size = 6
+
+    sstruct = struct.Struct("=HHH")
+    if sstruct.size != input_size:
+        raise AssertionError("bug")
+
+    untrusted_first, untrusted_second, untrusted_third = sstruct.unpack(
+        read_exact(input_size, NO_HEADER_EXIT_CODE)
     )
-    del untrusted_input
+    if untrusted_first != EXTENDED_HEADER_MAGIC:
+        # legacy header: width, height and fps of a raw I420 stream
+        version = 1
+        transport = TRANSPORT_RAW
+        pixel_format = 0
+        untrusted_width, untrusted_height, untrusted_fps = (
+            untrusted_first, untrusted_second, untrusted_third
+        )
+    else:
+        untrusted_version, untrusted_transport = (
+            untrusted_second, untrusted_third
+        )
+        if not 2 <= untrusted_version <= PROTOCOL_VERSION:
+            raise RuntimeError("unsupported protocol version")
+        if untrusted_transport not in (TRANSPORT_RAW, TRANSPORT_TILES,
+                                       TRANSPORT_RLE):
+            raise RuntimeError("unsupported transport")
+        version = untrusted_version
+        transport = untrusted_transport
+        del untrusted_version, untrusted_transport
+        untrusted_width, untrusted_height, untrusted_fps = sstruct.unpack(
+            read_exact(input_size)
+        )
+        pixel_format = 0
+        if version >= 3:
+            (untrusted_pixel_format,) = struct.unpack("=H", read_exact(2))
+            if untrusted_pixel_format not in PIXEL_FORMATS:
+                raise RuntimeError("unsupported pixel format")
+            pixel_format = untrusted_pixel_format
+            del untrusted_pixel_format
+            # the decoders only produce I420 frames
+            if pixel_format != 0 and transport != TRANSPORT_RAW:
+                raise RuntimeError("transport requires I420 frames")
+    del untrusted_first, untrusted_second, untrusted_third
+
+    width, height, fps = check_format(untrusted_width, untrusted_height,
+                                      untrusted_fps)
+    del untrusted_width, untrusted_height, untrusted_fps
+
+    return width, height, fps, version, transport, pixel_format
+
 
+def check_format(untrusted_width: int, untrusted_height: int,
+                 untrusted_fps: int) -> (int, int, int):
+    """Check a format sent by the sender, in the header or later"""
     if (
         untrusted_width > 7680
         or untrusted_height > 4320
@@ -97,10 +671,7 @@ def read_video_parameters() -> (int, int, int):
         raise RuntimeError(
             "excessive width, height, and/or fps (max 8K: 7680x4320)"
         )
-    width, height, fps = untrusted_width, untrusted_height, untrusted_fps
-    del untrusted_width, untrusted_height, untrusted_fps
-
-    return width, height, fps
+    return untrusted_width, untrusted_height, untrusted_fps
 
 
 if __name__ == "__main__":
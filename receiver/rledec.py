@@ -0,0 +1,86 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Row delta and run-length decoder for the lossless transport
+
+See sender/rle.py for the wire format.  Everything read here comes from the
+sending qube and is untrusted.  Every run is checked against the lines left
+in its plane before anything is copied, and the decoder only copies whole
+lines within the frame, so its work is bounded by the frame size.
+"""
+
+import struct
+
+from i420 import frame_lines, i420_layout
+
+RUN_SAME = 0
+RUN_UP = 1
+RUN_FILL = 2
+RUN_LITERAL = 3
+
+run_header = struct.Struct("=BH")
+
+
+# pylint: disable=too-few-public-methods
+class RowDecoder:
+    """Rebuild I420 frames from runs of lines"""
+
+    def __init__(self, width: int, height: int):
+        self.lines = frame_lines(width, height)
+        frame_size = i420_layout(width, height)[2]
+        self.frame = bytearray(frame_size)
+        # every line in a run of its own, with a fill byte
+        self.max_payload_size = (frame_size +
+                                 len(self.lines) * (run_header.size + 1))
+        self._have_frame = False
+
+    def decode(self, untrusted_payload: memoryview) -> None:
+        """Decode the payload of a frame into self.frame"""
+        pos = 0
+        index = 0
+        while index < len(self.lines):
+            if pos + run_header.size > len(untrusted_payload):
+                raise RuntimeError("truncated run header")
+            untrusted_op, untrusted_count = run_header.unpack_from(
+                untrusted_payload, pos
+            )
+            pos += run_header.size
+            if not 1 <= untrusted_count <= len(self.lines) - index:
+                raise RuntimeError("run out of bounds")
+            count = untrusted_count
+            del untrusted_count
+            start, _end, plane = self.lines[index]
+            _start, end, last_plane = self.lines[index + count - 1]
+            if plane != last_plane:
+                raise RuntimeError("run crosses planes")
+
+            if untrusted_op == RUN_SAME:
+                if not self._have_frame:
+                    raise RuntimeError("unchanged lines in the first frame")
+            elif untrusted_op == RUN_UP:
+                if index == 0 or self.lines[index - 1][2] != plane:
+                    raise RuntimeError("no line above the run")
+                stride = self.lines[index][1] - start
+                self.frame[start:end] = \
+                    self.frame[start - stride:start] * count
+            elif untrusted_op == RUN_FILL:
+                if pos + 1 > len(untrusted_payload):
+                    raise RuntimeError("truncated fill value")
+                self.frame[start:end] = \
+                    bytes(untrusted_payload[pos:pos + 1]) * (end - start)
+                pos += 1
+            elif untrusted_op == RUN_LITERAL:
+                if pos + end - start > len(untrusted_payload):
+                    raise RuntimeError("truncated lines")
+                self.frame[start:end] = untrusted_payload[pos:pos + end - start]
+                pos += end - start
+            else:
+                raise RuntimeError("unknown run op")
+            del untrusted_op
+            index += count
+        if pos != len(untrusted_payload):
+            raise RuntimeError("trailing data after the last run")
+        self._have_frame = True
@@ -63,12 +63,72 @@ v4l2_loopback_config_format = "ii32sIIIIiiii"
 # use legacy numbers since the change was recent
 V4L2LOOPBACK_CTL_ADD = 0x4C80
 
+DEFAULT_NAME = "Qubes Video Companion"
+
+#: Present when the qvc-device-pool service is enabled for this qube
+POOL_FLAG = "/run/qubes-service/qvc-device-pool"
+#: Devices of each name kept registered after their stream ends, when the
+#: pool is enabled
+POOL_SIZE = 2
+#: Devices to register before giving up, when other streams keep taking new
+#: devices from the pool before this one can claim them
+CLAIM_ATTEMPTS = 3
+
+
+def pool_enabled():
+    return os.path.exists(POOL_FLAG)
+
+
+def device_name(dev_nr):
+    """Return the card label of a video device, None if it is gone"""
+    try:
+        with open(f"/sys/class/video4linux/video{dev_nr}/name",
+                  encoding="utf-8") as name:
+            return name.read().rstrip("\n")
+    except OSError:
+        return None
+
+
+def devices_named(name):
+    """Return the numbers of the video devices with a card label"""
+    numbers = []
+    try:
+        entries = os.listdir("/sys/class/video4linux")
+    except FileNotFoundError:
+        return numbers
+    for entry in entries:
+        if entry.startswith("video") and entry[len("video"):].isdigit() \
+                and device_name(entry[len("video"):]) == name:
+            numbers.append(int(entry[len("video"):]))
+    return sorted(numbers)
+
+
+def claim_device(dev_nr):
+    """
+    Lock a device for the stream of this process, so that no other stream
+    takes it from the pool
+
+    The lock is held until this process and the programs it runs, such as
+    gst-launch-1.0, exit.
+    """
+    try:
+        fd = os.open(f"/dev/video{dev_nr}", os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    os.set_inheritable(fd, True)
+    return True
+
 
 def register_device(name):
     ctrl_fd = os.open("/dev/v4l2loopback", os.O_RDWR)
     try:
         if not name:
-            name = "Qubes Video Companion"
+            name = DEFAULT_NAME
         # arg is v4l2_loopback_config config struct
         conf = bytearray(
             struct.pack(
@@ -92,10 +152,19 @@ def register_device(name):
         os.close(ctrl_fd)
 
 
+def check_call(cmdline):
+    """
+    Run a command without the standard input and output of this process,
+    which are the video stream when called from receiver.py
+    """
+    subprocess.check_call(cmdline, stdin=subprocess.DEVNULL,
+                          stdout=sys.stderr)
+
+
 def try_esc_exec(exe, cmdline):
     if shutil.which(exe) is not None:
         try:
-            subprocess.check_call([exe, *cmdline])
+            check_call([exe, *cmdline])
         except Exception:
             return False
     else:
@@ -103,12 +172,16 @@ def try_esc_exec(exe, cmdline):
     return True
 
 
-def main(argv):
-    name = None
-    if len(argv) == 2:
-        name = f"QVC - {argv[1]}"
-    elif len(argv) != 1:
-        raise RuntimeError("Invalid arguments - usage: setup.py [name]")
+def setup_device(name):
+    """
+    Take an idle device from the pool, or load v4l2loopback if needed and
+    register a device; return its path
+    """
+    pool = pool_enabled()
+    if pool:
+        for dev_nr in devices_named(name or DEFAULT_NAME):
+            if claim_device(dev_nr):
+                return f"/dev/video{dev_nr}"
     if not os.path.exists("/dev/v4l2loopback"):
         if (
             not try_esc_exec(
@@ -127,11 +200,30 @@ def main(argv):
                 "Cannot escalate privileges to modprobe v4l2loopback"
             )
         # wait for udev to apply permission
-        subprocess.check_call(
+        check_call(
             ["udevadm", "wait", "--settle", "/dev/v4l2loopback"]
         )
-    dev_nr = register_device(name)
-    print(f"/dev/video{dev_nr}")
+    if not pool:
+        return f"/dev/video{register_device(name)}"
+    for _attempt in range(CLAIM_ATTEMPTS):
+        dev_nr = register_device(name)
+        # udev must have applied the permissions before the device can be
+        # claimed, and until then another stream may find it idle
+        check_call(
+            ["udevadm", "wait", "--settle", f"/dev/video{dev_nr}"]
+        )
+        if claim_device(dev_nr):
+            return f"/dev/video{dev_nr}"
+    raise RuntimeError(f"Cannot claim any of {CLAIM_ATTEMPTS} new devices")
+
+
+def main(argv):
+    name = None
+    if len(argv) == 2:
+        name = f"QVC - {argv[1]}"
+    elif len(argv) != 1:
+        raise RuntimeError("Invalid arguments - usage: setup.py [name]")
+    print(setup_device(name))
 
 
 if __name__ == "__main__":
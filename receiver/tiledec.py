@@ -0,0 +1,110 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Tile delta decoder for the screen sharing transport
+
+See sender/tiles.py for the wire format.  Everything read here comes from the
+sending qube and is untrusted, so every header is bounds-checked before any
+pixel data is accepted.
+"""
+
+import struct
+
+from i420 import i420_layout
+
+TILE_SIZE = 64
+
+FRAME_KEY = 0
+FRAME_DELTA = 1
+
+frame_header = struct.Struct("=BH")
+tile_header = struct.Struct("=HH")
+
+
+# pylint: disable=too-few-public-methods
+class TileDecoder:
+    """Rebuild full I420 frames from keyframes and tile deltas"""
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.offsets, self.strides, frame_size = i420_layout(width, height)
+        self.columns = (width + TILE_SIZE - 1) // TILE_SIZE
+        self.rows = (height + TILE_SIZE - 1) // TILE_SIZE
+        self.frame = bytearray(frame_size)
+        # a delta frame with every tile is the largest possible payload
+        self.max_payload_size = (frame_header.size + frame_size +
+                                 self.columns * self.rows * tile_header.size)
+        self._have_keyframe = False
+
+    def _tile_rect(self, column: int, row: int, plane: int):
+        """Return the (left, top, width, height) of a tile in a plane"""
+        left = column * TILE_SIZE
+        top = row * TILE_SIZE
+        width = min(TILE_SIZE, self.width - left)
+        height = min(TILE_SIZE, self.height - top)
+        if plane == 0:
+            return left, top, width, height
+        return (left // 2, top // 2,
+                (left + width + 1) // 2 - left // 2,
+                (top + height + 1) // 2 - top // 2)
+
+    def _apply_tile(self, untrusted_payload: memoryview, pos: int) -> int:
+        """Copy the tile at pos into the frame, return the end of the tile"""
+        if pos + tile_header.size > len(untrusted_payload):
+            raise RuntimeError("truncated tile header")
+        untrusted_column, untrusted_row = tile_header.unpack_from(
+            untrusted_payload, pos
+        )
+        if untrusted_column >= self.columns or untrusted_row >= self.rows:
+            raise RuntimeError("tile position out of bounds")
+        column, row = untrusted_column, untrusted_row
+        del untrusted_column, untrusted_row
+        pos += tile_header.size
+
+        rects = [self._tile_rect(column, row, plane) for plane in range(3)]
+        size = sum(width * height for _left, _top, width, height in rects)
+        if pos + size > len(untrusted_payload):
+            raise RuntimeError("truncated tile")
+
+        for plane, (left, top, width, height) in enumerate(rects):
+            offset, stride = self.offsets[plane], self.strides[plane]
+            for line in range(top, top + height):
+                start = offset + line * stride + left
+                self.frame[start:start + width] = \
+                    untrusted_payload[pos:pos + width]
+                pos += width
+        return pos
+
+    def decode(self, untrusted_payload: memoryview) -> None:
+        """Apply the payload of a frame to self.frame"""
+        if len(untrusted_payload) < frame_header.size:
+            raise RuntimeError("truncated frame header")
+        untrusted_kind, untrusted_count = frame_header.unpack_from(
+            untrusted_payload
+        )
+        pos = frame_header.size
+        if untrusted_kind == FRAME_KEY:
+            if untrusted_count != 0:
+                raise RuntimeError("keyframe with tiles")
+            if len(untrusted_payload) - pos != len(self.frame):
+                raise RuntimeError("wrong keyframe size")
+            self.frame[:] = untrusted_payload[pos:]
+            self._have_keyframe = True
+            return
+        if untrusted_kind != FRAME_DELTA:
+            raise RuntimeError("unknown frame kind")
+        if not self._have_keyframe:
+            raise RuntimeError("delta frame before the first keyframe")
+        if untrusted_count > self.columns * self.rows:
+            raise RuntimeError("too many tiles")
+        count = untrusted_count
+        del untrusted_kind, untrusted_count
+
+        for _ in range(count):
+            pos = self._apply_tile(untrusted_payload, pos)
+        if pos != len(untrusted_payload):
+            raise RuntimeError("trailing data after the last tile")
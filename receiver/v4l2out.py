@@ -0,0 +1,237 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Write frames to a V4L2 output device through mmap'd buffers
+
+The layouts below are those of 64-bit architectures.
+"""
+
+import fcntl
+import mmap
+import struct
+import time
+
+# see videodev2.h:
+#    struct v4l2_format {
+#        __u32 type;
+#        union {
+#            struct v4l2_pix_format pix;  /* width, height, pixelformat,
+#                                            field, bytesperline, sizeimage,
+#                                            colorspace, priv, flags,
+#                                            ycbcr_enc, quantization,
+#                                            xfer_func */
+#            ...
+#            __u8 raw_data[200];
+#        } fmt;
+#    };
+v4l2_format = struct.Struct("=I4xIIIIIIIIIIII152x")
+#    struct v4l2_requestbuffers {
+#        __u32 count;
+#        __u32 type;
+#        __u32 memory;
+#        __u32 capabilities;
+#        __u8 flags;
+#        __u8 reserved[3];
+#    };
+v4l2_requestbuffers = struct.Struct("=IIIIB3x")
+#    struct v4l2_buffer {
+#        __u32 index;
+#        __u32 type;
+#        __u32 bytesused;
+#        __u32 flags;
+#        __u32 field;
+#        struct timeval timestamp;
+#        struct v4l2_timecode timecode;
+#        __u32 sequence;
+#        __u32 memory;
+#        union {
+#            __u32 offset;
+#            unsigned long userptr;
+#            struct v4l2_plane *planes;
+#            __s32 fd;
+#        } m;
+#        __u32 length;
+#        __u32 reserved2;
+#        union {
+#            __s32 request_fd;
+#            __u32 reserved;
+#        };
+#    };
+v4l2_buffer = struct.Struct("=IIIII4xqq16sIII4xIIi4x")
+
+
+def _ioc(direction: int, number: int, size: int) -> int:
+    return (direction << 30) | (size << 16) | (ord("V") << 8) | number
+
+
+_IOW = 1
+_IOWR = 3
+VIDIOC_S_FMT = _ioc(_IOWR, 5, v4l2_format.size)
+VIDIOC_REQBUFS = _ioc(_IOWR, 8, v4l2_requestbuffers.size)
+VIDIOC_QUERYBUF = _ioc(_IOWR, 9, v4l2_buffer.size)
+VIDIOC_QBUF = _ioc(_IOWR, 15, v4l2_buffer.size)
+VIDIOC_DQBUF = _ioc(_IOWR, 17, v4l2_buffer.size)
+VIDIOC_STREAMON = _ioc(_IOW, 18, 4)
+VIDIOC_STREAMOFF = _ioc(_IOW, 19, 4)
+
+V4L2_BUF_TYPE_VIDEO_OUTPUT = 2
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_NONE = 1
+V4L2_PIX_FMT_YUV420 = int.from_bytes(b"YU12", "little")
+V4L2_PIX_FMT_YUYV = int.from_bytes(b"YUYV", "little")
+V4L2_PIX_FMT_NV12 = int.from_bytes(b"NV12", "little")
+# what GStreamer uses for colorimetry=2:4:7:1
+V4L2_COLORSPACE_SRGB = 8
+
+BUFFER_COUNT = 4
+
+
+class UnsupportedFormat(Exception):
+    """The device cannot take frames in the layout of the stream"""
+
+
+class LoopbackOutput:
+    """
+    Queue frames, laid out as GStreamer does, to a V4L2 output device
+
+    Frames are written by the caller straight into the buffers mapped from
+    the device, so each frame is copied only once, from the stream.
+    """
+
+    def __init__(self, fd: int, width: int, height: int, frame_size: int,
+                 *, ioctl=fcntl.ioctl, mmap_func=mmap.mmap,
+                 pixelformat: int = V4L2_PIX_FMT_YUV420,
+                 bytesperline: int = 0):
+        self.fd = fd
+        self.pixelformat = pixelformat
+        self._ioctl = ioctl
+        self._mmap = mmap_func
+        self._maps = []
+        self._views = []
+        self._free = []
+        self._current = None
+        self._streaming = False
+        self._configure(width, height, frame_size, bytesperline or width)
+
+    def _configure(self, width: int, height: int, frame_size: int,
+                   bytesperline: int) -> None:
+        """Set the format of the device and map its buffers"""
+        fd, ioctl, pixelformat = self.fd, self._ioctl, self.pixelformat
+        self.frame_size = frame_size
+        untrusted_fmt = v4l2_format.unpack(ioctl(
+            fd, VIDIOC_S_FMT, v4l2_format.pack(
+                V4L2_BUF_TYPE_VIDEO_OUTPUT,
+                width,
+                height,
+                pixelformat,
+                V4L2_FIELD_NONE,
+                bytesperline,
+                frame_size,  # sizeimage
+                V4L2_COLORSPACE_SRGB,
+                *(0,) * 5,
+            )
+        ))
+        # rows padded by GStreamer (widths that are not a multiple of 8, or
+        # odd heights) are laid out differently by V4L2
+        if untrusted_fmt[1:4] != (width, height, pixelformat) or \
+                untrusted_fmt[5:7] != (bytesperline, frame_size):
+            raise UnsupportedFormat(
+                "device does not accept {}x{} {} frames of {} bytes"
+                .format(width, height,
+                        pixelformat.to_bytes(4, "little").decode("ascii"),
+                        frame_size)
+            )
+
+        count = v4l2_requestbuffers.unpack(ioctl(
+            fd, VIDIOC_REQBUFS, v4l2_requestbuffers.pack(
+                BUFFER_COUNT, V4L2_BUF_TYPE_VIDEO_OUTPUT, V4L2_MEMORY_MMAP,
+                0, 0,
+            )
+        ))[0]
+        if not count:
+            raise UnsupportedFormat("device has no mmap buffers")
+        for index in range(count):
+            buf = v4l2_buffer.unpack(
+                ioctl(fd, VIDIOC_QUERYBUF, self._buffer(index))
+            )
+            offset, length = buf[10], buf[11]
+            if length < frame_size:
+                raise UnsupportedFormat("device buffers are too small")
+            mapping = self._mmap(fd, length, mmap.MAP_SHARED,
+                                 mmap.PROT_READ | mmap.PROT_WRITE,
+                                 offset=offset)
+            self._maps.append(mapping)
+            self._views.append(memoryview(mapping)[:frame_size])
+            self._free.append(index)
+
+    def _buffer(self, index: int, bytesused: int = 0) -> bytes:
+        now = time.time_ns()
+        return v4l2_buffer.pack(
+            index,
+            V4L2_BUF_TYPE_VIDEO_OUTPUT,
+            bytesused,
+            0,  # flags
+            V4L2_FIELD_NONE,
+            now // 1000000000,  # timestamp
+            now // 1000 % 1000000,
+            b"",  # timecode
+            0,  # sequence
+            V4L2_MEMORY_MMAP,
+            0,  # offset
+            0,  # length
+            0,  # reserved2
+            0,  # request_fd
+        )
+
+    def frame_buffer(self) -> memoryview:
+        """Return the buffer to fill with the next frame"""
+        if self._free:
+            self._current = self._free.pop()
+        else:
+            # wait for the device to be done with a buffer
+            self._current = v4l2_buffer.unpack(
+                self._ioctl(self.fd, VIDIOC_DQBUF, self._buffer(0))
+            )[0]
+        return self._views[self._current]
+
+    def queue(self) -> None:
+        """Queue the frame written to the last frame_buffer()"""
+        self._ioctl(self.fd, VIDIOC_QBUF,
+                    self._buffer(self._current, self.frame_size))
+        self._current = None
+        if not self._streaming:
+            self._ioctl(self.fd, VIDIOC_STREAMON,
+                        struct.pack("=I", V4L2_BUF_TYPE_VIDEO_OUTPUT))
+            self._streaming = True
+
+    def write(self, frame) -> None:
+        """Copy a complete frame to the device"""
+        self.frame_buffer()[:] = frame
+        self.queue()
+
+    def reconfigure(self, width: int, height: int, frame_size: int,
+                    bytesperline: int) -> None:
+        """Switch to another frame size, with the same pixel format"""
+        self.close()
+        # free the old buffers, so that the format can be changed
+        self._ioctl(self.fd, VIDIOC_REQBUFS, v4l2_requestbuffers.pack(
+            0, V4L2_BUF_TYPE_VIDEO_OUTPUT, V4L2_MEMORY_MMAP, 0, 0,
+        ))
+        self._free = []
+        self._current = None
+        self._configure(width, height, frame_size, bytesperline)
+
+    def close(self) -> None:
+        if self._streaming:
+            self._ioctl(self.fd, VIDIOC_STREAMOFF,
+                        struct.pack("=I", V4L2_BUF_TYPE_VIDEO_OUTPUT))
+            self._streaming = False
+        for view in self._views:
+            view.release()
+        for mapping in self._maps:
+            mapping.close()
+        self._views = []
+        self._maps = []
@@ -5,31 +5,20 @@
 
 """Configure the best video format for any given webcam device"""
 
-import subprocess
+import sys
+import os
+
+# v4l2.py is installed next to webcam_formats.py, but lives in sender/ here
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../sender"))
+# pylint: disable=wrong-import-position
+import v4l2
 import webcam_formats
 
 
 def main():
     """Program entry point"""
 
-    # For testing
-    # Perhaps make unit tests for this; although it
-    # would be better to use V4L2 ioctls
-
-    # file = open("scripts/webcam-formats/webcam-formats", 'r')
-    # webcam_supported_formats = file.read().replace('\t', '').splitlines()
-
-    # Can't use capture_output because Python version in dom0 is too old
-    webcam_supported_formats = (
-        subprocess.run(
-            ["v4l2-ctl", "--list-formats-ext"],
-            stdout=subprocess.PIPE,
-            check=True,
-        )
-        .stdout.decode("utf-8")
-        .replace("\t", "")
-        .splitlines()
-    )
+    webcam_supported_formats = v4l2.list_formats("/dev/video0")
 
     webcam_settings = webcam_formats.WebcamFormats(webcam_supported_formats)
     webcam_settings.configure_webcam_best_format()
@@ -9,98 +9,36 @@ import argparse
 import subprocess
 from collections import OrderedDict
 import qubesdb
+import v4l2
 
 
 class WebcamFormats:
     """
-    Parse supported webcam formats
+    Index supported webcam formats
 
-    Output from: v4l2-ctl --device /dev/videoX --list-formats-ext
+    Formats as enumerated by v4l2.list_formats()
     """
 
-    formats = ""
-    formats_len = 0
     video_device = ""
 
-    __line_idx = 0
-
-    pix_fmt = {}
-
     selected_format = ""
     selected_size = ()
     selected_fps = 0
 
     def __init__(self, formats, video_device="/dev/video0"):
-        self.formats = formats
-        self.formats_len = len(self.formats)
-
         self.video_device = video_device
-
-        while self.__line_idx < self.formats_len:
-            line = self.formats[self.__line_idx]
-
-            if line.startswith("["):
-                self.__index()
-
-            self.__line_idx = self.__line_idx + 1
-
-    def __index(self):
-        """Parse each pixel format by index value"""
-
-        # We must use a while loop because Python's for loop doesn't
-        # allow changing the index while inside the loop
-        # Python's for loop is like other languages foreach loop
-        while self.__line_idx < self.formats_len:
-            line = self.formats[self.__line_idx]
-
-            if line.startswith("["):
-                # Remove removing surrounding single quotes (') junk
-                pix_fmt = line.split()[1].replace("'", "")
-                self.pix_fmt[pix_fmt] = {}
-
-            if line.startswith("Size"):
-                self.__size()
-            else:
-                self.__line_idx += 1
-
-    def __size(self):
-        """Parse size value (video dimensions)"""
-
-        size = self.formats[self.__line_idx].split()[2]
-        # Split size by the "x" in between the dimensions into a tuple
-        size = tuple(map(int, size.split("x")))
-
-        last_key = list(self.pix_fmt)[-1]
-        self.pix_fmt[last_key][size] = []
-
-        self.__line_idx += 1
-        self.__fps()
-
-    def __fps(self):
-        """Parse FPS values for size"""
-
-        while self.__line_idx < self.formats_len:
-            line = self.formats[self.__line_idx]
-
-            if line.startswith("Interval"):
-                # Remove all FPS values that are not a whole number
-                if "." in line and ".0" not in line:
-                    self.__line_idx += 1
-                    continue
-
-                # Capture portion of line with FPS
-                fps = line.split()[3]
-                # Remove decimals with all zeros and junk opening
-                # bracket captured with FPS
-                fps = int(fps.split(".")[0].replace("(", ""))
-
-                last_key = list(self.pix_fmt)[-1]
-                last_key2 = list(self.pix_fmt[last_key])[-1]
-                self.pix_fmt[last_key][last_key2].append(fps)
-            else:
-                break
-
-            self.__line_idx += 1
+        self.formats = list(formats)
+
+        # pixel format -> (width, height) -> list of integer frame rates
+        self.pix_fmt = {}
+        for fmt in formats:
+            sizes = self.pix_fmt.setdefault(fmt.pixelformat, {})
+            rates = sizes.setdefault((fmt.width, fmt.height), [])
+            # integer rates are what can be requested; fractional ones such
+            # as 29.97 are close enough to their rounded value
+            fps = max(round(fmt.fps), 1)
+            if fps not in rates:
+                rates.append(fps)
 
     def find_best_format(self):
         """
@@ -121,7 +59,7 @@ class WebcamFormats:
             self.selected_format = best_format
         else:
             # Otherwise, use the first pixel format specified by the webcam
-            self.selected_format = self.pix_fmt[0]
+            self.selected_format = next(iter(self.pix_fmt))
 
         sizes_sorted = self.pix_fmt[self.selected_format].copy()
         sizes_sorted = OrderedDict(sorted(sizes_sorted.items(), reverse=True))
@@ -142,8 +80,11 @@ class WebcamFormats:
     def publish_formats_info(self, portid):
         qdb = qubesdb.QubesDB()
         prefix = f"/webcam-devices/{portid}"
+        # invalidate the list used by the sender until it is complete again
+        qdb.rm(prefix + "/generation")
         # remove old entries
         qdb.rm(prefix + "/formats/")
+        qdb.rm(prefix + "/capture-formats/")
         formats = (
                 (w, h, fps)
                 for pix_fmt, size_dict in self.pix_fmt.items()
@@ -156,6 +97,14 @@ class WebcamFormats:
                       f"{width}x{height}x{fps}")
             format_nr += 1
 
+        # the exact formats, so the sender does not have to enumerate them
+        # again on every call; dom0 can read them as well, but only lists
+        # the rounded formats above
+        for format_nr, fmt in enumerate(self.formats):
+            qdb.write(f"{prefix}/capture-formats/{format_nr:03d}",
+                      v4l2.format_to_str(fmt))
+        qdb.write(prefix + "/generation",
+                  v4l2.device_generation(self.video_device))
 
     def configure_webcam_best_format(self):
         """Configure webcam device to use the best format"""
@@ -204,16 +153,7 @@ def main():
         args.device = "/dev/video0"
         args.portid = "dev-video0"
 
-    webcam_supported_formats = (
-        subprocess.run(
-            ["v4l2-ctl", "--device", args.device, "--list-formats-ext"],
-            stdout=subprocess.PIPE,
-            check=True,
-        )
-        .stdout.decode("utf-8")
-        .replace("\t", "")
-        .splitlines()
-    )
+    webcam_supported_formats = v4l2.list_formats(args.device)
 
     webcam_settings = WebcamFormats(webcam_supported_formats, args.device)
     webcam_settings.publish_formats_info(args.portid)
@@ -0,0 +1,191 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Share one capture pipeline between the streams of a video source
+
+The first stream of a source captures and converts the frames, and listens on
+a UNIX socket in /run/qubes.  Later streams of the same source connect to it
+instead of opening the device again, and get every frame as raw I420 data
+with its sequence number and capture time.  They frame and encode it for
+their own receiver, so each receiver still negotiates its protocol version,
+transport and latency budget on its own.
+
+Every consumer has a queue of at most QUEUE_FRAMES frames.  When a receiver
+does not keep up, the oldest frame of its queue is dropped, which leaves a
+gap in the sequence numbers it gets, and neither the capture nor the other
+receivers wait for it.
+"""
+
+import collections
+import contextlib
+import fcntl
+import os
+import socket
+import struct
+import threading
+from typing import Callable, Iterator, Optional, Tuple
+
+#: Present when the qvc-fanout service is enabled for this qube
+FANOUT_FLAG = "/run/qubes-service/qvc-fanout"
+
+#: Frames queued for a consumer before the oldest one is dropped
+QUEUE_FRAMES = 2
+
+#: Sent once to every consumer: width, height, fps
+params_header = struct.Struct("=HHH")
+#: Precedes every frame: sequence number, capture time in ns, frame size
+frame_header = struct.Struct("=IQI")
+
+
+def enabled() -> bool:
+    return os.path.exists(FANOUT_FLAG)
+
+
+def socket_path(source: str, key: str) -> str:
+    return f"/run/qubes/qvc-{source}-{key}.sock"
+
+
+@contextlib.contextmanager
+def locked(path: str):
+    """Serialize the processes that share state named by path"""
+    with open(path + ".lock", "a", encoding="ascii") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def connect_or_listen(path: str) \
+        -> Tuple[Optional[socket.socket], Optional[socket.socket]]:
+    """
+    Connect to the stream capturing the source, or become it
+
+    Return a (feed, listener) tuple, where exactly one is not None.
+    """
+    with locked(path):
+        feed = socket.socket(socket.AF_UNIX,
+                             socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        try:
+            feed.connect(path)
+            return feed, None
+        except (FileNotFoundError, ConnectionRefusedError):
+            feed.close()
+        # left behind by a stream that did not exit cleanly
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX,
+                                 socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        listener.bind(path)
+        listener.listen()
+        return None, listener
+
+
+# pylint: disable=too-few-public-methods
+class Consumer:
+    """A stream fed by the capture pipeline, with its own writer thread"""
+
+    def __init__(self, sock: socket.socket,
+                 on_close: Callable[["Consumer"], None]):
+        self.sock = sock
+        self._frames = collections.deque()
+        self._cond = threading.Condition()
+        self._on_close = on_close
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, sequence: int, capture_time: int, data: bytes) -> None:
+        with self._cond:
+            if len(self._frames) >= QUEUE_FRAMES:
+                self._frames.popleft()
+            self._frames.append((sequence, capture_time, data))
+            self._cond.notify()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._cond:
+                    while not self._frames:
+                        self._cond.wait()
+                    sequence, capture_time, data = self._frames.popleft()
+                self.sock.sendall(
+                    frame_header.pack(sequence, capture_time, len(data))
+                )
+                self.sock.sendall(data)
+        except OSError:
+            pass
+        finally:
+            self.sock.close()
+            self._on_close(self)
+
+
+class Distributor:
+    """Accept consumers and pass every captured frame on to all of them"""
+
+    def __init__(self, listener: socket.socket,
+                 on_empty: Callable[[], None]):
+        self.consumers = []
+        self._listener = listener
+        self._on_empty = on_empty
+        self._lock = threading.Lock()
+        self._params = None
+        self._ready = threading.Event()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def start(self, width: int, height: int, fps: int) -> None:
+        """Start accepting consumers, once the format is known"""
+        self._params = params_header.pack(width, height, fps)
+        self._ready.set()
+
+    def _accept(self) -> None:
+        while True:
+            conn, _ = self._listener.accept()
+            self._ready.wait()
+            try:
+                conn.sendall(self._params)
+            except OSError:
+                conn.close()
+                continue
+            with self._lock:
+                self.consumers.append(Consumer(conn, self._remove))
+
+    def _remove(self, consumer: Consumer) -> None:
+        with self._lock:
+            self.consumers.remove(consumer)
+            empty = not self.consumers
+        if empty:
+            self._on_empty()
+
+    def publish(self, sequence: int, capture_time: int, data: bytes) -> None:
+        """Queue a frame for every consumer; never blocks on them"""
+        with self._lock:
+            consumers = list(self.consumers)
+        for consumer in consumers:
+            consumer.put(sequence, capture_time, data)
+
+
+class Feed:
+    """The frames of a capture pipeline run by another stream"""
+
+    def __init__(self, sock: socket.socket):
+        self._file = sock.makefile("rb")
+
+    def _read(self, size: int) -> bytes:
+        data = self._file.read(size)
+        if len(data) != size:
+            raise EOFError("capture stream ended")
+        return data
+
+    def parameters(self) -> Tuple[int, int, int]:
+        return params_header.unpack(self._read(params_header.size))
+
+    def frames(self) -> Iterator[Tuple[int, int, bytes]]:
+        """Yield (sequence, capture time, data) until the capture ends"""
+        while True:
+            try:
+                sequence, capture_time, size = frame_header.unpack(
+                    self._read(frame_header.size)
+                )
+                data = self._read(size)
+            except EOFError:
+                return
+            yield sequence, capture_time, data
@@ -0,0 +1,98 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Per-frame state of the stream sent to the receiver"""
+
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import latency
+import tracing
+
+DROP_REPORT_INTERVAL_NS = 10 * 1000000000
+
+
+class Framing:
+    """
+    The sequence numbers of the frames, whether the receiver follows format
+    changes, and the encoder, latency budget and tracer of the current
+    format
+    """
+
+    def __init__(self):
+        #: set by the trace option, before the first format is started
+        self.trace = False
+        self.format = None  # type: Optional[Tuple[int, int, int]]
+        #: set once the receiver said that it follows format changes
+        self.formats_followed = False
+        self.encoder = None
+        self.budget = None  # type: Optional[latency.LatencyBudget]
+        self.tracer = None  # type: Optional[tracing.PipelineTracer]
+        self._sequence = 0
+        self._sequence_lock = threading.Lock()
+        self._last_drop_report = 0
+
+    def start(self, fmt: Tuple[int, int, int], encoder,
+              budget: Optional[latency.LatencyBudget], pipeline=None) -> None:
+        """
+        Start framing a (width, height, fps) format; pipeline is traced if
+        tracing is enabled, or only the encoding and writing without it
+        """
+        self.format = fmt
+        self.encoder = encoder
+        if self.budget is not None and budget is not None:
+            # the drops of the previous format are reported with the new one
+            budget.add_counts(*self.budget.take_counts())
+        self.budget = budget
+        self._last_drop_report = time.monotonic_ns()
+        if self.trace:
+            self.tracer = tracing.PipelineTracer(pipeline)
+
+    def next_sequence(self) -> int:
+        """Return the sequence number of the next captured frame"""
+        with self._sequence_lock:
+            sequence = self._sequence
+            self._sequence = (sequence + 1) & 0xFFFFFFFF
+        return sequence
+
+    def overrun(self) -> None:
+        """Count a frame dropped before it got a sequence number"""
+        # leave a gap in the sequence numbers, so that the receiver sees it
+        self.next_sequence()
+        self.budget.overrun()
+
+    def take_drops(self) -> Optional[Tuple[int, int]]:
+        """
+        Return the (late, overruns) counts of dropped frames at most every
+        DROP_REPORT_INTERVAL_NS, None if there is nothing to report yet
+        """
+        now = time.monotonic_ns()
+        if now - self._last_drop_report < DROP_REPORT_INTERVAL_NS:
+            return None
+        self._last_drop_report = now
+        late, overruns = self.budget.take_counts()
+        if not late and not overruns:
+            return None
+        return late, overruns
+
+    def encode(self, data: bytes, start: int) -> List[bytes]:
+        """
+        Return the chunks to send for a frame whose processing began at
+        start
+        """
+        chunks = [data] if self.encoder is None else self.encoder.encode(data)
+        if self.tracer is not None:
+            self.tracer.record("encode", start, time.monotonic_ns())
+        return chunks
+
+    def sent(self, size: int, start: int) -> None:
+        """Account for a frame whose write began at start"""
+        end = time.monotonic_ns()
+        if self.budget is not None:
+            self.budget.sent(size, end - start)
+        if self.tracer is not None:
+            self.tracer.record("write", start, end)
@@ -0,0 +1,39 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Memory layout of I420 frames
+
+Used by the encoders of the sender and the decoders of the receiver, which
+must agree on it.  This file is installed next to both.
+"""
+
+from typing import List, Tuple
+
+
+def i420_layout(width: int, height: int) -> Tuple[
+        Tuple[int, int, int], Tuple[int, int, int], int]:
+    """
+    Return the plane offsets, strides and total size of an I420 frame, as
+    laid out by GStreamer when no explicit layout is negotiated
+    """
+    y_stride = (width + 3) & ~3
+    c_stride = ((width + 1) // 2 + 3) & ~3
+    c_height = (height + 1) // 2
+    u_offset = y_stride * c_height * 2
+    v_offset = u_offset + c_stride * c_height
+    size = v_offset + c_stride * c_height
+    return (0, u_offset, v_offset), (y_stride, c_stride, c_stride), size
+
+
+def frame_lines(width: int, height: int) -> List[Tuple[int, int, int]]:
+    """Return the (start, end, plane) of every line of an I420 frame"""
+    offsets, strides, size = i420_layout(width, height)
+    ends = offsets[1:] + (size,)
+    lines = []
+    for plane in range(3):
+        for start in range(offsets[plane], ends[plane], strides[plane]):
+            lines.append((start, start + strides[plane], plane))
+    return lines
@@ -0,0 +1,85 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Latency budget for the video sender"""
+
+import threading
+import time
+
+# weight of the newest sample in the moving averages
+SMOOTHING = 0.25
+# writes that return faster than this did not block on the receiver
+BLOCKED_WRITE_NS = 1000000
+
+
+class LatencyBudget:
+    """
+    Decide which frames to drop so that frames reach the receiver at most
+    max_latency_ns after they were captured
+
+    A write that blocks means the receiver is not keeping up, and the output
+    is then assumed to stay busy for as long as it takes to drain one frame
+    at the rate measured from such writes.  While it is busy, frames that
+    would arrive too late are dropped.  Once it is idle, the next frame is
+    always sent, as nothing fresher can be delivered anyway.
+    """
+
+    def __init__(self, max_latency_ns: int):
+        self.max_latency_ns = max_latency_ns
+        self.drain_rate = 0.0  # bytes per ns, 0 until a write blocked
+        self.frame_size = 0.0
+        self.busy_until = 0
+        self.late = 0
+        self.overruns = 0
+        self._lock = threading.Lock()
+
+    def transfer_time(self) -> int:
+        """Return the time needed to drain an average frame, in ns"""
+        if not self.drain_rate:
+            return 0
+        return int(self.frame_size / self.drain_rate)
+
+    def should_send(self, capture_time: int) -> bool:
+        """Return False if a frame should be dropped, and count it"""
+        if self.busy_until <= time.time_ns():
+            return True
+        delivery = self.busy_until + self.transfer_time()
+        if delivery - capture_time <= self.max_latency_ns:
+            return True
+        with self._lock:
+            self.late += 1
+        return False
+
+    def sent(self, size: int, duration_ns: int) -> None:
+        """Account for a frame written to the receiver"""
+        self.frame_size += SMOOTHING * (size - self.frame_size)
+        if duration_ns < BLOCKED_WRITE_NS:
+            self.busy_until = 0
+            return
+        rate = size / duration_ns
+        if self.drain_rate:
+            self.drain_rate += SMOOTHING * (rate - self.drain_rate)
+        else:
+            self.drain_rate = rate
+        self.busy_until = time.time_ns() + self.transfer_time()
+
+    def overrun(self) -> None:
+        """Count a frame dropped by a leaky queue before reaching Python"""
+        with self._lock:
+            self.overruns += 1
+
+    def add_counts(self, late: int, overruns: int) -> None:
+        """Count drops that were not reported yet, from an earlier budget"""
+        with self._lock:
+            self.late += late
+            self.overruns += overruns
+
+    def take_counts(self):
+        """Return and reset the (late, overruns) drop counters"""
+        with self._lock:
+            counts = self.late, self.overruns
+            self.late = self.overruns = 0
+        return counts
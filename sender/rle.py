@@ -0,0 +1,88 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Row delta and run-length encoder for the lossless transport
+
+A frame in GStreamer's default I420 layout is split into lines: the rows of
+the Y plane, including the padding row of odd heights, then those of the U
+and V planes, each with its stride.  The payload of every frame is a
+sequence of runs that covers every line exactly once, in order.  A run starts
+with a ``=BH`` (op, line count) header and never crosses planes.
+
+- RUN_SAME lines are the same as in the previous frame.
+- RUN_UP lines are each the same as the line above them.
+- RUN_FILL lines consist of a single byte value, which follows the header.
+- RUN_LITERAL lines follow the header as they are.
+
+Static scenes become RUN_SAME runs, and flat areas of the screen RUN_UP or
+RUN_FILL runs, while the decoder only ever copies whole lines.
+"""
+
+import struct
+from typing import List, Tuple
+
+from i420 import frame_lines
+
+RUN_SAME = 0
+RUN_UP = 1
+RUN_FILL = 2
+RUN_LITERAL = 3
+
+MAX_RUN_LINES = 0xFFFF
+
+run_header = struct.Struct("=BH")
+
+
+# pylint: disable=too-few-public-methods
+class RowEncoder:
+    """Encode I420 frames as runs of lines"""
+
+    def __init__(self, width: int, height: int):
+        self.lines = frame_lines(width, height)
+        self._previous = None  # type: bytes
+
+    def _kind(self, frame: bytes, index: int) -> Tuple[int, int]:
+        """Return the kind of run that encodes a line, and its fill value"""
+        start, end, plane = self.lines[index]
+        line = frame[start:end]
+        if self._previous is not None and \
+                line == self._previous[start:end]:
+            return RUN_SAME, 0
+        if index and self.lines[index - 1][2] == plane and \
+                line == frame[2 * start - end:start]:
+            return RUN_UP, 0
+        if line.count(line[:1]) == len(line):
+            return RUN_FILL, line[0]
+        return RUN_LITERAL, 0
+
+    def encode(self, frame: bytes) -> List[bytes]:
+        """Return the payload of a frame as a list of chunks"""
+        chunks = []
+        run_kind = run_value = None
+        run_start = run_count = 0
+
+        def end_run():
+            chunks.append(run_header.pack(run_kind, run_count))
+            if run_kind == RUN_FILL:
+                chunks.append(bytes((run_value,)))
+            elif run_kind == RUN_LITERAL:
+                chunks.append(frame[self.lines[run_start][0]:
+                                    self.lines[run_start + run_count - 1][1]])
+
+        for index, (_start, _end, plane) in enumerate(self.lines):
+            kind, value = self._kind(frame, index)
+            if (run_count and kind == run_kind and value == run_value
+                    and run_count < MAX_RUN_LINES
+                    and self.lines[run_start][2] == plane):
+                run_count += 1
+                continue
+            if run_count:
+                end_run()
+            run_kind, run_value = kind, value
+            run_start, run_count = index, 1
+        end_run()
+        self._previous = frame
+        return chunks
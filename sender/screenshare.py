@@ -10,21 +10,80 @@
 # GI requires version declaration before importing
 # pylint: disable=wrong-import-position
 
+import sys
 import gi
 gi.require_version("Gdk", "3.0")
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, Gdk, GdkPixbuf
+from gi.repository import Gtk, Gdk, GdkPixbuf, GLib
 from service import Service
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from os import environ
+import xwindows
+
+#: How often the size of a shared window is checked
+WINDOW_POLL_MS = 500
+
+#: Largest size of the previews in the picker
+THUMBNAIL_WIDTH = 960
+THUMBNAIL_HEIGHT = 540
+#: Rows of the screen grabbed at once for a preview, which bounds both the
+#: memory used and the time the dialog is not responding
+THUMBNAIL_STRIP_ROWS = 128
+
+
+class Thumbnail:
+    """A preview of an area of the screen, built a strip at a time"""
+
+    def __init__(self, root: Gdk.Window, left: int, top: int, width: int,
+                 height: int):
+        self._root = root
+        self._left, self._top = left, top
+        self._width, self._height = width, height
+        self._row = 0
+        scale = min(THUMBNAIL_WIDTH / width, THUMBNAIL_HEIGHT / height, 1)
+        self._scale = scale
+        self.pixbuf = GdkPixbuf.Pixbuf.new(
+            GdkPixbuf.Colorspace.RGB, False, 8,
+            max(round(width * scale), 1), max(round(height * scale), 1),
+        )
+        self.pixbuf.fill(0)
+
+    def done(self) -> bool:
+        return self._row >= self._height
+
+    def step(self) -> None:
+        """Grab the next strip of the area and scale it into the preview"""
+        rows = min(THUMBNAIL_STRIP_ROWS, self._height - self._row)
+        strip = Gdk.pixbuf_get_from_window(self._root, self._left,
+                                           self._top + self._row,
+                                           self._width, rows)
+        if strip is None:
+            # off the screen
+            self._row = self._height
+            return
+        top = int(self._row * self._scale)
+        bottom = min(self.pixbuf.get_height(),
+                     -int(-(self._row + rows) * self._scale))
+        if bottom > top:
+            strip.scale(self.pixbuf, 0, top, self.pixbuf.get_width(),
+                        bottom - top, 0, self._row * self._scale,
+                        self._scale, self._scale,
+                        GdkPixbuf.InterpType.BILINEAR)
+        self._row += rows
 
 
 class ScreenShare(Service):
     """Screen sharing video souce class"""
 
-    def __init__(self) -> None:
+    def __init__(self, *, untrusted_arg: str) -> None:
+        super().__init__()
         self.selected_monitor_index = None
-        self.main(self)
+        self.selected_window = None  # type: Optional[int]
+        self._x_display = None  # type: Optional[xwindows.Display]
+        self._window_size = None  # type: Optional[Tuple[int, int]]
+        untrusted_arg = self.parse_protocol_options(untrusted_arg)
+        self.parse_requested_format(untrusted_arg)
+        self.main()
 
     def video_source(self) -> str:
         return "screenshare"
@@ -32,16 +91,31 @@ class ScreenShare(Service):
     def icon(self) -> str:
         return "video-display"
 
+    def headless(self) -> bool:
+        # the monitor picker needs GTK anyway
+        return False
+
+    def preload_elements(self) -> List[str]:
+        return super().preload_elements() + ["ximagesrc", "videoscale"]
+
+    def x_display(self) -> xwindows.Display:
+        if self._x_display is None:
+            self._x_display = xwindows.Display()
+        return self._x_display
+
     def monitor_dialog(self) -> None:
         display = Gdk.Display().get_default()
         monitor_count = display.get_n_monitors()
+        windows = self.x_display().windows()
 
-        if monitor_count == 1:
+        if monitor_count == 1 and not windows:
             self.selected_monitor_index = 0
             return
 
+        root = display.get_default_screen().get_root_window()
         combobox = Gtk.ComboBoxText()
-        monitor_screenshots = []
+        # the previews are filled in while the dialog is shown
+        thumbnails = []
         for monitor_num in range(monitor_count):
             monitor_name = display.get_monitor(monitor_num).get_model()
             monitor = display.get_monitor(monitor_num)
@@ -55,17 +129,14 @@ class ScreenShare(Service):
                                  f"{monitor_width}x{monitor_height} "
                                  f"{monitor_x}+{monitor_y}")
 
-            pixbuf = Gdk.pixbuf_get_from_window(
-                display.get_default_screen().get_root_window(),
-                monitor_x,
-                monitor_y,
-                monitor_width,
-                monitor_height)
-            pixbuf = pixbuf.scale_simple(
-                min(960, pixbuf.get_width()),
-                min(540, pixbuf.get_height()),
-                GdkPixbuf.InterpType.BILINEAR)
-            monitor_screenshots.append(pixbuf)
+            thumbnails.append(Thumbnail(root, monitor_x, monitor_y,
+                                        monitor_width, monitor_height))
+
+        for x_window in windows:
+            combobox.append_text(f"Window: {x_window.name}: "
+                                 f"{x_window.width}x{x_window.height}")
+            thumbnails.append(Thumbnail(root, x_window.x, x_window.y,
+                                        x_window.width, x_window.height))
 
         remote_domain = environ.get("QREXEC_REMOTE_DOMAIN")
         window_title = "Qubes Screen Share - " + remote_domain
@@ -74,7 +145,8 @@ class ScreenShare(Service):
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
         window.add(vbox)
 
-        window_text = "Select a monitor to share with qube " + remote_domain
+        window_text = ("Select a monitor or window to share with qube " +
+                       remote_domain)
         label = Gtk.Label(label=window_text)
         vbox.pack_start(label, False, False, 0)
         hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
@@ -90,7 +162,11 @@ class ScreenShare(Service):
         hbox.pack_end(cancel_button, False, False, 0)
 
         def on_ok_button_clicked(_):
-            self.selected_monitor_index = combobox.get_active()
+            index = combobox.get_active()
+            if index < monitor_count:
+                self.selected_monitor_index = index
+            else:
+                self.selected_window = windows[index - monitor_count].xid
             window.close()
 
         def on_cancel_button_clicked(_):
@@ -104,35 +180,113 @@ class ScreenShare(Service):
 
         def on_combobox_changed(combobox):
             monitor_index = combobox.get_active()
-            pixbuf = monitor_screenshots[monitor_index]
-            image.set_from_pixbuf(pixbuf)
+            image.set_from_pixbuf(thumbnails[monitor_index].pixbuf)
+
+        filler = None
+
+        def fill_thumbnails():
+            nonlocal filler
+            # the selected preview first, then the others in order
+            active = combobox.get_active()
+            pending = [thumbnail for thumbnail in
+                       [thumbnails[active], *thumbnails]
+                       if not thumbnail.done()]
+            if not pending:
+                filler = None
+                return GLib.SOURCE_REMOVE
+            pending[0].step()
+            if pending[0] is thumbnails[active]:
+                image.set_from_pixbuf(pending[0].pixbuf)
+            return GLib.SOURCE_CONTINUE
 
         combobox.connect("changed", on_combobox_changed)
         ## Show the first monitor screenshot when opening the dialog.
         on_combobox_changed(combobox)
 
+        def on_destroy(_window):
+            # nothing is grabbed once a choice is made
+            if filler is not None:
+                GLib.source_remove(filler)
+
+        filler = GLib.idle_add(fill_thumbnails, priority=GLib.PRIORITY_LOW)
+        window.connect("destroy", on_destroy)
         window.show_all()
         Gtk.main()
 
     def parameters(self) -> Tuple[int, int, int]:
         display = Gdk.Display().get_default()
-        self.monitor_dialog()
+        if self.selected_monitor_index is None and \
+                self.selected_window is None:
+            self.monitor_dialog()
+        if self.selected_window is not None:
+            return self.window_parameters()
         monitor_index = self.selected_monitor_index
         if monitor_index is None:
             raise ValueError("Monitor index was not set")
+        if monitor_index >= display.get_n_monitors():
+            # the selected monitor was unplugged
+            monitor_index = self.selected_monitor_index = 0
         geometry = display.get_monitor(monitor_index).get_geometry()
-        screen = Gdk.Screen().get_default()
         kwargs = {
-            "crop_t": geometry.y,
-            "crop_l": geometry.x,
-            "crop_r": screen.width()  - geometry.x - geometry.width,
-            "crop_b": screen.height() - geometry.y - geometry.height,
+            "capture_x": geometry.x,
+            "capture_y": geometry.y,
+            "capture_width": geometry.width,
+            "capture_height": geometry.height,
         }
-        return (geometry.width, geometry.height, 30, kwargs)
+        # scale down only, upscaling would just waste bandwidth
+        width, height, fps = geometry.width, geometry.height, 30
+        if self.untrusted_requested_fps:
+            width = min(self.untrusted_requested_width, width)
+            height = min(self.untrusted_requested_height, height)
+            fps = self.untrusted_requested_fps
+        return (width, height, fps, kwargs)
 
-    def pipeline(self, width: int, height: int, fps: int,
-                 **kwargs) -> List[str]:
-        caps = (
+    def window_parameters(self) -> Tuple[int, int, int]:
+        size = self.x_display().window_size(self.selected_window)
+        if size is None:
+            raise ValueError("The selected window was closed")
+        self._window_size = size
+        kwargs = {
+            "capture_xid": self.selected_window,
+            "capture_width": size[0],
+            "capture_height": size[1],
+        }
+        width, height, fps = size[0], size[1], 30
+        if self.untrusted_requested_fps:
+            width = min(self.untrusted_requested_width, width)
+            height = min(self.untrusted_requested_height, height)
+            fps = self.untrusted_requested_fps
+        return (width, height, fps, kwargs)
+
+    def start_transmission(self) -> None:
+        super().start_transmission()
+        if self.selected_window is not None:
+            GLib.timeout_add(WINDOW_POLL_MS, self.follow_window)
+            return
+        # follow resolution changes and monitor hotplug without restarting
+        # the stream
+        Gdk.Screen.get_default().connect(
+            "monitors-changed", lambda _screen: GLib.idle_add(self.renegotiate)
+        )
+
+    def follow_window(self) -> bool:
+        """Switch to the new size of the shared window, if it changed"""
+        if self._quitting:
+            return GLib.SOURCE_REMOVE
+        size = self.x_display().window_size(self.selected_window)
+        if size is None:
+            print("The shared window was closed, exiting", file=sys.stderr)
+            self.quit()
+            return GLib.SOURCE_REMOVE
+        if size != self._window_size:
+            self._window_size = size
+            self.renegotiate()
+        return GLib.SOURCE_CONTINUE
+
+    @staticmethod
+    def caps(width: int, height: int, fps: int) -> str:
+        """Return the caps shared by every stage of the pipeline"""
+        return (
             "colorimetry=2:4:7:1,"
             "chroma-site=none,"
             "width={0},"
@@ -143,29 +297,64 @@ class ScreenShare(Service):
             "max-framerate={2}/1,"
             "views=1".format(width, height, fps)
         )
+
+    def pipeline(self, width: int, height: int, fps: int,
+                 **kwargs) -> List[str]:
+        caps = self.caps(width, height, fps)
+        if "capture_xid" in kwargs:
+            # ximagesrc follows the window as it moves, and renegotiates
+            # when it is resized, until the stream switches to the new size
+            source = ("xid=" + str(kwargs["capture_xid"]),)
+            capture_caps = "framerate={}/1".format(fps)
+        else:
+            # only the selected monitor is read from the X server; the end
+            # coordinates are inclusive
+            source = (
+                "startx=" + str(kwargs["capture_x"]),
+                "starty=" + str(kwargs["capture_y"]),
+                "endx=" + str(kwargs["capture_x"] +
+                              kwargs["capture_width"] - 1),
+                "endy=" + str(kwargs["capture_y"] +
+                              kwargs["capture_height"] - 1),
+            )
+            # ximagesrc captures at the framerate of its caps, so a lower
+            # fps makes it capture less often instead of dropping frames
+            # afterwards
+            capture_caps = self.caps(
+                kwargs["capture_width"], kwargs["capture_height"], fps
+            )
+        if capture_caps == caps:
+            scale = ()
+        else:
+            # scaling before the conversion leaves fewer pixels to convert;
+            # the aspect ratio is kept by adding borders
+            scale = ("!", "videoscale")
         return [
             "ximagesrc",
             "use-damage=false",
+            *source,
             "!",
-            "queue",
-            "!",
-            "videocrop",
-            "top=" + str(kwargs["crop_t"]),
-            "left=" + str(kwargs["crop_l"]),
-            "right=" + str(kwargs["crop_r"]),
-            "bottom=" + str(kwargs["crop_b"]),
+            *self.queue(),
             "!",
             "capsfilter",
-            "caps=video/x-raw,format=BGRx," + caps,
+            "caps=video/x-raw,format=BGRx," + capture_caps,
+            *scale,
             "!",
             "videoconvert",
             "!",
             "capsfilter",
             "caps=video/x-raw,format=I420," + caps,
             "!",
-            "fdsink",
+            *self.sink(),
         ]
 
 
 if __name__ == "__main__":
-    screenshare = ScreenShare()
+    _untrusted_arg = ""
+    if len(sys.argv) == 2:
+        _untrusted_arg = sys.argv[1]
+    elif len(sys.argv) != 1:
+        print("Must have 0 or 1 argument, not " + str(len(sys.argv)),
+              file=sys.stderr)
+        sys.exit(1)
+    screenshare = ScreenShare(untrusted_arg=_untrusted_arg)
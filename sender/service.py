@@ -9,19 +9,71 @@
 # GI requires version declaration before importing
 # pylint: disable=wrong-import-position
 
+import atexit
 import os
+import re
+import signal
 import struct
 import sys
-from typing import Optional, NoReturn, List, Tuple
+import threading
+import time
+from typing import Optional, NoReturn, List, Tuple, TYPE_CHECKING
 
 import gi
 
-gi.require_version("Gtk", "3.0")
 gi.require_version("Gst", "1.0")
-gi.require_version("Notify", "0.7")
-from gi.repository import Gtk, Gst, Notify  # pylint: disable=no-name-in-module
+from gi.repository import Gio, GLib, Gst  # pylint: disable=no-name-in-module
 
-import tray_icon
+import rle
+import tiles
+import latency
+import fanout
+import framing
+import tracing
+
+if TYPE_CHECKING:
+    # imported when the icon is shown, as it needs Gtk
+    import tray_icon
+
+#: First field of the extended stream header.  It is larger than any valid
+#: width, so receivers that predate the extended header reject the stream
+#: instead of misinterpreting it.
+EXTENDED_HEADER_MAGIC = 0xFFFF
+
+#: Version 1 is the legacy ``=HHH`` header followed by raw frames.  Starting
+#: with version 2 the extended header is used, and every frame is preceded by
+#: a ``=IQI`` (sequence number, capture time in ns, payload length) header.
+#: Version 3 adds a ``=H`` pixel format code after the extended header.
+#: Version 4 adds format changes: a frame header with FORMAT_CHANGE set in
+#: the payload length is followed by a ``=HHH`` (width, height, fps) payload
+#: instead of a frame, and the receiver may ask for a format by writing the
+#: same ``=HHH`` to the standard input of the sender.  The first request
+#: after the header is FORMATS_FOLLOWED if the receiver can follow format
+#: changes, or FORMATS_FIXED if it cannot after all; the format is not changed
+#: before it.
+PROTOCOL_VERSION = 4
+
+TRANSPORT_RAW = 0
+TRANSPORT_TILES = 1
+TRANSPORT_RLE = 2
+
+TRANSPORT_OPTIONS = {"tiles": TRANSPORT_TILES, "rle": TRANSPORT_RLE}
+
+frame_header = struct.Struct("=IQI")
+format_struct = struct.Struct("=HHH")
+
+FORMAT_CHANGE = 0x80000000
+FORMATS_FOLLOWED = b"\xff" * format_struct.size
+FORMATS_FIXED = bytes(format_struct.size)
+
+#: Pixel format codes of the version 3 header.  I420 is always accepted, the
+#: others only when the receiver offers them.
+PIXEL_FORMATS = {"I420": 0, "YUY2": 1, "NV12": 2}
+
+KEYFRAME_INTERVAL_SECONDS = 2
+
+#: Present when the qvc-headless service is enabled for this qube
+HEADLESS_FLAG = "/run/qubes-service/qvc-headless"
 
 
 class Service:
@@ -29,7 +81,23 @@ class Service:
 
     _quitting = None  # type: bool
     _element = None  # type: Optional[Gst.Element]
-    _tray_icon = None  # type: tray_icon.TrayIcon
+    _tray_icon = None  # type: Optional[tray_icon.TrayIcon]
+    _loop = None  # type: Optional[GLib.MainLoop]
+    _gst_thread = None  # type: Optional[threading.Thread]
+    _framing = None  # type: framing.Framing
+    _fanout = None  # type: Optional[fanout.Distributor]
+    _output_closed = False  # type: bool
+    protocol_version = 1  # type: int
+    transport = TRANSPORT_RAW  # type: int
+    max_latency_ms = 0  # type: int
+    accepted_pixel_formats = frozenset({"I420"})  # type: frozenset
+    pixel_format = "I420"  # type: str
+    untrusted_requested_width = 0  # type: int
+    untrusted_requested_height = 0  # type: int
+    untrusted_requested_fps = 0  # type: int
+
+    def __init__(self):
+        self._framing = framing.Framing()
 
     def start_service(self, target_domain: str, remote_domain: str) -> None:
         """Start video sender service"""
@@ -47,13 +115,82 @@ class Service:
         )
 
         app = "Qubes Video Companion"
-        Notify.init(app)
-        Notify.Notification.new(app, msg, icon).show()
-
-        self._tray_icon = tray_icon.TrayIcon(app, icon, msg)
+        if self.headless():
+            self.notify(app, msg, icon)
+            GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM,
+                                 self.on_terminate)
+        else:
+            # GTK and AppIndicator take long to load, so only load them when
+            # they are used
+            # pylint: disable=import-outside-toplevel
+            gi.require_version("Notify", "0.7")
+            from gi.repository import Notify
+            import tray_icon
+
+            Notify.init(app)
+            Notify.Notification.new(app, msg, icon).show()
+
+            if self._fanout is None:
+                self._tray_icon = tray_icon.TrayIcon(app, icon, msg)
+            else:
+                # stop only this stream, others share the capture
+                self._tray_icon = tray_icon.TrayIcon(app, icon, msg,
+                                                     self.on_terminate)
+                # replaces the handler of the tray icon, which exits at once
+                GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM,
+                                     self.on_terminate)
 
         self.record_connect_state(remote_domain)
 
+    @property
+    def shares_capture(self) -> bool:
+        """Whether other streams get the frames of this capture"""
+        return self._fanout is not None
+
+    def headless(self) -> bool:
+        """
+        Return True to run without GTK: the user is notified with a plain
+        D-Bus notification and there is no tray icon
+        """
+        if os.path.exists(HEADLESS_FLAG):
+            return True
+        # the desktop session may not be up yet
+        display = re.match(r"\A:([0-9]+)(\.[0-9]+)?\Z",
+                           os.environ.get("DISPLAY", ""))
+        if display is None:
+            return not os.environ.get("DISPLAY")
+        return not os.path.exists("/tmp/.X11-unix/X" + display.group(1))
+
+    @staticmethod
+    def notify(app: str, msg: str, icon: str) -> None:
+        """Show a notification without waiting for it"""
+
+        def on_reply(bus: Gio.DBusConnection, result: Gio.AsyncResult):
+            try:
+                bus.call_finish(result)
+            except GLib.Error as e:
+                print("Cannot show notification:", e.message,
+                      file=sys.stderr)
+
+        try:
+            bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        except GLib.Error as e:
+            print("Cannot show notification:", e.message, file=sys.stderr)
+            return
+        bus.call(
+            "org.freedesktop.Notifications",
+            "/org/freedesktop/Notifications",
+            "org.freedesktop.Notifications",
+            "Notify",
+            GLib.Variant("(susssasa{sv}i)",
+                         (app, 0, icon, app, msg, [], {}, -1)),
+            None,
+            Gio.DBusCallFlags.NONE,
+            -1,
+            None,
+            on_reply,
+        )
+
     def video_source(self) -> str:
         """
         Return the video source
@@ -66,6 +203,13 @@ class Service:
         """
         raise NotImplementedError("Pure virtual method called!")
 
+    def fanout_key(self) -> str:
+        """
+        Return what tells the sources of video_source() apart, for sharing
+        a capture between streams
+        """
+        return "default"
+
     def pipeline(self, width: int, height: int, fps: int,
                  **kwargs) -> List[str]:
         """
@@ -79,20 +223,196 @@ class Service:
         """
         raise NotImplementedError("Pure virtual method called!")
 
+    def preload_elements(self) -> List[str]:
+        """
+        Return the elements whose plugins are loaded while the parameters
+        are computed
+        """
+        return ["queue", "capsfilter", "videoconvert",
+                "appsink" if self.uses_appsink() else "fdsink"]
+
+    def init_gstreamer(self) -> None:
+        """Initialize GStreamer and load the plugins of the pipeline"""
+
+        # pylint: disable=no-value-for-parameter
+        Gst.init()
+        for name in self.preload_elements():
+            factory = Gst.ElementFactory.find(name)
+            if factory is not None:
+                factory.load()
+
+    def parse_protocol_options(self, untrusted_arg: str) -> str:
+        """
+        Remove the protocol options requested by the receiver from the
+        service argument, and return the rest of it
+        """
+        version_re = re.compile(r"\Av[1-9][0-9]{0,2}\Z")
+        latency_re = re.compile(r"\Alat[1-9][0-9]{0,3}\Z")
+        untrusted_rest = []
+        for untrusted_option in untrusted_arg.split("+"):
+            if untrusted_option in TRANSPORT_OPTIONS:
+                transport = TRANSPORT_OPTIONS[untrusted_option]
+                if self.transport not in (TRANSPORT_RAW, transport):
+                    print("Only one transport can be requested",
+                          file=sys.stderr)
+                    sys.exit(1)
+                self.transport = transport
+            elif untrusted_option == "trace":
+                self._framing.trace = True
+            elif untrusted_option in ("yuy2", "nv12"):
+                self.accepted_pixel_formats |= {untrusted_option.upper()}
+            elif latency_re.match(untrusted_option):
+                self.max_latency_ms = int(untrusted_option[3:], 10)
+            elif version_re.match(untrusted_option):
+                # the receiver offers the newest version it supports
+                self.protocol_version = min(int(untrusted_option[1:], 10),
+                                            PROTOCOL_VERSION)
+            elif untrusted_option:
+                untrusted_rest.append(untrusted_option)
+        if ((self.transport != TRANSPORT_RAW or self.max_latency_ms)
+                and self.protocol_version < 2):
+            print("Transport and latency options require protocol version 2 "
+                  "or later", file=sys.stderr)
+            sys.exit(1)
+        if self.protocol_version < 3 or self.transport != TRANSPORT_RAW:
+            # only raw I420 frames can be encoded or sent without a format
+            self.accepted_pixel_formats = frozenset({"I420"})
+        return "+".join(untrusted_rest)
+
+    def queue(self) -> List[str]:
+        """
+        Return the queue that decouples the source from the rest of the
+        pipeline
+        """
+        if not self.max_latency_ms:
+            return ["queue"]
+        # drop old frames right after capture instead of letting them pile up
+        return [
+            "queue",
+            "name=source-queue",
+            "leaky=downstream",
+            "max-size-buffers=1",
+            "max-size-bytes=0",
+            "max-size-time=0",
+        ]
+
+    def parse_requested_format(self, untrusted_arg: Optional[str]) -> None:
+        """
+        Parse the optional WIDTH+HEIGHT+FPS format requested by the receiver
+        """
+        if not untrusted_arg:
+            self.untrusted_requested_width = 0
+            self.untrusted_requested_height = 0
+            self.untrusted_requested_fps = 0
+            return
+
+        def parse_int(untrusted_decimal: str) -> int:
+            if not ((1 <= len(untrusted_decimal) <= 4) and
+                    untrusted_decimal.isdigit() and
+                    untrusted_decimal[0] != "0"):
+                print("Invalid argument " + untrusted_arg + ": bad number",
+                      file=sys.stderr)
+                sys.exit(1)
+            return int(untrusted_decimal, 10)
+        if len(untrusted_arg) > 14:
+            # qrexec has already sanitized the argument to some degree,
+            # so this is safe
+            print("Invalid argument " + untrusted_arg +
+                  ": too long (limit 14 bytes)", file=sys.stderr)
+            sys.exit(1)
+        arg_list = untrusted_arg.split("+", 4)
+        if len(arg_list) != 3:
+            print("Invalid argument " + untrusted_arg +
+                  ": wrong number of integers (expected 3)",
+                  file=sys.stderr)
+            sys.exit(1)
+        ( self.untrusted_requested_width
+        , self.untrusted_requested_height
+        , self.untrusted_requested_fps
+        ) = map(parse_int, arg_list)
+
+    def uses_appsink(self) -> bool:
+        """Return True if frames are written by on_sample()"""
+        return (self.protocol_version >= 2 or self._fanout is not None
+                or self._framing.trace)
+
+    def sink(self) -> List[str]:
+        """
+        Return the pipeline elements that deliver frames to the receiver
+        """
+        if not self.uses_appsink():
+            return ["fdsink"]
+        sink = ["appsink", "name=sink", "emit-signals=true", "sync=false"]
+        if self.max_latency_ms:
+            # block instead of dropping, so that frames are only dropped by
+            # the source queue and the latency budget, which count them
+            sink += ["max-buffers=1"]
+        return sink
+
     def quit(self) -> None:
         """Close the pipeline"""
 
         if self._quitting:
             return
         self._quitting = True
-        self._element.set_state(Gst.State.NULL)
-        Gtk.main_quit()
+        if self._element is not None:
+            self._element.set_state(Gst.State.NULL)
+        if self._loop is not None:
+            self._loop.quit()
+        else:
+            # pylint: disable=import-outside-toplevel
+            from gi.repository import Gtk
+            Gtk.main_quit()
 
     def record_connect_state(self, remote_domain) -> None:
         """
         Record state of stream, for the disconnect purpose.
         """
 
+    def release_connect_state(self) -> None:
+        """
+        Forget the state recorded by record_connect_state(); may be called
+        more than once.
+        """
+
+    def on_terminate(self) -> bool:
+        """Handle SIGTERM, which qvc.WebcamDetach sends to detach a stream"""
+
+        if (self._fanout is not None and self._fanout.consumers
+                and not self._output_closed):
+            # other streams still get the frames of this capture
+            self.close_output()
+            return GLib.SOURCE_CONTINUE
+        self.quit()
+        return GLib.SOURCE_REMOVE
+
+    def close_output(self) -> None:
+        """Stop sending to the receiver, but keep capturing for others"""
+
+        self._output_closed = True
+        # the receiver sees the end of the stream
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+        self.release_connect_state()
+        if not self._fanout.consumers:
+            GLib.idle_add(self.quit)
+
+    def on_consumers_gone(self) -> None:
+        """Called by the distributor when its last consumer went away"""
+
+        if self._output_closed:
+            GLib.idle_add(self.quit)
+
+    def print_drops(self, late: int, overruns: int) -> None:
+        print(
+            "Dropped {} late frames and {} frames the pipeline could not "
+            "keep up with to stay within {} ms of latency".format(
+                late, overruns, self.max_latency_ms,
+            ),
+            file=sys.stderr,
+        )
+
     def msg_handler(self, _bus: Gst.Bus, msg: Gst.Message) -> None:
         """Handle pipeline messages"""
 
@@ -106,11 +426,14 @@ class Service:
             print("Clock lost, resetting", file=sys.stderr)
             self._element.set_state(Gst.State.PAUSED)
             self._element.set_state(Gst.State.PLAYING)
+        elif msg.type == Gst.MessageType.APPLICATION:
+            structure = msg.get_structure()
+            if structure.get_name() == "qvc-drops":
+                self.print_drops(structure.get_value("late"),
+                                 structure.get_value("overruns"))
 
     @staticmethod
-    def validate_qube_names(target_domain: str, remote_domain: str) -> NoReturn:
-        import re
-
+    def validate_qube_names(target_domain: str, remote_domain: str) -> None:
         qube_re = re.compile("^[A-Za-z][A-Za-z0-9_-]{1,30}$")
         if not qube_re.match(target_domain):
             print(
@@ -125,30 +448,278 @@ class Service:
             )
             sys.exit(1)
 
+    def write_header(self, width: int, height: int, fps: int) -> None:
+        """Send the stream header to the receiver"""
+
+        if self.protocol_version == 1:
+            header = struct.pack("=HHH", width, height, fps)
+        else:
+            header = struct.pack(
+                "=HHHHHH",
+                EXTENDED_HEADER_MAGIC,
+                self.protocol_version,
+                self.transport,
+                width,
+                height,
+                fps,
+            )
+            if self.protocol_version >= 3:
+                header += struct.pack("=H", PIXEL_FORMATS[self.pixel_format])
+        sys.stdout.buffer.write(header)
+        sys.stdout.buffer.flush()
+
+    def start_framing(self, width: int, height: int, fps: int,
+                      pipeline: Optional[Gst.Bin] = None) -> None:
+        """Set up the encoding, latency budget and tracing of the frames"""
+
+        encoder = None
+        if self.transport == TRANSPORT_TILES:
+            encoder = tiles.TileEncoder(
+                width, height, fps * KEYFRAME_INTERVAL_SECONDS
+            )
+        elif self.transport == TRANSPORT_RLE:
+            encoder = rle.RowEncoder(width, height)
+        budget = None
+        if self.max_latency_ms:
+            budget = latency.LatencyBudget(self.max_latency_ms * 1000000)
+        self._framing.start((width, height, fps), encoder, budget, pipeline)
+
     def start_transmission(self) -> None:
         """Start video transmission"""
 
         width, height, fps, extra_params = self.parameters()
-        sys.stdout.buffer.write(struct.pack("=HHH", width, height, fps))
-        sys.stdout.buffer.flush()
+        self.write_header(width, height, fps)
+        if self._fanout is not None:
+            self._fanout.start(width, height, fps)
+        if self._gst_thread is not None:
+            # started by main() while the parameters were computed
+            self._gst_thread.join()
         # pylint is confused about gi-imported objects, Gst.init() is a class
         # method
         # pylint: disable=no-value-for-parameter
         Gst.init()
+        self.start_pipeline(width, height, fps, extra_params)
+        if self.protocol_version >= 4:
+            threading.Thread(target=self.read_requests, daemon=True).start()
+
+    def start_pipeline(self, width: int, height: int, fps: int,
+                       extra_params: dict) -> None:
+        """Create and start the pipeline for a format"""
+
         element = self._element = Gst.parse_launchv(
             self.pipeline(width, height, fps, **extra_params)
         )
+        self.start_framing(width, height, fps, element)
+        if self.max_latency_ms:
+            element.get_by_name("source-queue").connect(
+                "overrun", self.on_overrun
+            )
+        if self.uses_appsink():
+            element.get_by_name("sink").connect("new-sample", self.on_sample)
         bus = element.get_bus()
         bus.add_signal_watch()
         bus.connect("message", self.msg_handler)
         element.set_state(Gst.State.PLAYING)
 
-    @classmethod
-    def main(cls, self) -> NoReturn:
+    def renegotiate(self) -> bool:
+        """
+        Switch to the format picked by parameters() now, without closing the
+        stream; called from the main loop
+        """
+        if self.protocol_version < 4 or self._element is None or \
+                self._quitting or self._output_closed:
+            return GLib.SOURCE_REMOVE
+        if not self._framing.formats_followed:
+            # the receiver may not be able to follow it, this is tried again
+            # once it said it can
+            return GLib.SOURCE_REMOVE
+        if self._fanout is not None:
+            # the other streams of the capture expect the same format
+            print("Not changing the format of a shared capture",
+                  file=sys.stderr)
+            return GLib.SOURCE_REMOVE
+        width, height, fps, extra_params = self.parameters()
+        if (width, height, fps) == self._framing.format:
+            return GLib.SOURCE_REMOVE
+        print("Changing the format to {}x{} {} FPS".format(width, height, fps),
+              file=sys.stderr)
+        # no frame of the old format can be written after this
+        self._element.get_bus().remove_signal_watch()
+        self._element.set_state(Gst.State.NULL)
+        try:
+            # not a frame, so it takes no sequence number
+            sys.stdout.buffer.write(frame_header.pack(
+                0, time.time_ns(), FORMAT_CHANGE | format_struct.size,
+            ))
+            sys.stdout.buffer.write(format_struct.pack(width, height, fps))
+            sys.stdout.buffer.flush()
+        except BrokenPipeError:
+            self.quit()
+            return GLib.SOURCE_REMOVE
+        self.start_pipeline(width, height, fps, extra_params)
+        return GLib.SOURCE_REMOVE
+
+    def read_requests(self) -> None:
+        """Apply the formats the receiver asks for on standard input"""
+
+        stdin = sys.stdin.buffer
+        while True:
+            untrusted_request = stdin.read(format_struct.size)
+            if len(untrusted_request) != format_struct.size:
+                return
+            if untrusted_request == FORMATS_FIXED:
+                # the receiver fell back to a pipeline that cannot follow a
+                # format change, keep the format as older versions do
+                print("Receiver cannot change the format, keeping it",
+                      file=sys.stderr)
+                self.protocol_version = 3
+                return
+            if untrusted_request == FORMATS_FOLLOWED:
+                self._framing.formats_followed = True
+                if self._fanout is None:
+                    # apply a change that came up before
+                    GLib.idle_add(self.renegotiate)
+                continue
+            untrusted_width, untrusted_height, untrusted_fps = \
+                format_struct.unpack(untrusted_request)
+            # the same limits as for the service argument
+            if not all(1 <= value <= 9999 for value in
+                       (untrusted_width, untrusted_height, untrusted_fps)):
+                print("Invalid format request, ignoring", file=sys.stderr)
+                continue
+            self.untrusted_requested_width = untrusted_width
+            self.untrusted_requested_height = untrusted_height
+            self.untrusted_requested_fps = untrusted_fps
+            del untrusted_width, untrusted_height, untrusted_fps
+            GLib.idle_add(self.renegotiate)
+
+    def start_shared_transmission(self, feed: fanout.Feed) -> None:
+        """Start sending the frames captured by another stream"""
+
+        try:
+            width, height, fps = feed.parameters()
+        except EOFError:
+            print("The shared capture ended", file=sys.stderr)
+            sys.exit(1)
+        # the requested format is ignored, the capture is already running
+        self.write_header(width, height, fps)
+        self.start_framing(width, height, fps)
+
+        def relay() -> None:
+            for sequence, capture_time, data in feed.frames():
+                if (self.send_frame(sequence, capture_time, data)
+                        != Gst.FlowReturn.OK):
+                    break
+            print("End of stream, exiting", file=sys.stderr)
+            GLib.idle_add(self.quit)
+
+        threading.Thread(target=relay, daemon=True).start()
+
+    def capture_time(self, buf: Gst.Buffer) -> int:
+        """Return the wall clock time at which a buffer was captured, in ns"""
+
+        now = time.time_ns()
+        clock = self._element.get_clock()
+        if clock is None or buf.pts == Gst.CLOCK_TIME_NONE:
+            return now
+        age = clock.get_time() - self._element.get_base_time() - buf.pts
+        return now - max(age, 0)
+
+    def on_overrun(self, _queue: Gst.Element) -> None:
+        """Count a frame dropped by the source queue"""
+
+        self._framing.overrun()
+
+    def report_drops(self) -> None:
+        """Periodically post the drop counts to the bus"""
+
+        drops = self._framing.take_drops()
+        if drops is None:
+            return
+        late, overruns = drops
+        if self._element is None:
+            # frames of a shared capture, there is no pipeline
+            self.print_drops(late, overruns)
+            return
+        structure = Gst.Structure.new_empty("qvc-drops")
+        structure.set_value("late", late)
+        structure.set_value("overruns", overruns)
+        self._element.post_message(
+            Gst.Message.new_application(self._element, structure)
+        )
+
+    def on_sample(self, sink: Gst.Element) -> Gst.FlowReturn:
+        """Pass a captured frame on; called from the streaming thread"""
+
+        buf = sink.emit("pull-sample").get_buffer()
+        sequence = self._framing.next_sequence()
+        capture_time = self.capture_time(buf)
+        if self._fanout is None:
+            return self.send_frame(sequence, capture_time, buf)
+        data = buf.extract_dup(0, buf.get_size())
+        self._fanout.publish(sequence, capture_time, data)
+        if self._output_closed:
+            return Gst.FlowReturn.OK
+        return self.send_frame(sequence, capture_time, data)
+
+    def send_frame(self, sequence: int, capture_time: int, frame) \
+            -> Gst.FlowReturn:
+        """Frame and send a frame, given as a Gst.Buffer or as bytes"""
+
+        budget = self._framing.budget
+        if budget is not None:
+            self.report_drops()
+            if not budget.should_send(capture_time):
+                # dropped before encoding, so that the next tile delta is
+                # computed against the last frame the receiver got
+                return Gst.FlowReturn.OK
+        encode_start = time.monotonic_ns()
+        if isinstance(frame, Gst.Buffer):
+            data = frame.extract_dup(0, frame.get_size())
+        else:
+            data = frame
+        chunks = self._framing.encode(data, encode_start)
+        size = sum(len(chunk) for chunk in chunks)
+        start = time.monotonic_ns()
+        try:
+            if self.protocol_version >= 2:
+                sys.stdout.buffer.write(
+                    frame_header.pack(sequence, capture_time, size)
+                )
+            sys.stdout.buffer.writelines(chunks)
+            sys.stdout.buffer.flush()
+        except BrokenPipeError:
+            if self._fanout is not None and self._fanout.consumers:
+                self.close_output()
+                return Gst.FlowReturn.OK
+            return Gst.FlowReturn.EOS
+        self._framing.sent(size, start)
+        return Gst.FlowReturn.OK
+
+    def main(self) -> NoReturn:
         """Program entry point"""
 
         import qubesdb  # pylint: disable=import-error
 
+        if os.environ.get("QVC_TRACE") or os.path.exists(tracing.TRACE_FLAG):
+            self._framing.trace = True
+
+        feed = None
+        if fanout.enabled():
+            path = fanout.socket_path(self.video_source(), self.fanout_key())
+            feed, listener = fanout.connect_or_listen(path)
+            if listener is not None:
+                self._fanout = fanout.Distributor(listener,
+                                                  self.on_consumers_gone)
+                atexit.register(os.unlink, path)
+
+        if feed is None:
+            # loading the GStreamer registry and plugins is independent of
+            # everything up to the pipeline creation
+            self._gst_thread = threading.Thread(target=self.init_gstreamer,
+                                                daemon=True)
+            self._gst_thread.start()
+
         target_domain = qubesdb.QubesDB().read("/name")
         if target_domain is None:
             # dom0 doesn't have a /name value in its QubesDB
@@ -162,6 +733,15 @@ class Service:
         self.validate_qube_names(target_domain, remote_domain)
 
         self.start_service(target_domain, remote_domain)
-        self.start_transmission()
+        if feed is None:
+            self.start_transmission()
+        else:
+            self.start_shared_transmission(fanout.Feed(feed))
 
-        Gtk.main()
+        if self._tray_icon is None:
+            self._loop = GLib.MainLoop()
+            self._loop.run()
+        else:
+            # pylint: disable=import-outside-toplevel
+            from gi.repository import Gtk
+            Gtk.main()
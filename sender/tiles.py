@@ -0,0 +1,135 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Tile delta encoder for the screen sharing transport
+
+The payload of every frame starts with a ``=BH`` (kind, tile count) header.
+
+- A keyframe has a tile count of zero and is followed by a complete I420
+  frame in GStreamer's default memory layout.
+- A delta frame is followed by that many tiles.  Each tile starts with a
+  ``=HH`` (column, row) header, in units of TILE_SIZE pixels, and then carries
+  its Y, U and V rows without any padding.  Tiles on the right and bottom
+  edges are clipped to the frame size.
+
+A delta frame without any tiles repeats the previous frame.
+"""
+
+import struct
+from typing import List, Tuple
+
+from i420 import i420_layout
+
+TILE_SIZE = 64
+
+FRAME_KEY = 0
+FRAME_DELTA = 1
+
+frame_header = struct.Struct("=BH")
+tile_header = struct.Struct("=HH")
+
+
+def _fold_lines(band: int, lines: int, stride: int) -> int:
+    """
+    OR the lines of a band together, given as an integer with the first line
+    in its low bits, halving the band on each step
+    """
+    while lines > 1:
+        kept = lines - lines // 2
+        shift = kept * stride * 8
+        band = (band & ((1 << shift) - 1)) | (band >> shift)
+        lines = kept
+    return band
+
+
+# pylint: disable=too-few-public-methods
+class TileEncoder:
+    """Compute tile deltas between consecutive I420 frames"""
+
+    def __init__(self, width: int, height: int, keyframe_interval: int):
+        self.width = width
+        self.height = height
+        self.keyframe_interval = keyframe_interval
+        self.offsets, self.strides, self.frame_size = i420_layout(
+            width, height
+        )
+        self.columns = (width + TILE_SIZE - 1) // TILE_SIZE
+        self.rows = (height + TILE_SIZE - 1) // TILE_SIZE
+        self._previous = None  # type: bytes
+        self._frames_since_keyframe = 0
+
+    def _tile_rect(self, column: int, row: int, plane: int
+                   ) -> Tuple[int, int, int, int]:
+        """Return the (left, top, width, height) of a tile in a plane"""
+        left = column * TILE_SIZE
+        top = row * TILE_SIZE
+        width = min(TILE_SIZE, self.width - left)
+        height = min(TILE_SIZE, self.height - top)
+        if plane == 0:
+            return left, top, width, height
+        return (left // 2, top // 2,
+                (left + width + 1) // 2 - left // 2,
+                (top + height + 1) // 2 - top // 2)
+
+    def _changed_columns(self, frame: bytes, row: int) -> List[int]:
+        """Return the columns of the tiles that changed in a row of tiles"""
+        previous = self._previous
+        changed = set()
+        for plane in range(3):
+            offset, stride = self.offsets[plane], self.strides[plane]
+            _left, top, _width, height = self._tile_rect(0, row, plane)
+            band_start = offset + top * stride
+            band_end = band_start + height * stride
+            if frame[band_start:band_end] == previous[band_start:band_end]:
+                continue
+            # a line with a non-zero byte below every byte that changed in
+            # the band, so that each tile is checked once instead of per line
+            diff = _fold_lines(
+                int.from_bytes(frame[band_start:band_end], "little") ^
+                int.from_bytes(previous[band_start:band_end], "little"),
+                height, stride,
+            ).to_bytes(stride, "little")
+            for column in range(self.columns):
+                left, _top, width, _height = self._tile_rect(column, row,
+                                                             plane)
+                if diff.count(0, left, left + width) != width:
+                    changed.add(column)
+            if len(changed) == self.columns:
+                break
+        return sorted(changed)
+
+    def _tile(self, frame: bytes, column: int, row: int) -> bytearray:
+        """Return the header and the pixels of a single tile"""
+        data = bytearray(tile_header.pack(column, row))
+        for plane in range(3):
+            offset, stride = self.offsets[plane], self.strides[plane]
+            left, top, width, height = self._tile_rect(column, row, plane)
+            for line in range(top, top + height):
+                start = offset + line * stride + left
+                data += frame[start:start + width]
+        return data
+
+    def encode(self, frame: bytes) -> List[bytes]:
+        """Encode a frame, returning the chunks to send to the receiver"""
+        if len(frame) != self.frame_size:
+            raise ValueError(
+                "frame size {} does not match {}x{} I420".format(
+                    len(frame), self.width, self.height
+                )
+            )
+        if (self._previous is None
+                or self._frames_since_keyframe >= self.keyframe_interval):
+            self._previous = frame
+            self._frames_since_keyframe = 0
+            return [frame_header.pack(FRAME_KEY, 0), frame]
+
+        tiles = []
+        for row in range(self.rows):
+            for column in self._changed_columns(frame, row):
+                tiles.append(self._tile(frame, column, row))
+        self._previous = frame
+        self._frames_since_keyframe += 1
+        return [frame_header.pack(FRAME_DELTA, len(tiles)), *tiles]
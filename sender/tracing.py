@@ -0,0 +1,185 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Per-element tracing of the sender pipeline
+
+Pad probes on every element record when each buffer enters and leaves it.
+Their difference is the time spent in the element, which for a queue is the
+time the buffer waited in it.  The intervals between buffers leaving an
+element and the fill level of queues are recorded as well.  A summary line
+per element is printed to standard error, which ends up in the journal, at
+most every SUMMARY_INTERVAL_NS.
+
+Nothing here is used unless tracing is enabled, so a normal stream has no
+probes at all.
+"""
+
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+from gi.repository import Gst  # pylint: disable=no-name-in-module
+
+SUMMARY_INTERVAL_NS = 10 * 1000000000
+
+#: Present when the qvc-trace service is enabled for this qube
+TRACE_FLAG = "/run/qubes-service/qvc-trace"
+
+#: Buffers seen entering an element but not leaving it yet, beyond which the
+#: oldest are forgotten (for elements that drop or merge buffers)
+MAX_PENDING = 64
+
+
+class ElementStats:
+    """What is recorded for one element"""
+
+    def __init__(self, name: str, queue: Optional[Gst.Element] = None):
+        self.name = name
+        self.queue = queue
+        self.pending = {}  # type: Dict[int, int]
+        self.reset()
+
+    def reset(self) -> None:
+        self.frames = 0
+        self.busy = 0
+        self.busy_total = 0
+        self.busy_max = 0
+        self.interval_total = 0
+        self.interval_max = 0
+        self.level_total = 0
+        self.level_max = 0
+        self.last_frame = None
+
+    def entered(self, pts: int, now: int) -> None:
+        if len(self.pending) >= MAX_PENDING:
+            del self.pending[next(iter(self.pending))]
+        self.pending[pts] = now
+
+    def left(self, pts: int, now: int) -> None:
+        self.frames += 1
+        if self.last_frame is not None:
+            interval = now - self.last_frame
+            self.interval_total += interval
+            self.interval_max = max(self.interval_max, interval)
+        self.last_frame = now
+        entered = self.pending.pop(pts, None)
+        if entered is not None:
+            self.busy += 1
+            self.busy_total += now - entered
+            self.busy_max = max(self.busy_max, now - entered)
+        if self.queue is not None:
+            level = self.queue.get_property("current-level-buffers")
+            self.level_total += level
+            self.level_max = max(self.level_max, level)
+
+    def summary(self) -> str:
+        parts = [f"{self.name}: {self.frames} frames"]
+        if self.frames > 1:
+            parts.append("interval avg {:.1f} max {:.1f} ms".format(
+                self.interval_total / (self.frames - 1) / 1e6,
+                self.interval_max / 1e6,
+            ))
+        if self.busy:
+            parts.append("time avg {:.2f} max {:.2f} ms".format(
+                self.busy_total / self.busy / 1e6, self.busy_max / 1e6,
+            ))
+        if self.queue is not None and self.frames:
+            parts.append("level avg {:.1f} max {} buffers".format(
+                self.level_total / self.frames, self.level_max,
+            ))
+        return ", ".join(parts)
+
+
+class PipelineTracer:
+    """Attach probes to the elements of a pipeline and print summaries"""
+
+    def __init__(self, pipeline: Optional[Gst.Bin] = None):
+        self._lock = threading.Lock()
+        self._stats = []
+        self._by_name = {}  # type: Dict[str, ElementStats]
+        self._last_summary = time.monotonic_ns()
+        if pipeline is None:
+            return
+        elements = []
+        iterator = pipeline.iterate_sorted()
+        while True:
+            result, element = iterator.next()
+            if result != Gst.IteratorResult.OK:
+                break
+            elements.append(element)
+        # iterate_sorted() starts from the sinks
+        for element in reversed(elements):
+            self._attach(element)
+
+    @staticmethod
+    def _pads(iterator: Gst.Iterator):
+        pads = []
+        while True:
+            result, pad = iterator.next()
+            if result != Gst.IteratorResult.OK:
+                return pads
+            pads.append(pad)
+
+    def _attach(self, element: Gst.Element) -> None:
+        factory = element.get_factory()
+        queue = element if factory and factory.get_name() == "queue" \
+            else None
+        stats = self.stats(element.get_name(), queue)
+        sink_pads = self._pads(element.iterate_sink_pads())
+        src_pads = self._pads(element.iterate_src_pads())
+        if src_pads:
+            for pad in sink_pads:
+                pad.add_probe(Gst.PadProbeType.BUFFER, self._on_enter, stats)
+            for pad in src_pads:
+                pad.add_probe(Gst.PadProbeType.BUFFER, self._on_leave, stats)
+        else:
+            # a sink: buffers only arrive, the time spent writing them is
+            # recorded by whoever writes them
+            for pad in sink_pads:
+                pad.add_probe(Gst.PadProbeType.BUFFER, self._on_leave, stats)
+
+    def stats(self, name: str,
+              queue: Optional[Gst.Element] = None) -> ElementStats:
+        """Return the statistics of an element or of another stage"""
+        with self._lock:
+            if name not in self._by_name:
+                self._by_name[name] = ElementStats(name, queue)
+                self._stats.append(self._by_name[name])
+            return self._by_name[name]
+
+    def _on_enter(self, _pad: Gst.Pad, info: Gst.PadProbeInfo,
+                  stats: ElementStats) -> Gst.PadProbeReturn:
+        with self._lock:
+            stats.entered(info.get_buffer().pts, time.monotonic_ns())
+        return Gst.PadProbeReturn.OK
+
+    def _on_leave(self, _pad: Gst.Pad, info: Gst.PadProbeInfo,
+                  stats: ElementStats) -> Gst.PadProbeReturn:
+        now = time.monotonic_ns()
+        with self._lock:
+            stats.left(info.get_buffer().pts, now)
+        self.maybe_summarize(now)
+        return Gst.PadProbeReturn.OK
+
+    def record(self, name: str, start: int, end: int) -> None:
+        """Record a stage outside of GStreamer, such as writing a frame"""
+        stats = self.stats(name)
+        with self._lock:
+            stats.entered(start, start)
+            stats.left(start, end)
+        self.maybe_summarize(end)
+
+    def maybe_summarize(self, now: int) -> None:
+        with self._lock:
+            if now - self._last_summary < SUMMARY_INTERVAL_NS:
+                return
+            self._last_summary = now
+            lines = [stats.summary() for stats in self._stats]
+            for stats in self._stats:
+                stats.reset()
+        for line in lines:
+            print("Trace:", line, file=sys.stderr)
@@ -13,7 +13,7 @@
 
 import signal
 import sys
-from typing import NoReturn
+from typing import Callable, NoReturn, Optional
 
 import gi
 
@@ -36,8 +36,12 @@ except (ImportError, ValueError):
 class TrayIcon:
     """Tray icon user interface component"""
 
-    def __init__(self, app, icon_name, msg):
-        """Create tray icon"""
+    def __init__(self, app, icon_name, msg,
+                 on_stop: Optional[Callable[[], object]] = None):
+        """
+        Create tray icon; on_stop is called instead of exiting when the
+        user stops the video transmission
+        """
         self.icon_name = icon_name
         self.indicator = AppIndicator.Indicator.new(
             app,
@@ -45,10 +49,9 @@ class TrayIcon:
             AppIndicator.IndicatorCategory.APPLICATION_STATUS,
         )
         self.indicator.set_status(AppIndicator.IndicatorStatus.ACTIVE)
-        self.indicator.set_menu(self.menu(msg, app))
+        self.indicator.set_menu(self.menu(msg, app, on_stop))
 
-    @classmethod
-    def menu(cls, msg, app) -> object:
+    def menu(self, msg, app, on_stop=None) -> object:
         """Create tray icon menu"""
 
         # pylint: disable=line-too-long
@@ -79,8 +82,12 @@ class TrayIcon:
             # that for us.  We *do* care about exiting ASAP.
             sys.exit(0)
 
+        def stop(unused_gtk) -> None:
+            self.indicator.set_status(AppIndicator.IndicatorStatus.PASSIVE)
+            on_stop()
+
         entry = Gtk.MenuItem.new_with_label("Stop video transmission")
-        entry.connect("activate", die)
+        entry.connect("activate", die if on_stop is None else stop)
         menu.connect("destroy", die)
         signal.signal(signal.SIGTERM, lambda *_args: die(None))
         menu.append(entry)
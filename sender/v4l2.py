@@ -0,0 +1,288 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Enumerate the formats of a V4L2 capture device with ioctls"""
+
+import argparse
+import errno
+import fcntl
+import json
+import os
+import struct
+from fractions import Fraction
+from typing import Callable, List, NamedTuple
+
+# see videodev2.h:
+#    struct v4l2_fmtdesc {
+#        __u32 index;
+#        __u32 type;
+#        __u32 flags;
+#        __u8 description[32];
+#        __u32 pixelformat;
+#        __u32 mbus_code;
+#        __u32 reserved[3];
+#    };
+v4l2_fmtdesc = struct.Struct("=III32sII12x")
+#    struct v4l2_frmsizeenum {
+#        __u32 index;
+#        __u32 pixel_format;
+#        __u32 type;
+#        union {
+#            struct v4l2_frmsize_discrete discrete;  /* width, height */
+#            struct v4l2_frmsize_stepwise stepwise;  /* min_width, max_width,
+#                                                       step_width,
+#                                                       min_height,
+#                                                       max_height,
+#                                                       step_height */
+#        };
+#        __u32 reserved[2];
+#    };
+v4l2_frmsizeenum = struct.Struct("=IIIIIIIII8x")
+#    struct v4l2_frmivalenum {
+#        __u32 index;
+#        __u32 pixel_format;
+#        __u32 width;
+#        __u32 height;
+#        __u32 type;
+#        union {
+#            struct v4l2_fract discrete;  /* numerator, denominator */
+#            struct v4l2_frmival_stepwise stepwise;  /* min, max, step */
+#        };
+#        __u32 reserved[2];
+#    };
+v4l2_frmivalenum = struct.Struct("=IIIIIIIIIII8x")
+
+
+def _iowr(number: int, size: int) -> int:
+    return (3 << 30) | (size << 16) | (ord("V") << 8) | number
+
+
+VIDIOC_ENUM_FMT = _iowr(2, v4l2_fmtdesc.size)
+VIDIOC_ENUM_FRAMESIZES = _iowr(74, v4l2_frmsizeenum.size)
+VIDIOC_ENUM_FRAMEINTERVALS = _iowr(75, v4l2_frmivalenum.size)
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_FMT_FLAG_COMPRESSED = 0x1
+V4L2_FRMSIZE_TYPE_DISCRETE = 1
+V4L2_FRMIVAL_TYPE_DISCRETE = 1
+
+
+class FrameFormat(NamedTuple):
+    """A single capture format of a device"""
+    pixelformat: str
+    compressed: bool
+    width: int
+    height: int
+    fps: Fraction
+
+
+Ioctl = Callable[[int, int, bytes], bytes]
+
+
+def _enumerate(ioctl: Ioctl, fd: int, request: int, sstruct: struct.Struct,
+               *fields) -> List[tuple]:
+    """
+    Call an enumeration ioctl with increasing indexes until EINVAL; fields
+    are the values of the struct members following the index
+    """
+    results = []
+    index = 0
+    while True:
+        arg = sstruct.pack(index, *fields)
+        try:
+            results.append(sstruct.unpack(ioctl(fd, request, arg)))
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                return results
+            raise
+        index += 1
+
+
+def _fourcc(pixelformat: int) -> str:
+    return pixelformat.to_bytes(4, "little").decode("ascii", "replace")
+
+
+def _sizes(ioctl: Ioctl, fd: int, pixelformat: int) -> List[tuple]:
+    sizes = []
+    for (_index, _fmt, size_type, *size) in _enumerate(
+            ioctl, fd, VIDIOC_ENUM_FRAMESIZES, v4l2_frmsizeenum,
+            pixelformat, *(0,) * 7):
+        if size_type == V4L2_FRMSIZE_TYPE_DISCRETE:
+            sizes.append((size[0], size[1]))
+        else:
+            # stepwise and continuous ranges are reported once; offer their
+            # extremes
+            (min_width, max_width, _step_width,
+             min_height, max_height, _step_height) = size
+            sizes.append((min_width, min_height))
+            sizes.append((max_width, max_height))
+            break
+    return sizes
+
+
+def _rates(ioctl: Ioctl, fd: int, pixelformat: int,
+           width: int, height: int) -> List[Fraction]:
+    rates = []
+    for (_index, _fmt, _width, _height, interval_type, *interval) in \
+            _enumerate(ioctl, fd, VIDIOC_ENUM_FRAMEINTERVALS,
+                       v4l2_frmivalenum, pixelformat, width, height,
+                       *(0,) * 7):
+        if interval_type == V4L2_FRMIVAL_TYPE_DISCRETE:
+            intervals = [interval[0:2]]
+        else:
+            # the shortest and the longest interval of the range
+            intervals = [interval[0:2], interval[2:4]]
+        for numerator, denominator in intervals:
+            if numerator and denominator:
+                # an interval is the time per frame, fps is its inverse
+                rates.append(Fraction(denominator, numerator))
+        if interval_type != V4L2_FRMIVAL_TYPE_DISCRETE:
+            break
+    return rates
+
+
+def enumerate_formats(fd: int, ioctl: Ioctl = fcntl.ioctl
+                      ) -> List[FrameFormat]:
+    """
+    Return every (pixel format, size, frame rate) combination supported by
+    the capture device open as fd
+
+    ioctl can be replaced to replay recorded device responses.
+    """
+    formats = []
+    for (_index, _type, flags, _description, pixelformat, _mbus) in \
+            _enumerate(ioctl, fd, VIDIOC_ENUM_FMT, v4l2_fmtdesc,
+                       V4L2_BUF_TYPE_VIDEO_CAPTURE, 0, b"", 0, 0):
+        for width, height in _sizes(ioctl, fd, pixelformat):
+            for fps in _rates(ioctl, fd, pixelformat, width, height):
+                formats.append(FrameFormat(
+                    _fourcc(pixelformat),
+                    bool(flags & V4L2_FMT_FLAG_COMPRESSED),
+                    width,
+                    height,
+                    fps,
+                ))
+    return formats
+
+
+def format_to_str(fmt: FrameFormat) -> str:
+    """Serialize a format for storing it in QubesDB"""
+    # the pixel format goes last, as some FourCCs contain spaces
+    return "{}x{} {} {:d} {}".format(fmt.width, fmt.height, fmt.fps,
+                                     fmt.compressed, fmt.pixelformat)
+
+
+def format_from_str(value: str) -> FrameFormat:
+    """Parse a format serialized by format_to_str(), raise ValueError"""
+    size, fps, compressed, pixelformat = value.split(" ", 3)
+    width, height = size.split("x")
+    if compressed not in ("0", "1") or len(pixelformat) != 4:
+        raise ValueError("invalid format: " + value)
+    return FrameFormat(pixelformat, compressed == "1", int(width),
+                       int(height), Fraction(fps))
+
+
+def device_generation(device: str) -> str:
+    """
+    Return a marker that changes whenever another device appears behind a
+    device node, so that formats recorded for an unplugged camera are not
+    used for another
+
+    It is made of the device number, the sysfs path of the device and, for
+    USB devices, the USB device number, which changes on every plug.  Unlike
+    the times of the device node, none of these change with its permissions.
+    """
+    rdev = os.stat(device).st_rdev
+    sysfs_path = os.path.realpath(
+        f"/sys/dev/char/{os.major(rdev)}:{os.minor(rdev)}"
+    )
+    path = sysfs_path
+    while path.startswith("/sys/devices/"):
+        try:
+            with open(os.path.join(path, "devnum"), encoding="ascii") \
+                    as devnum_file:
+                devnum = devnum_file.read().strip()
+        except FileNotFoundError:
+            path = os.path.dirname(path)
+            continue
+        return f"{rdev:x}-{sysfs_path}-{devnum}"
+    return f"{rdev:x}-{sysfs_path}"
+
+
+def list_formats(device: str, ioctl: Ioctl = fcntl.ioctl
+                 ) -> List[FrameFormat]:
+    """Return the formats supported by the capture device at a path"""
+    fd = os.open(device, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        return enumerate_formats(fd, ioctl)
+    finally:
+        os.close(fd)
+
+
+# pylint: disable=too-few-public-methods
+class IoctlRecorder:
+    """Record the ioctl exchanges with a device, for replaying them later"""
+
+    def __init__(self, ioctl: Ioctl = fcntl.ioctl):
+        self.exchanges = []
+        self._ioctl = ioctl
+
+    def __call__(self, fd: int, request: int, arg: bytes) -> bytes:
+        try:
+            result = self._ioctl(fd, request, arg)
+        except OSError as e:
+            self.exchanges.append([request, arg.hex(), None, e.errno])
+            raise
+        self.exchanges.append([request, arg.hex(), result.hex(), 0])
+        return result
+
+
+# pylint: disable=too-few-public-methods
+class IoctlReplayer:
+    """Answer ioctls from exchanges recorded by IoctlRecorder"""
+
+    def __init__(self, exchanges: list):
+        self.responses = {
+            (request, arg): (result, error)
+            for request, arg, result, error in exchanges
+        }
+
+    def __call__(self, _fd: int, request: int, arg: bytes) -> bytes:
+        result, error = self.responses.get((request, arg.hex()),
+                                           (None, errno.EINVAL))
+        if error:
+            raise OSError(error, os.strerror(error))
+        return bytes.fromhex(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="List the formats of a V4L2 capture device")
+    parser.add_argument("--device", default="/dev/video0",
+                        help="/dev/video* device path")
+    parser.add_argument("--record", metavar="FILE",
+                        help="save the ioctl exchanges to FILE")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="answer ioctls from FILE instead of a device")
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay, encoding="ascii") as fixture:
+            formats = enumerate_formats(-1, IoctlReplayer(json.load(fixture)))
+    elif args.record:
+        recorder = IoctlRecorder()
+        formats = list_formats(args.device, recorder)
+        with open(args.record, "w", encoding="ascii") as fixture:
+            json.dump(recorder.exchanges, fixture, indent=1)
+    else:
+        formats = list_formats(args.device)
+
+    for fmt in formats:
+        print(f"{fmt.pixelformat} {fmt.width}x{fmt.height} {fmt.fps} fps")
+
+
+if __name__ == "__main__":
+    main()
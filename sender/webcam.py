@@ -8,23 +8,32 @@
 
 import atexit
 import os
-import sys
 import re
-import subprocess
+import sys
+from typing import List, Optional
 from service import Service
+import fanout
 import qubesdb
+import v4l2
+
+
+#: /dev/video* devices, as published by the udev handler; at most 12
+#: characters for dom0
+port_re = re.compile(r"\Adev-video(0|[1-9][0-9]{0,2})\Z")
+
+#: Raw V4L2 pixel formats that can be sent without conversion, with their
+#: GStreamer names
+PASSTHROUGH_FORMATS = {"YUYV": "YUY2", "NV12": "NV12"}
 
 
 class Webcam(Service):
     """Webcam video source class"""
 
-    untrusted_requested_width: int
-    untrusted_requested_height: int
-    untrusted_requested_fps: int
-
     def __init__(self, *, untrusted_arg: str):
+        super().__init__()
         self.port_id = "dev-video0"
 
+        untrusted_arg = self.parse_protocol_options(untrusted_arg)
         if untrusted_arg:
             if untrusted_arg.startswith("dev-"):
                 # first arg may be a port id, and then optional resolution arg
@@ -35,45 +44,29 @@ class Webcam(Service):
                 else:
                     untrusted_port_id, untrusted_arg = untrusted_arg, None
 
-                # currently support only a single port: "dev-video0"
-                if untrusted_port_id != "dev-video0":
-                    print(f"Unsupported webcam port ({untrusted_port_id}), "
-                           "only 'dev-video0' supported", file=sys.stderr)
-                self.port_id = untrusted_port_id
-
-        if untrusted_arg:
-            def parse_int(untrusted_decimal: bytes) -> int:
-                if not ((1 <= len(untrusted_decimal) <= 4) and
-                        untrusted_decimal.isdigit() and
-                        untrusted_decimal[0] != "0"):
-                    print("Invalid argument " + untrusted_arg + ": bad number",
+                if not port_re.match(untrusted_port_id):
+                    print(f"Unsupported webcam port ({untrusted_port_id})",
                           file=sys.stderr)
                     sys.exit(1)
-                return int(untrusted_decimal, 10)
-            if len(untrusted_arg) > 14:
-                # qrexec has already sanitized the argument to some degree,
-                # so this is safe
-                print("Invalid argument " + untrusted_arg +
-                      ": too long (limit 14 bytes)", file=sys.stderr)
-                sys.exit(1)
-            arg_list = untrusted_arg.split("+", 4)
-            if len(arg_list) != 3:
-                print("Invalid argument " + untrusted_arg +
-                      ": wrong number of integers (expected 3)",
-                      file=sys.stderr)
-                sys.exit(1)
-            ( self.untrusted_requested_width
-            , self.untrusted_requested_height
-            , self.untrusted_requested_fps
-            ) = map(parse_int, arg_list)
-        else:
-            self.untrusted_requested_width = 0
-            self.untrusted_requested_height = 0
-            self.untrusted_requested_fps = 0
+                # other video devices, such as metadata nodes or loopback
+                # devices of streams received by this qube, are not published
+                if untrusted_port_id != "dev-video0" and \
+                        qubesdb.QubesDB().read(
+                            f"/webcam-devices/{untrusted_port_id}/connected-to"
+                        ) is None:
+                    print(f"Webcam port {untrusted_port_id} is not published",
+                          file=sys.stderr)
+                    sys.exit(1)
+                self.port_id = untrusted_port_id
+                del untrusted_port_id
+        self.device = "/dev/" + self.port_id[len("dev-"):]
+
+        self.parse_requested_format(untrusted_arg)
 
         self.pidfile = None
+        self.remote_domain = None
 
-        Service.main(self)
+        self.main()
 
     def video_source(self) -> str:
         return "webcam"
@@ -81,66 +74,88 @@ class Webcam(Service):
     def icon(self) -> str:
         return "camera-web"
 
+    def fanout_key(self) -> str:
+        return self.port_id
+
+    def preload_elements(self):
+        return super().preload_elements() + ["v4l2src", "jpegdec",
+                                             "videoflip"]
+
+    def cached_formats(self) -> Optional[List[v4l2.FrameFormat]]:
+        """
+        Return the formats published by the udev handler, or None if they
+        are missing or were recorded for an earlier instance of the device
+        """
+        qdb = qubesdb.QubesDB()
+        prefix = f"/webcam-devices/{self.port_id}"
+        generation = qdb.read(prefix + "/generation")
+        try:
+            if (not generation or generation.decode("ascii") !=
+                    v4l2.device_generation(self.device)):
+                return None
+            entries = qdb.multiread(prefix + "/capture-formats/")
+            formats = [v4l2.format_from_str(entries[key].decode("ascii"))
+                       for key in sorted(entries)]
+        except (OSError, ValueError, qubesdb.Error) as e:
+            print(f"Ignoring published formats: {e}", file=sys.stderr)
+            return None
+        return formats or None
+
     def parameters(self):
-        mjpeg_re = re.compile(
-            rb"\t\[[0-9]+]: 'MJPG' \(Motion-JPEG, compressed\)\Z"
-        )
-        fmt_re = re.compile(rb"\t\[[0-9]+]: ")
-        dimensions_re = re.compile(rb"\t\tSize: Discrete [0-9]+x[0-9]+\Z")
-        interval_re = re.compile(
-            rb"\t\t\tInterval: Discrete [0-9.]+s \([0-9]+\.0+ fps\)\Z"
-        )
-        frac_interval_re = re.compile(
-            rb"\t\t\tInterval: Discrete [0-9.]+s \([0-9]+\.0*[1-9][0-9]* "\
-            rb"fps\)\Z"
-        )
-        proc = subprocess.run(
-            ("v4l2-ctl", "--list-formats-ext"),
-            stdout=subprocess.PIPE,
-            check=True,
-            env={"PATH": "/bin:/usr/bin", "LC_ALL": "C"},
-        )
         formats = []
-        for i in proc.stdout.split(b"\n"):
-            if mjpeg_re.match(i):
-                fmt = "image/jpeg"
-            elif fmt_re.match(i):
-                # try raw, if it doesn't match, gstreamer will tell you
-                fmt = "video/x-raw"
-            elif dimensions_re.match(i):
-                width, height = map(int, i[17:].split(b"x"))
-            elif interval_re.match(i):
-                fps = int(i[22:].split(b"(", 1)[1].split(b".", 1)[0])
-                formats.append((width, height, fps, {"fmt": fmt}))
-            elif frac_interval_re.match(i):
-                # factional FPS not supported
-                continue
-            elif i in (
-                b"",
-                b"ioctl: VIDIOC_ENUM_FMT",
-                b"\tType: Video Capture",
-            ):
+        supported = self.cached_formats()
+        if supported is None:
+            supported = v4l2.list_formats(self.device)
+        # a format change carries no pixel format, so once the stream runs
+        # the receiver keeps expecting the one it started with
+        renegotiating = self._framing.format is not None
+        accepted = ({self.pixel_format} if renegotiating
+                    else self.accepted_pixel_formats)
+        for fmt in supported:
+            if fmt.pixelformat == "MJPG":
+                caps = "image/jpeg"
+            elif fmt.compressed:
+                # only Motion-JPEG can be decoded
                 continue
             else:
-                print("Cannot parse output %r of v4l2ctl" % i, file=sys.stderr)
+                # try raw, if it doesn't match, gstreamer will tell you
+                caps = "video/x-raw"
+            kwargs = {"fmt": caps}
+            passthrough = PASSTHROUGH_FORMATS.get(fmt.pixelformat)
+            # a shared capture is converted to I420 for every receiver
+            if passthrough in accepted and not self.shares_capture:
+                kwargs["format"] = passthrough
+            if renegotiating and \
+                    kwargs.get("format", "I420") != self.pixel_format:
+                continue
+            formats.append((fmt.width, fmt.height, fmt.fps, kwargs))
+        # among equal formats, prefer one that needs no conversion
+        formats.sort(key=lambda x: "format" not in x[3])
         formats.sort(key=lambda x: x[0] * x[1] * x[2], reverse=True)
         if self.untrusted_requested_fps:
             formats.sort(key=lambda x:
                          (x[0] - self.untrusted_requested_width) ** 2 +
                          (x[1] - self.untrusted_requested_height) ** 2 +
                          (x[2] - self.untrusted_requested_fps) ** 2)
-        return formats[0]
+        width, height, fps, kwargs = formats[0]
+        # the exact rate is needed to negotiate with the camera, while the
+        # receiver only needs an approximate one
+        kwargs["framerate"] = "{}/{}".format(fps.numerator, fps.denominator)
+        self.pixel_format = kwargs.get("format", "I420")
+        return width, height, max(round(fps), 1), kwargs
 
     def pipeline(self, width: int, height: int, fps: int, **kwargs):
         fmt = kwargs.get("fmt", "image/jpeg")
+        pixel_format = kwargs.get("format", "I420")
+        framerate = kwargs.get("framerate", "{}/1".format(fps))
         caps = (
             "width={0},"
             "height={1},"
-            "framerate={2}/1,"
+            "framerate={2},"
             "interlace-mode=progressive,"
             "pixel-aspect-ratio=1/1,"
-            "max-framerate={2}/1,"
-            "views=1".format(width, height, fps)
+            "max-framerate={2},"
+            "views=1".format(width, height, framerate)
         )
         if "jpeg" in fmt:
             convert = (
@@ -151,6 +166,13 @@ class Webcam(Service):
                 "!",
                 "jpegdec",
             )
+        elif pixel_format != "I420":
+            # the receiver takes the format of the camera as it is
+            convert = (
+                    "!",
+                    # no-op filter that discards padding, see below
+                    "videoflip",
+                    )
         else:
             convert = (
                     "!",
@@ -165,32 +187,57 @@ class Webcam(Service):
                     )
         return [
             "v4l2src",
+            "device=" + self.device,
             "!",
-            "queue",
+            *self.queue(),
             *convert,
             "!",
             "capsfilter",
-            "caps=video/x-raw,format=I420," + caps,
+            "caps=video/x-raw,format={},".format(pixel_format) + caps,
             "!",
-            "fdsink",
+            *self.sink(),
         ]
 
-    def _cleanup_connect_state(self):
-        qdb = qubesdb.QubesDB()
-        qdb.write(f"/webcam-devices/{self.port_id}/connected-to", "")
-        qdb.write("/webcam-devices", "")
+    def _update_connected_to(self, add: Optional[str] = None,
+                             remove: Optional[str] = None) -> None:
+        """
+        Update the space-separated list of qubes the device is streamed to;
+        with a shared capture there may be more than one
+        """
+        path = f"/webcam-devices/{self.port_id}/connected-to"
+        with fanout.locked(f"/run/qubes/qvc-webcam-{self.port_id}"):
+            qdb = qubesdb.QubesDB()
+            connected_to = (qdb.read(path) or b"").decode("ascii").split()
+            if remove in connected_to:
+                connected_to.remove(remove)
+            if add is not None:
+                connected_to.append(add)
+            qdb.write(path, " ".join(connected_to))
+            qdb.write("/webcam-devices", "")
+
+    def release_connect_state(self) -> None:
+        if self.remote_domain is None:
+            return
+        self._update_connected_to(remove=self.remote_domain)
+        self.remote_domain = None
         if self.pidfile:
-            os.unlink(self.pidfile)
+            try:
+                os.unlink(self.pidfile)
+            except FileNotFoundError:
+                # removed by qvc.WebcamDetach
+                pass
+            self.pidfile = None
 
     def record_connect_state(self, remote_domain) -> None:
-        self.pidfile = f"/run/qubes/qvc-webcam-{self.port_id}"
+        # one pidfile per stream, so that qvc.WebcamDetach can stop the
+        # stream of one qube
+        self.pidfile = f"/run/qubes/qvc-webcam-{self.port_id}+{remote_domain}"
         with open(self.pidfile, "w", encoding="ascii") as f_pid:
             f_pid.write(f"{os.getpid()}\n")
 
-        qdb = qubesdb.QubesDB()
-        qdb.write(f"/webcam-devices/{self.port_id}/connected-to", remote_domain)
-        qdb.write("/webcam-devices", "")
-        atexit.register(self._cleanup_connect_state)
+        self.remote_domain = remote_domain
+        self._update_connected_to(add=remote_domain)
+        atexit.register(self.release_connect_state)
 
 
 if __name__ == "__main__":
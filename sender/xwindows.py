@@ -0,0 +1,178 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""List the top-level windows of the X server and query their geometry
+
+Qubes runs no window manager inside a qube, so the windows of applications
+are direct children of the root window, and neither _NET_CLIENT_LIST nor
+GDK's window stack lists them.  Xlib is called directly instead.
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+from typing import List, NamedTuple, Optional
+
+IS_VIEWABLE = 2
+INPUT_OUTPUT = 1
+
+
+class XWindowAttributes(ctypes.Structure):
+    # pylint: disable=too-few-public-methods
+    _fields_ = [
+        ("x", ctypes.c_int),
+        ("y", ctypes.c_int),
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("border_width", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("visual", ctypes.c_void_p),
+        ("root", ctypes.c_ulong),
+        ("c_class", ctypes.c_int),
+        ("bit_gravity", ctypes.c_int),
+        ("win_gravity", ctypes.c_int),
+        ("backing_store", ctypes.c_int),
+        ("backing_planes", ctypes.c_ulong),
+        ("backing_pixel", ctypes.c_ulong),
+        ("save_under", ctypes.c_int),
+        ("colormap", ctypes.c_ulong),
+        ("map_installed", ctypes.c_int),
+        ("map_state", ctypes.c_int),
+        ("all_event_masks", ctypes.c_long),
+        ("your_event_mask", ctypes.c_long),
+        ("do_not_propagate_mask", ctypes.c_long),
+        ("override_redirect", ctypes.c_int),
+        ("screen", ctypes.c_void_p),
+    ]
+
+
+class Window(NamedTuple):
+    """A top-level window, with its position relative to the root window"""
+
+    xid: int
+    name: str
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_void_p)
+
+
+@_ERROR_HANDLER
+def _ignore_error(_display, _event) -> int:
+    return 0
+
+
+class Display:
+    """A connection to the X server named by $DISPLAY"""
+
+    def __init__(self):
+        xlib = self._xlib = ctypes.CDLL(ctypes.util.find_library("X11"))
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XQueryTree.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong,
+            ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_ulong),
+            ctypes.POINTER(ctypes.POINTER(ctypes.c_ulong)),
+            ctypes.POINTER(ctypes.c_uint),
+        ]
+        xlib.XGetWindowAttributes.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong,
+            ctypes.POINTER(XWindowAttributes),
+        ]
+        xlib.XFetchName.argtypes = [ctypes.c_void_p, ctypes.c_ulong,
+                                    ctypes.POINTER(ctypes.c_char_p)]
+        xlib.XFree.argtypes = [ctypes.c_void_p]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XSetErrorHandler.argtypes = [_ERROR_HANDLER]
+        xlib.XSetErrorHandler.restype = _ERROR_HANDLER
+        self._display = xlib.XOpenDisplay(None)
+        if not self._display:
+            raise OSError("Cannot open the X display")
+        self._root = xlib.XDefaultRootWindow(self._display)
+
+    @contextlib.contextmanager
+    def _ignoring_errors(self):
+        """
+        Ignore the X errors of the requests made in the block
+
+        Windows may be destroyed at any time, which would otherwise make the
+        default error handler exit the process.  The error handler is global
+        to the process, so GDK's own is restored once the errors of these
+        requests have been received.
+        """
+        self._xlib.XSync(self._display, False)
+        previous = self._xlib.XSetErrorHandler(_ignore_error)
+        try:
+            yield
+        finally:
+            self._xlib.XSync(self._display, False)
+            self._xlib.XSetErrorHandler(previous)
+
+    def _attributes(self, xid: int) -> Optional[XWindowAttributes]:
+        attributes = XWindowAttributes()
+        if not self._xlib.XGetWindowAttributes(self._display, xid,
+                                               ctypes.byref(attributes)):
+            return None
+        return attributes
+
+    def _name(self, xid: int) -> Optional[str]:
+        name = ctypes.c_char_p()
+        if not self._xlib.XFetchName(self._display, xid, ctypes.byref(name)) \
+                or not name.value:
+            return None
+        try:
+            return name.value.decode("utf-8", "replace")
+        finally:
+            self._xlib.XFree(name)
+
+    def windows(self) -> List[Window]:
+        """Return the visible, named top-level windows, topmost first"""
+        with self._ignoring_errors():
+            windows = []
+            # XQueryTree() lists the children from bottom to top
+            for xid in reversed(self._children()):
+                attributes = self._attributes(xid)
+                if attributes is None or attributes.map_state != IS_VIEWABLE \
+                        or attributes.c_class != INPUT_OUTPUT \
+                        or attributes.override_redirect:
+                    # hidden windows, menus and tooltips
+                    continue
+                name = self._name(xid)
+                if name is None:
+                    continue
+                windows.append(Window(xid, name, attributes.x, attributes.y,
+                                      attributes.width, attributes.height))
+        return windows
+
+    def _children(self) -> List[int]:
+        root = ctypes.c_ulong()
+        parent = ctypes.c_ulong()
+        children = ctypes.POINTER(ctypes.c_ulong)()
+        count = ctypes.c_uint()
+        if not self._xlib.XQueryTree(self._display, self._root,
+                                     ctypes.byref(root), ctypes.byref(parent),
+                                     ctypes.byref(children),
+                                     ctypes.byref(count)):
+            return []
+        try:
+            return children[:count.value]
+        finally:
+            if children:
+                self._xlib.XFree(children)
+
+    def window_size(self, xid: int) -> Optional[tuple]:
+        """Return the (width, height) of a window, None if it is gone"""
+        with self._ignoring_errors():
+            attributes = self._attributes(xid)
+        if attributes is None or attributes.map_state != IS_VIEWABLE:
+            return None
+        return attributes.width, attributes.height
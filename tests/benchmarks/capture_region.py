@@ -0,0 +1,209 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""
+Measure the cost of capturing one monitor of a multi-monitor desktop
+
+For every monitor count, Xvfb runs a desktop of that many monitors side by
+side, and the real ScreenShare pipeline shares the first of them, with
+fakesink in place of the sink to the receiver.  The "region" mode is the
+pipeline as it is, which only reads the monitor from the X server.  The
+"crop" mode captures the whole root window and crops it with videocrop, as
+earlier versions did, for reference.
+
+The CPU time used by the capture process and by the X server is reported per
+frame.  For the region mode it should stay the same as monitors are added,
+while for the crop mode it grows with the size of the desktop:
+
+    python3 tests/benchmarks/capture_region.py --monitor 1920x1080x30
+
+Xvfb and GStreamer are needed, no real display.
+"""
+
+# pylint: disable=import-outside-toplevel
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from harness import parse_size, use_sender
+
+MODES = ("region", "crop")
+MONITORS = (1, 2, 3)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def cpu_seconds(pid: int) -> float:
+    """Return the CPU time used by all threads of a process"""
+    with open(f"/proc/{pid}/stat", encoding="ascii") as stat:
+        # the command name may contain spaces, skip past it
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def run_capture(args) -> None:
+    """Capture the first monitor, print the measurements as JSON"""
+    use_sender()
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import Gst
+    from screenshare import ScreenShare
+
+    class BenchmarkScreenShare(ScreenShare):
+        """ScreenShare that is not started as a service"""
+
+        def __init__(self):  # pylint: disable=super-init-not-called
+            pass
+
+        def sink(self):
+            return ["fakesink", "name=sink", "signal-handoffs=true",
+                    "sync=false"]
+
+    width, height, fps = args.monitor
+    elements = BenchmarkScreenShare().pipeline(
+        width, height, fps, capture_x=0, capture_y=0,
+        capture_width=width, capture_height=height,
+    )
+    if args.mode == "crop":
+        source_end = elements.index("!")
+        elements[:source_end] = ["ximagesrc", "use-damage=false"]
+        crop_end = elements.index("capsfilter")
+        elements[crop_end:crop_end] = [
+            "videocrop", "top=0", "left=0",
+            "right=" + str(width * (args.monitors - 1)), "bottom=0", "!",
+        ]
+
+    Gst.init(None)
+    element = Gst.parse_launchv(elements)
+    counter = {"frames": 0}
+    window = {}
+
+    def on_handoff(*_args):
+        counter["frames"] += 1
+        if counter["frames"] == args.warmup:
+            window["start"] = (time.monotonic(), resource.getrusage(
+                resource.RUSAGE_SELF), cpu_seconds(args.server_pid))
+        elif counter["frames"] == args.warmup + args.frames:
+            window["end"] = (time.monotonic(), resource.getrusage(
+                resource.RUSAGE_SELF), cpu_seconds(args.server_pid))
+            element.post_message(Gst.Message.new_eos(element))
+
+    element.get_by_name("sink").connect("handoff", on_handoff)
+    element.set_state(Gst.State.PLAYING)
+    msg = element.get_bus().timed_pop_filtered(
+        Gst.CLOCK_TIME_NONE,
+        Gst.MessageType.EOS | Gst.MessageType.ERROR,
+    )
+    element.set_state(Gst.State.NULL)
+    if msg.type == Gst.MessageType.ERROR:
+        print(msg.parse_error()[0].message, file=sys.stderr)
+        sys.exit(1)
+    (start, start_usage, start_server), (end, end_usage, end_server) = \
+        window["start"], window["end"]
+    capture_cpu = (end_usage.ru_utime - start_usage.ru_utime +
+                   end_usage.ru_stime - start_usage.ru_stime)
+    json.dump({
+        "fps": round(args.frames / (end - start), 1),
+        "capture_cpu_ms_per_frame":
+            round(capture_cpu * 1000 / args.frames, 3),
+        "server_cpu_ms_per_frame":
+            round((end_server - start_server) * 1000 / args.frames, 3),
+    }, sys.stdout)
+
+
+def start_server(width: int, height: int) -> (subprocess.Popen, str):
+    """Start Xvfb with a screen of the given size, return it and its display"""
+    read_fd, write_fd = os.pipe()
+    # pylint: disable=consider-using-with
+    server = subprocess.Popen(
+        ["Xvfb", "-displayfd", str(write_fd), "-nolisten", "tcp",
+         "-screen", "0", f"{width}x{height}x24"],
+        pass_fds=(write_fd,), stderr=subprocess.DEVNULL,
+    )
+    os.close(write_fd)
+    with os.fdopen(read_fd, encoding="ascii") as displayfd:
+        display = displayfd.readline().strip()
+    if not display:
+        server.wait()
+        raise RuntimeError(f"Xvfb exited with {server.returncode}")
+    return server, ":" + display
+
+
+def measure(args, monitors: int, mode: str) -> dict:
+    width, height, fps = args.monitor
+    config = {"monitors": monitors, "mode": mode,
+              "desktop_width": width * monitors, "desktop_height": height}
+    server, display = start_server(width * monitors, height)
+    try:
+        capture = subprocess.run(
+            [sys.executable, __file__, "--capture", "--mode", mode,
+             "--monitor", f"{width}x{height}x{fps}",
+             "--monitors", str(monitors), "--frames", str(args.frames),
+             "--warmup", str(args.warmup),
+             "--server-pid", str(server.pid)],
+            stdout=subprocess.PIPE, env=dict(os.environ, DISPLAY=display),
+            text=True, check=False,
+            timeout=args.timeout + (args.frames + args.warmup) / fps,
+        )
+    except subprocess.TimeoutExpired:
+        return {**config, "error": "timed out"}
+    finally:
+        server.terminate()
+        server.wait()
+    if capture.returncode != 0:
+        return {**config, "error": f"exited with {capture.returncode}"}
+    return {**config, **json.loads(capture.stdout)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the cost of capturing one monitor of a desktop")
+    parser.add_argument("--monitor", type=parse_size,
+                        default=(1920, 1080, 30),
+                        help="WIDTHxHEIGHTxFPS of every monitor "
+                             "(default: 1920x1080x30)")
+    parser.add_argument("--monitor-counts",
+                        default=",".join(map(str, MONITORS)),
+                        help="comma-separated list of monitor counts")
+    parser.add_argument("--modes", default=",".join(MODES),
+                        help="comma-separated list of: " + ", ".join(MODES))
+    parser.add_argument("--frames", type=int, default=150)
+    parser.add_argument("--warmup", type=int, default=30,
+                        help="frames to capture before measuring")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds to allow beyond the nominal duration")
+    parser.add_argument("--capture", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--monitors", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--server-pid", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.capture:
+        run_capture(args)
+        return
+
+    modes = args.modes.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            parser.error("Unknown mode: " + mode)
+    counts = [int(count) for count in args.monitor_counts.split(",")]
+    json.dump({
+        "benchmark": "capture_region",
+        "monitor": "{}x{}x{}".format(*args.monitor),
+        "results": [measure(args, monitors, mode)
+                    for monitors in counts for mode in modes],
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
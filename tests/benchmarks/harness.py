@@ -0,0 +1,78 @@
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Helpers shared by the benchmarks"""
+
+# pylint: disable=import-outside-toplevel
+
+import argparse
+import os
+import sys
+from typing import List
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def use_sender() -> None:
+    """Make the sender modules and the QubesDB stub importable"""
+    sys.path[:0] = [os.path.join(ROOT, "sender"),
+                    os.path.join(ROOT, "ci", "test-packages")]
+
+
+def parse_size(value: str):
+    try:
+        width, height, fps = map(int, value.split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHTxFPS") \
+            from None
+    return width, height, fps
+
+
+def service_arg(width: int, height: int, fps: int, protocol: int,
+                transport: str = "raw") -> str:
+    """Return the service argument the receiver wrapper would send"""
+    arg = f"{width}+{height}+{fps}"
+    if protocol >= 2:
+        arg += f"+v{protocol}"
+    if transport != "raw":
+        arg += f"+{transport}"
+    return arg
+
+
+class _Exec(Exception):
+    """Raised in place of replacing the process"""
+
+
+def receiver_elements(sink: List[str]) -> List[str]:
+    """
+    Run receiver.main() on standard input up to the point where it would
+    exec gst-launch-1.0, and return its pipeline with sink in place of
+    v4l2sink
+
+    For protocol version 2 and later the frame relay child is running when this
+    returns, just like for the real receiver.
+    """
+    # i420.py is installed next to receiver.py, but lives in sender/ here
+    sys.path[:0] = [os.path.join(ROOT, "receiver"),
+                    os.path.join(ROOT, "sender")]
+    import receiver
+
+    def execv(_path, argv):
+        raise _Exec(argv)
+
+    os.execv = execv
+    # the receiver writes requests for the sender to standard output and then
+    # replaces it, while it carries the results of the benchmark here
+    stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    try:
+        receiver.main(["receiver.py", "--engine=gst", "/dev/null"])
+    except _Exec as e:
+        argv = list(e.args[0])
+    finally:
+        os.dup2(stdout, 1)
+        os.close(stdout)
+    return argv[1:argv.index("v4l2sink")] + sink
@@ -0,0 +1,226 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""
+Compare the mmap and gst engines of receiver.py
+
+A writer process sends a fixed number of raw frames through an anonymous
+pipe, and the receiver engine under test passes them on until the end of the
+stream.  The mmap engine writes into a fake loopback device, which answers
+the V4L2 ioctls and maps anonymous memory in place of device buffers.  The
+gst engine runs the receiver pipeline with fakesink in place of v4l2sink, so
+it is measured without the copy v4l2sink would do.
+
+    python3 tests/benchmarks/receiver_engines.py --size 1920x1080x30
+
+Only GStreamer is needed for the gst engine, no V4L2 device for either.
+"""
+
+# pylint: disable=import-outside-toplevel
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import time
+
+from harness import ROOT, parse_size, receiver_elements
+
+sys.path[:0] = [os.path.join(ROOT, "receiver"), os.path.join(ROOT, "sender")]
+import i420  # pylint: disable=wrong-import-position
+import receiver  # pylint: disable=wrong-import-position
+import v4l2out  # pylint: disable=wrong-import-position
+
+ENGINES = ("mmap", "gst")
+
+
+class FakeLoopback:
+    """Answer the ioctls of v4l2out.LoopbackOutput like v4l2loopback"""
+
+    def __init__(self):
+        self.size = 0
+        self.queued = []
+        self.frames = 0
+
+    def ioctl(self, _fd: int, request: int, arg: bytes) -> bytes:
+        if request == v4l2out.VIDIOC_S_FMT:
+            fields = list(v4l2out.v4l2_format.unpack(arg))
+            width, height = fields[1], fields[2]
+            # YU12 is 12 bits per pixel
+            self.size = width * height * 3 // 2
+            fields[5], fields[6] = width, self.size
+            return v4l2out.v4l2_format.pack(*fields)
+        if request == v4l2out.VIDIOC_QUERYBUF:
+            fields = list(v4l2out.v4l2_buffer.unpack(arg))
+            fields[10] = fields[0] * self.size  # offset
+            fields[11] = self.size  # length
+            return v4l2out.v4l2_buffer.pack(*fields)
+        if request == v4l2out.VIDIOC_QBUF:
+            self.queued.append(v4l2out.v4l2_buffer.unpack(arg)[0])
+            self.frames += 1
+            return arg
+        if request == v4l2out.VIDIOC_DQBUF:
+            fields = list(v4l2out.v4l2_buffer.unpack(arg))
+            fields[0] = self.queued.pop(0)
+            return v4l2out.v4l2_buffer.pack(*fields)
+        # VIDIOC_REQBUFS keeps the requested count, STREAMON/OFF do nothing
+        return arg
+
+    @staticmethod
+    def mmap(_fd, length, _flags, _prot, offset=0):
+        # pylint: disable=unused-argument
+        return mmap.mmap(-1, length)
+
+
+def run_writer(args) -> None:
+    """Write the stream header and the frames to standard output"""
+    frame = bytes(range(256)) * (
+        i420.i420_layout(args.width, args.height)[2] // 256 + 1
+    )
+    frame = frame[:i420.i420_layout(args.width, args.height)[2]]
+    out = sys.stdout.buffer
+    if args.protocol == 1:
+        out.write(struct.pack("=HHH", args.width, args.height, args.fps))
+    else:
+        out.write(struct.pack("=HHHHHH", receiver.EXTENDED_HEADER_MAGIC,
+                              args.protocol, receiver.TRANSPORT_RAW,
+                              args.width, args.height, args.fps))
+        if args.protocol >= 3:
+            out.write(struct.pack("=H", 0))  # I420
+    for sequence in range(args.frames):
+        if args.protocol >= 2:
+            out.write(receiver.frame_header.pack(sequence, time.time_ns(),
+                                                 len(frame)))
+        out.write(frame)
+    out.flush()
+
+
+def run_engine(args) -> None:
+    """Receive the stream on standard input with one engine"""
+    if args.engine == "mmap":
+        width, height, fps, version, transport, pixel_format = \
+            receiver.read_video_parameters()
+        device = FakeLoopback()
+        fd = os.open(os.devnull, os.O_RDWR)
+        output = v4l2out.LoopbackOutput(
+            fd, width, height, i420.i420_layout(width, height)[2],
+            ioctl=device.ioctl, mmap_func=device.mmap,
+        )
+        receiver.receive_frames((width, height, fps), version, transport,
+                                pixel_format, output=output)
+        output.close()
+        frames = device.frames
+    else:
+        elements = receiver_elements(
+            ["fakesink", "name=sink", "signal-handoffs=true", "sync=false"]
+        )
+        import gi
+        gi.require_version("Gst", "1.0")
+        from gi.repository import Gst
+        Gst.init(None)
+        element = Gst.parse_launchv(elements)
+        counter = {"frames": 0}
+
+        def on_handoff(*_args):
+            counter["frames"] += 1
+
+        element.get_by_name("sink").connect("handoff", on_handoff)
+        element.set_state(Gst.State.PLAYING)
+        element.get_bus().timed_pop_filtered(
+            Gst.CLOCK_TIME_NONE,
+            Gst.MessageType.EOS | Gst.MessageType.ERROR,
+        )
+        element.set_state(Gst.State.NULL)
+        frames = counter["frames"]
+        try:
+            # include the frame relay in the resource usage
+            os.wait()
+        except ChildProcessError:
+            pass
+    json.dump({"frames": frames}, sys.stdout)
+
+
+def measure(args, engine: str) -> dict:
+    read_fd, write_fd = os.pipe()
+    size = f"{args.width}x{args.height}x{args.fps}"
+    # pylint: disable=consider-using-with
+    writer = subprocess.Popen(
+        [sys.executable, __file__, "--writer", "--size", size,
+         "--frames", str(args.frames), "--protocol", str(args.protocol)],
+        stdout=write_fd,
+    )
+    start = time.monotonic()
+    reader = subprocess.Popen(
+        [sys.executable, __file__, "--engine", engine],
+        stdin=read_fd, stdout=subprocess.PIPE,
+    )
+    os.close(read_fd)
+    os.close(write_fd)
+    output = reader.stdout.read()
+    _pid, status, usage = os.wait4(reader.pid, 0)
+    seconds = time.monotonic() - start
+    reader.returncode = os.waitstatus_to_exitcode(status)
+    reader.stdout.close()
+    writer.wait()
+    if reader.returncode != 0:
+        return {"engine": engine,
+                "error": f"exited with {reader.returncode}"}
+    frames = json.loads(output)["frames"]
+    cpu = usage.ru_utime + usage.ru_stime
+    return {
+        "engine": engine,
+        "frames": frames,
+        "seconds": round(seconds, 3),
+        "fps": round(frames / seconds, 1),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_ms_per_frame": round(cpu * 1000 / max(frames, 1), 3),
+        "peak_rss_kib": usage.ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the receiver engines with a fake loopback device")
+    parser.add_argument("--size", type=parse_size, default=(1920, 1080, 30),
+                        help="WIDTHxHEIGHTxFPS of the stream "
+                             "(default: 1920x1080x30)")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--protocol", type=int, choices=(1, 2, 3, 4),
+                        default=4)
+    parser.add_argument("--engines", default=",".join(ENGINES),
+                        help="comma-separated list of: " + ", ".join(ENGINES))
+    parser.add_argument("--writer", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--engine", choices=ENGINES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.width, args.height, args.fps = args.size
+
+    if args.writer:
+        run_writer(args)
+        return
+    if args.engine:
+        run_engine(args)
+        return
+
+    engines = args.engines.split(",")
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error("Unknown engine: " + engine)
+    json.dump({
+        "benchmark": "receiver_engines",
+        "width": args.width,
+        "height": args.height,
+        "protocol": args.protocol,
+        "results": [measure(args, engine) for engine in engines],
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""
+Measure the time from a qvc.Webcam call to the first frame at the receiver
+
+The real sender code (Service.main and Webcam) runs with videotestsrc in
+place of v4l2src, and QubesDB is provided by the stub in ci/test-packages.
+Its output is piped into the real receiver.py, whose gst-launch-1.0 pipeline
+is run in-process with fakesink in place of v4l2sink.  No camera, X server,
+Qubes or v4l2loopback is needed.
+
+The result is a JSON object with the median, minimum and maximum duration of
+every startup phase over all runs:
+
+    python3 tests/benchmarks/startup.py --runs 10 > startup.json
+
+GTK needs a display and notifications need a D-Bus session bus, so on a
+headless box run it under xvfb-run and dbus-run-session.  If no notification
+daemon answers, the notify_tray phase is reported with an error.
+"""
+
+# pylint: disable=import-outside-toplevel,wrong-import-position
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from fractions import Fraction
+
+from harness import parse_size, receiver_elements, service_arg, use_sender
+
+#: Phases, as (name, start mark, end mark).  Marks are CLOCK_MONOTONIC
+#: timestamps, which are comparable between processes.
+PHASES = (
+    ("interpreter", "spawn", "harness"),
+    ("imports", "harness", "imported"),
+    ("notify_tray", "start_service", "service_started"),
+    ("parameters", "parameters", "parameters_done"),
+    ("gst_init", "gst_init", "gst_init_done"),
+    ("parse_launchv", "parse_launchv", "parse_launchv_done"),
+    ("playing", "parse_launchv_done", "playing"),
+    ("first_frame", "playing", "first_frame"),
+    ("total", "spawn", "first_frame"),
+)
+
+
+class Marks:
+    """Append named timestamps to a file, one JSON object per line"""
+
+    def __init__(self, path: str):
+        # line buffered, the process is killed once the frame arrived
+        # pylint: disable=consider-using-with
+        self.file = open(path, "a", encoding="ascii", buffering=1)
+
+    def __call__(self, name: str, **extra) -> None:
+        self.file.write(json.dumps(
+            {"mark": name, "time": time.monotonic_ns(), **extra}
+        ) + "\n")
+
+    def timed(self, name: str, func):
+        """Wrap func to mark when calls to it start and return"""
+        def wrapper(*args, **kwargs):
+            self(name)
+            result = func(*args, **kwargs)
+            self(name + "_done")
+            return result
+        return wrapper
+
+
+def run_sender(args) -> None:
+    """Run the sender with instrumentation; never returns"""
+    mark = Marks(args.marks)
+    mark("harness")
+    use_sender()
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import GLib, Gst
+    import v4l2
+    from webcam import Webcam
+    mark("imported")
+
+    # Service.start_transmission() looks these up on the module at call time
+    Gst.init = mark.timed("gst_init", Gst.init)
+    Gst.parse_launchv = mark.timed("parse_launchv", Gst.parse_launchv)
+
+    class BenchmarkWebcam(Webcam):
+        """Webcam with videotestsrc in place of the camera"""
+
+        def start_service(self, target_domain, remote_domain):
+            mark("start_service")
+            try:
+                super().start_service(target_domain, remote_domain)
+            except GLib.Error as e:
+                mark("service_started", error=str(e))
+                return
+            mark("service_started")
+
+        def record_connect_state(self, remote_domain):
+            # nothing to clean up in QubesDB or /run/qubes
+            pass
+
+        def cached_formats(self):
+            if args.formats:
+                # replay a camera recorded with v4l2.py --record, to include
+                # the cost of enumerating its formats
+                with open(args.formats, encoding="ascii") as fixture:
+                    return v4l2.enumerate_formats(
+                        -1, v4l2.IoctlReplayer(json.load(fixture))
+                    )
+            return [v4l2.FrameFormat("YUYV", False, args.width, args.height,
+                                     Fraction(args.fps))]
+
+        def parameters(self):
+            mark("parameters")
+            result = super().parameters()
+            mark("parameters_done")
+            return result
+
+        def pipeline(self, width, height, fps, **kwargs):
+            kwargs["fmt"] = "video/x-raw"
+            elements = super().pipeline(width, height, fps, **kwargs)
+            elements[0:2] = ["videotestsrc", "is-live=true"]
+            return elements
+
+        def msg_handler(self, bus, msg):
+            if (msg.type == Gst.MessageType.STATE_CHANGED
+                    and msg.src == self._element
+                    and msg.parse_state_changed()[1] == Gst.State.PLAYING):
+                mark("playing")
+            super().msg_handler(bus, msg)
+
+    BenchmarkWebcam(untrusted_arg=args.arg)
+
+
+def run_receiver() -> None:
+    """Run receiver.py until the first frame reaches the sink"""
+    elements = receiver_elements(
+        ["fakesink", "name=sink", "signal-handoffs=true", "sync=false"]
+    )
+    print(json.dumps({"mark": "header", "time": time.monotonic_ns()}),
+          flush=True)
+
+    # imported only now, as the real receiver starts gst-launch-1.0 here
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import GLib, Gst
+    Gst.init(None)
+    element = Gst.parse_launchv(elements)
+    loop = GLib.MainLoop()
+
+    def on_handoff(*_args):
+        print(json.dumps({"mark": "first_frame", "time": time.monotonic_ns()}),
+              flush=True)
+        GLib.idle_add(loop.quit)
+
+    element.get_by_name("sink").connect("handoff", on_handoff)
+    element.set_state(Gst.State.PLAYING)
+    loop.run()
+    element.set_state(Gst.State.NULL)
+
+
+def read_marks(lines) -> dict:
+    marks = {}
+    for line in lines:
+        entry = json.loads(line)
+        marks.setdefault(entry["mark"], entry)
+    return marks
+
+
+def run_once(args) -> dict:
+    """Start a sender and a receiver, return the marks of both"""
+    env = dict(os.environ, QREXEC_REMOTE_DOMAIN="benchmark")
+    env.pop("NOTIFY_SOCKET", None)
+    with tempfile.NamedTemporaryFile(mode="r", encoding="ascii",
+                                     suffix=".jsonl") as marks_file:
+        read_fd, write_fd = os.pipe()
+        spawn = time.monotonic_ns()
+        # pylint: disable=consider-using-with
+        sender = subprocess.Popen(
+            [sys.executable, __file__, "--sender", "--marks", marks_file.name,
+             "--size", f"{args.width}x{args.height}x{args.fps}",
+             *(["--formats", args.formats] if args.formats else []),
+             "--", args.arg],
+            stdout=write_fd, env=env,
+        )
+        receiver = subprocess.Popen(
+            [sys.executable, __file__, "--receiver"],
+            stdin=read_fd, stdout=subprocess.PIPE, env=env, text=True,
+        )
+        os.close(read_fd)
+        os.close(write_fd)
+        try:
+            receiver_output = receiver.communicate(timeout=args.timeout)[0]
+        except subprocess.TimeoutExpired:
+            receiver.kill()
+            receiver_output = receiver.communicate()[0]
+        finally:
+            sender.terminate()
+            try:
+                sender.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                sender.kill()
+                sender.wait()
+        marks = read_marks(marks_file)
+    marks.update(read_marks(receiver_output.splitlines()))
+    marks["spawn"] = {"mark": "spawn", "time": spawn}
+    return marks
+
+
+def summarize(runs) -> dict:
+    phases = {}
+    errors = set()
+    for name, start, end in PHASES:
+        durations = [
+            (marks[end]["time"] - marks[start]["time"]) / 1000000
+            for marks in runs if start in marks and end in marks
+        ]
+        for marks in runs:
+            if "error" in marks.get(end, {}):
+                errors.add(f"{name}: {marks[end]['error']}")
+        if not durations:
+            phases[name] = None
+            continue
+        phases[name] = {
+            "median_ms": round(statistics.median(durations), 3),
+            "min_ms": round(min(durations), 3),
+            "max_ms": round(max(durations), 3),
+            "samples": len(durations),
+        }
+    return {"phases": phases, "errors": sorted(errors)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the startup latency of a webcam stream")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--size", type=parse_size, default=(640, 480, 30),
+                        help="WIDTHxHEIGHTxFPS of the stream "
+                             "(default: 640x480x30)")
+    parser.add_argument("--protocol", type=int, choices=(1, 2, 3, 4),
+                        default=4)
+    parser.add_argument("--formats", metavar="FILE",
+                        help="formats recorded with sender/v4l2.py --record, "
+                             "enumerated instead of a published list")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds to wait for the first frame of a run")
+    parser.add_argument("--sender", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--receiver", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--marks", help=argparse.SUPPRESS)
+    parser.add_argument("arg", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.width, args.height, args.fps = args.size
+
+    if args.receiver:
+        run_receiver()
+        return
+    if args.sender:
+        run_sender(args)
+        return
+
+    args.arg = service_arg(args.width, args.height, args.fps, args.protocol)
+    runs = [run_once(args) for _ in range(args.runs)]
+    result = {
+        "benchmark": "startup",
+        "source": "videotestsrc",
+        "width": args.width,
+        "height": args.height,
+        "fps": args.fps,
+        "protocol": args.protocol,
+        "runs": args.runs,
+        "python": sys.version.split()[0],
+        **summarize(runs),
+    }
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/python3 --
+
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""
+Measure sustained throughput and CPU usage of the video pipelines
+
+For every source, transport and size, the real Webcam or ScreenShare pipeline
+(with its exact caps) runs with videotestsrc in place of v4l2src or
+ximagesrc, and writes into an anonymous pipe in place of qrexec.  The real receiver.py reads
+the pipe, and its gst-launch-1.0 pipeline runs in-process with fakesink in
+place of v4l2sink.
+
+After a warm-up, the achieved frame rate, the bytes written into the pipe per
+second, the CPU used by the sender and the receiver (including the frame
+relay), and their peak RSS are measured:
+
+    python3 tests/benchmarks/throughput.py > baseline.json
+    python3 tests/benchmarks/throughput.py --baseline baseline.json
+
+--transports compares the raw frames with the tile and row transports, whose
+change detection and encoding run in the sender; the tile transport needs
+screenshare, and both need protocol version 2 or later.  --budget only
+applies to the raw transport.
+
+With --baseline, frame rates that dropped or CPU usage and peak RSS that grew
+by more than the tolerance are reported, and the exit status is 1.  The exit
+status is also 1 if a --budget configuration did not reach 95% of its frame
+rate.
+"""
+
+# pylint: disable=import-outside-toplevel
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from fractions import Fraction
+
+from harness import parse_size, receiver_elements, service_arg, use_sender
+
+SIZES = ("640x480x30", "1280x720x30", "1920x1080x30", "3840x2160x30",
+         "7680x4320x30")
+SOURCES = ("webcam", "screenshare")
+TRANSPORTS = ("raw", "tiles", "rle")
+BUDGET = ("1920x1080x30", "3840x2160x30")
+#: fraction of the requested frame rate a configuration must reach
+BUDGET_FPS = 0.95
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def cpu_seconds(pid: int) -> float:
+    """Return the CPU time used by all threads of a process"""
+    with open(f"/proc/{pid}/stat", encoding="ascii") as stat:
+        # the command name may contain spaces, skip past it
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def peak_rss_kib(pid: int) -> int:
+    with open(f"/proc/{pid}/status", encoding="ascii") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def bytes_written(pid: int) -> int:
+    with open(f"/proc/{pid}/io", encoding="ascii") as io:
+        for line in io:
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+    return 0
+
+
+def children(pid: int) -> list:
+    with open(f"/proc/{pid}/task/{pid}/children", encoding="ascii") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def run_sender(args) -> None:
+    """Run the sender without notifications or tray icon; never returns"""
+    use_sender()
+    import v4l2
+
+    def start_service(self, _target_domain, _remote_domain):
+        self._quitting = False  # pylint: disable=protected-access
+        self._element = None  # pylint: disable=protected-access
+
+    if args.source == "webcam":
+        from webcam import Webcam
+
+        class BenchmarkWebcam(Webcam):
+            """Webcam with videotestsrc in place of the camera"""
+
+            def record_connect_state(self, remote_domain):
+                pass
+
+            def cached_formats(self):
+                return [v4l2.FrameFormat("YUYV", False, args.width,
+                                         args.height, Fraction(args.fps))]
+
+            def pipeline(self, width, height, fps, **kwargs):
+                kwargs["fmt"] = "video/x-raw"
+                elements = super().pipeline(width, height, fps, **kwargs)
+                elements[0:2] = ["videotestsrc", "is-live=true"]
+                return elements
+
+        BenchmarkWebcam.start_service = start_service
+        BenchmarkWebcam(untrusted_arg=args.arg)
+    else:
+        from screenshare import ScreenShare
+
+        class BenchmarkScreenShare(ScreenShare):
+            """ScreenShare with videotestsrc in place of the X server"""
+
+            def parameters(self):
+                return (args.width, args.height, args.fps, {
+                    "capture_x": 0,
+                    "capture_y": 0,
+                    "capture_width": args.width,
+                    "capture_height": args.height,
+                })
+
+            def pipeline(self, width, height, fps, **kwargs):
+                elements = super().pipeline(width, height, fps, **kwargs)
+                # ximagesrc and its properties
+                elements[:elements.index("!")] = ["videotestsrc",
+                                                  "is-live=true"]
+                return elements
+
+        BenchmarkScreenShare.start_service = start_service
+        BenchmarkScreenShare(untrusted_arg=args.arg)
+
+
+def run_receiver(args) -> None:
+    """Receive frames, print the measurements of the window as JSON"""
+    elements = receiver_elements(
+        ["fakesink", "name=sink", "signal-handoffs=true", "sync=false"]
+    )
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import GLib, Gst
+    Gst.init(None)
+    element = Gst.parse_launchv(elements)
+    loop = GLib.MainLoop()
+    # the frame relay, if any, is a child of this process
+    receivers = [os.getpid(), *children(os.getpid())]
+    counters = {"frames": 0, "bytes": 0}
+    window = {}
+
+    def snapshot():
+        return {
+            "time": time.monotonic(),
+            "frames": counters["frames"],
+            "bytes": counters["bytes"],
+            "pipe_bytes": bytes_written(args.sender_pid),
+            "sender_cpu": cpu_seconds(args.sender_pid),
+            "receiver_cpu": sum(cpu_seconds(pid) for pid in receivers),
+        }
+
+    def end_window():
+        window["end"] = snapshot()
+        loop.quit()
+
+    def start_window():
+        window["start"] = snapshot()
+        GLib.timeout_add(int(args.duration * 1000), end_window)
+
+    def on_handoff(_sink, buf, _pad):
+        if not counters["frames"]:
+            GLib.idle_add(GLib.timeout_add,
+                          int(args.warmup * 1000), start_window)
+        counters["frames"] += 1
+        counters["bytes"] += buf.get_size()
+
+    element.get_by_name("sink").connect("handoff", on_handoff)
+    element.set_state(Gst.State.PLAYING)
+    loop.run()
+    start, end = window["start"], window["end"]
+    seconds = end["time"] - start["time"]
+    result = {
+        "achieved_fps": round((end["frames"] - start["frames"]) / seconds, 2),
+        "pipe_bytes_per_second":
+            round((end["pipe_bytes"] - start["pipe_bytes"]) / seconds),
+        "frame_bytes_per_second":
+            round((end["bytes"] - start["bytes"]) / seconds),
+        # in CPUs, 1.0 is one core fully used
+        "sender_cpu":
+            round((end["sender_cpu"] - start["sender_cpu"]) / seconds, 3),
+        "receiver_cpu":
+            round((end["receiver_cpu"] - start["receiver_cpu"]) / seconds, 3),
+        "sender_peak_rss_kib": peak_rss_kib(args.sender_pid),
+        "receiver_peak_rss_kib":
+            sum(peak_rss_kib(pid) for pid in receivers),
+    }
+    element.set_state(Gst.State.NULL)
+    json.dump(result, sys.stdout)
+
+
+def run_once(args, source: str, transport: str, size) -> dict:
+    """Stream one configuration, return its measurements"""
+    width, height, fps = size
+    env = dict(os.environ, QREXEC_REMOTE_DOMAIN="benchmark")
+    env.pop("NOTIFY_SOCKET", None)
+    config = {"source": source, "transport": transport, "width": width,
+              "height": height, "fps": fps, "protocol": args.protocol}
+    read_fd, write_fd = os.pipe()
+    # pylint: disable=consider-using-with
+    sender = subprocess.Popen(
+        [sys.executable, __file__, "--sender", "--source", source,
+         "--size", f"{width}x{height}x{fps}",
+         "--", service_arg(width, height, fps, args.protocol, transport)],
+        stdout=write_fd, env=env,
+    )
+    receiver = subprocess.Popen(
+        [sys.executable, __file__, "--receiver",
+         "--sender-pid", str(sender.pid),
+         "--warmup", str(args.warmup), "--duration", str(args.duration)],
+        stdin=read_fd, stdout=subprocess.PIPE, env=env, text=True,
+    )
+    os.close(read_fd)
+    os.close(write_fd)
+    try:
+        output = receiver.communicate(
+            timeout=args.timeout + args.warmup + args.duration
+        )[0]
+    except subprocess.TimeoutExpired:
+        receiver.kill()
+        output = receiver.communicate()[0]
+    finally:
+        sender.terminate()
+        try:
+            sender.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            sender.kill()
+            sender.wait()
+    if receiver.returncode != 0 or not output:
+        return {**config, "error": f"receiver exited with "
+                                   f"{receiver.returncode}"}
+    result = {**config, **json.loads(output)}
+    result["within_budget"] = result["achieved_fps"] >= fps * BUDGET_FPS
+    return result
+
+
+def key(result: dict) -> tuple:
+    # results from before the transport axis are all raw
+    return (result["source"], result["width"], result["height"],
+            result["fps"], result["protocol"], result.get("transport", "raw"))
+
+
+def compare(results, baseline, tolerance: float) -> list:
+    """Return a description of every regression against the baseline"""
+    regressions = []
+    previous = {key(result): result for result in baseline["results"]}
+    for result in results:
+        base = previous.get(key(result))
+        if base is None or "error" in base:
+            continue
+        name = "{} {}x{}x{} {}".format(*key(result)[:4], key(result)[5])
+        if "error" in result:
+            regressions.append(f"{name}: {result['error']}")
+            continue
+        if result["achieved_fps"] < base["achieved_fps"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['achieved_fps']} fps, "
+                               f"was {base['achieved_fps']}")
+        for metric in ("sender_cpu", "receiver_cpu", "sender_peak_rss_kib",
+                       "receiver_peak_rss_kib"):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {metric} {result[metric]}, was {base[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure throughput and CPU usage of the video pipelines")
+    parser.add_argument("--sizes", default=",".join(SIZES),
+                        help="comma-separated WIDTHxHEIGHTxFPS list")
+    parser.add_argument("--sources", default=",".join(SOURCES),
+                        help="comma-separated list of: " + ", ".join(SOURCES))
+    parser.add_argument("--transports", default="raw",
+                        help="comma-separated list of: " +
+                             ", ".join(TRANSPORTS) + " (default: raw)")
+    parser.add_argument("--protocol", type=int, choices=(1, 2, 3, 4),
+                        default=4)
+    parser.add_argument("--warmup", type=float, default=2,
+                        help="seconds to stream before measuring")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to measure each configuration")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds to wait for the first frame")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="earlier output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed relative regression (default: 0.1)")
+    parser.add_argument("--budget", default=",".join(BUDGET),
+                        help="comma-separated WIDTHxHEIGHTxFPS list that "
+                             "must reach their frame rate")
+    parser.add_argument("--sender", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--receiver", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--source", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=parse_size, help=argparse.SUPPRESS)
+    parser.add_argument("--sender-pid", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("arg", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.receiver:
+        run_receiver(args)
+        return
+    if args.sender:
+        args.width, args.height, args.fps = args.size
+        run_sender(args)
+        return
+
+    sources = args.sources.split(",")
+    for source in sources:
+        if source not in SOURCES:
+            parser.error("Unknown source: " + source)
+    transports = args.transports.split(",")
+    for transport in transports:
+        if transport not in TRANSPORTS:
+            parser.error("Unknown transport: " + transport)
+    if transports != ["raw"] and args.protocol < 2:
+        parser.error("--transports requires protocol version 2 or later")
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    budget = {parse_size(size) for size in args.budget.split(",")}
+
+    results = []
+    for source in sources:
+        for transport in transports:
+            if transport == "tiles" and source != "screenshare":
+                continue
+            for size in sizes:
+                result = run_once(args, source, transport, size)
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+    json.dump({
+        "benchmark": "throughput",
+        "duration": args.duration,
+        "python": sys.version.split()[0],
+        "results": results,
+    }, sys.stdout, indent=2)
+    print()
+
+    failures = [
+        "{} {}x{}x{} {}: {} fps".format(*key(result)[:4], key(result)[5],
+                                        result.get("achieved_fps", "no"))
+        for result in results
+        if key(result)[1:4] in budget and key(result)[5] == "raw"
+        and not result.get("within_budget")
+    ]
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            failures += compare(results, json.load(f), args.tolerance)
+    for failure in failures:
+        print("Regression: " + failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
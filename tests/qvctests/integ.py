@@ -126,6 +126,33 @@ class TC_00_QVCTest(qubes.tests.extra.ExtraTestCase):
             print(stdout)
             print(stderr)
 
+    def test_011_screenshare_resolution(self):
+        self.view.start()
+        self.qrexec_policy('qvc.ScreenShare',
+                           self.view.name,
+                           '@default',
+                           target=self.source.name)
+        p = self.view.run('qubes-video-companion -r 640x480x15 screenshare',
+                           passio_popen=True, passio_stderr=True)
+        # wait for device to appear, or a timeout
+        self.wait_for_video0(self.view)
+        self.loop.run_until_complete(self.wait_for_session(self.view))
+        if p.returncode is not None:
+            self.fail("'qubes-video-companion screenshare' exited early ({}): {} {}".format(
+                        p.returncode, *p.communicate()))
+
+        self.assertEqual(self.get_default_video_format(self.view),
+                         ['640', '480'])
+        destination_image = self.capture_from_video(self.view)
+        self.assertEqual(len(destination_image), 640 * 480 * 3 // 2)
+        self.click_stop(self.source, 'screenshare')
+        # wait for device to disappear, or a timeout
+        self.wait_for_video0_disconnect(self.view)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            self.fail("'qubes-video-companion screenshare' failed ({}): {} {}".format(
+                        p.returncode, stdout, stderr))
+
     def apply_mask(self, image, width=640, height=480):
         """Mask dynamic parts of vivid device output
 
@@ -0,0 +1,360 @@
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Unit tests for the webcam device extension of qubesd, with fake qubes"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "core3ext")]
+
+try:
+    import qvc  # pylint: disable=wrong-import-position
+except ImportError:
+    # the extension plugs into qubes-core-admin, which only dom0 has
+    qvc = None
+
+FORMATS = b"640x480x30"
+
+
+class FakeQubesDB:
+    """The QubesDB of a qube, recording the paths that are read"""
+
+    def __init__(self):
+        self.entries = {}
+        self.reads = []
+
+    def read(self, path: str):
+        self.reads.append(path)
+        return self.entries.get(path)
+
+    def multiread(self, prefix: str) -> dict:
+        self.reads.append(prefix)
+        return {path: value for path, value in self.entries.items()
+                if path.startswith(prefix)}
+
+    def list(self, prefix: str) -> list:
+        self.reads.append(prefix)
+        return [path for path in self.entries if path.startswith(prefix)]
+
+    def set_device(self, port_id: str, connected_to: bytes = b"") -> None:
+        """Write the entries of a device as qvc.WebcamList does"""
+        self.entries.update({
+            f"/webcam-devices/{port_id}/formats/0": FORMATS,
+            f"/webcam-devices/{port_id}/connected-to": connected_to,
+        })
+
+    def remove_device(self, port_id: str) -> None:
+        for path in list(self.entries):
+            if path.startswith(f"/webcam-devices/{port_id}/"):
+                del self.entries[path]
+
+
+class FakeFeatures(dict):
+    def check_with_template(self, feature: str, default):
+        return self.get(feature, default)
+
+
+class FakeApp:
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.domains = {}
+
+
+class FakeVM:
+    """A qube with the parts of QubesVM used by the extension"""
+
+    def __init__(self, app: FakeApp, name: str, qid: int):
+        self.app = app
+        self.name = name
+        self.qid = qid
+        self.uuid = f"00000000-0000-0000-0000-{qid:012}"
+        self.untrusted_qdb = FakeQubesDB()
+        self.log = logging.getLogger(f"vm.{name}")
+        self.features = FakeFeatures()
+        self.running = True
+        self.events = []
+        self.services = []
+        #: raised by the next service calls
+        self.service_error = None
+        app.domains[name] = self
+
+    def is_running(self) -> bool:
+        return self.running
+
+    def fire_event(self, event: str, **kwargs) -> None:
+        self.events.append((event, kwargs))
+
+    async def fire_event_async(self, event: str, **kwargs) -> None:
+        self.events.append((event, kwargs))
+
+    async def run_service_for_stdio(self, service: str, **_kwargs):
+        self.services.append(service)
+        if self.service_error is not None:
+            raise self.service_error
+        return b"", b""
+
+
+@unittest.skipIf(qvc is None, "qubes-core-admin is not installed")
+class ExtensionTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        qvc.attribute_cache.clear()
+        self.app = FakeApp()
+        self.backend = FakeVM(self.app, "backend", 1)
+        self.front1 = FakeVM(self.app, "front1", 2)
+        self.front2 = FakeVM(self.app, "front2", 3)
+        self.ext = qvc.WebcamDeviceExtension()
+
+    def event_names(self, vm: FakeVM) -> list:
+        return [event for event, _kwargs in vm.events]
+
+
+class TC_00_DeviceList(ExtensionTestCase):
+    def test_000_read_device_entries(self):
+        self.backend.untrusted_qdb.set_device("video0", b"front1")
+        self.backend.untrusted_qdb.entries["/webcam-devices/Bad!/x"] = b""
+        with self.assertLogs(self.backend.log, "WARNING"):
+            entries = self.ext.read_device_entries(self.backend)
+        self.assertEqual(entries, {"video0": {
+            "formats/0": FORMATS,
+            "connected-to": b"front1",
+        }})
+
+    def test_001_read_stopped_qube(self):
+        self.backend.untrusted_qdb.set_device("video0")
+        self.backend.running = False
+        self.assertEqual(self.ext.read_device_entries(self.backend), {})
+        self.assertFalse(self.backend.untrusted_qdb.reads)
+
+    def test_002_ports_added_removed(self):
+        qdb = self.backend.untrusted_qdb
+        qdb.set_device("video0")
+        self.assertEqual(self.ext.current_devices(self.backend),
+                         {"video0": None})
+        qdb.remove_device("video0")
+        qdb.set_device("video1")
+        self.assertEqual(self.ext.current_devices(self.backend),
+                         {"video1": None})
+        self.assertEqual(list(self.ext.qdb_entries_cache["backend"]),
+                         ["video1"])
+
+    def test_003_changed_entries(self):
+        qdb = self.backend.untrusted_qdb
+        qdb.set_device("video0")
+        qdb.set_device("video1", b"front2")
+        self.ext.current_devices(self.backend)
+        self.assertEqual(self.ext.attachments_cache["backend"],
+                         {"video0": [], "video1": ["front2"]})
+        qdb.set_device("video0", b"front1")
+        self.ext.current_devices(self.backend)
+        self.assertEqual(self.ext.attachments_cache["backend"],
+                         {"video0": ["front1"], "video1": ["front2"]})
+        self.assertEqual(self.ext.attached_index, {
+            "front1": {("backend", "video0")},
+            "front2": {("backend", "video1")},
+        })
+
+    async def test_004_attachment_changes(self):
+        qdb = self.backend.untrusted_qdb
+        qdb.set_device("video0", b"front1")
+        qdb.set_device("video1", b"front2")
+        self.ext.current_devices(self.backend)
+        previous = self.ext.attachments_snapshot("backend")
+        qdb.set_device("video0", b"front2")
+        self.ext.current_devices(self.backend)
+        self.ext.fire_attachment_changes(self.backend, previous, False)
+        self.ext.fire_attachment_changes(self.backend, previous, True)
+        await asyncio.sleep(0)
+        self.assertEqual(self.event_names(self.front1),
+                         ["device-detach:webcam"])
+        self.assertEqual(self.front1.events[0][1]["port"].port_id, "video0")
+        # the stream of video1 to front2 did not change
+        self.assertEqual(self.event_names(self.front2),
+                         ["device-attach:webcam"])
+        self.assertEqual(self.front2.events[0][1]["device"].port_id,
+                         "video0")
+        self.assertFalse(self.backend.events)
+
+    async def test_005_qdb_change(self):
+        qdb = self.backend.untrusted_qdb
+        qdb.set_device("video0", b"front1")
+        self.ext.current_devices(self.backend)
+        qdb.remove_device("video0")
+        qdb.set_device("video1")
+        with mock.patch.object(qvc.utils, "device_list_change") as change:
+            self.ext.on_qdb_change(self.backend, "domain-qdb-change",
+                                   "/webcam-devices")
+        await asyncio.sleep(0)
+        change.assert_called_once_with(self.ext, {"video1": None},
+                                       self.backend, "/webcam-devices",
+                                       qvc.WebcamDevice)
+        self.assertEqual(self.event_names(self.front1),
+                         ["device-detach:webcam"])
+        self.assertNotIn("front1", self.ext.attached_index)
+
+
+class TC_01_AttachedIndex(ExtensionTestCase):
+    def setUp(self):
+        super().setUp()
+        # the policy files go to /run/qubes/policy.d
+        patcher = mock.patch.object(
+            qvc, "allow_qrexec_call", lambda *_args: contextlib.nullcontext()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for frontend in (self.front1, self.front2):
+            frontend.features["supported-rpc.qvc.WebcamAttach"] = True
+        self.backend.untrusted_qdb.set_device("video0")
+        self.ext.current_devices(self.backend)
+
+    def attached(self, vm: FakeVM) -> list:
+        return [device.port_id for device, _options
+                in self.ext.on_device_list_attached(
+                    vm, "device-list-attached:webcam")]
+
+    async def attach(self, vm: FakeVM) -> None:
+        device = qvc.WebcamDevice(qvc.Port(self.backend, "video0", "webcam"))
+        await self.ext.on_device_pre_attach_webcam(
+            vm, "device-pre-attach:webcam", device, {})
+
+    async def detach(self, vm: FakeVM) -> None:
+        await self.ext.on_device_detach_webcam(
+            vm, "device-pre-detach:webcam",
+            qvc.Port(self.backend, "video0", "webcam"))
+
+    def stream_to(self, *frontends: FakeVM) -> None:
+        """Update connected-to as the backend does, and watch it"""
+        self.backend.untrusted_qdb.set_device("video0", b" ".join(
+            frontend.name.encode() for frontend in frontends))
+        self.ext.current_devices(self.backend)
+
+    async def test_000_attach(self):
+        await self.attach(self.front1)
+        self.assertEqual(self.front1.services, ["qvc.WebcamAttach"])
+        self.assertEqual(self.ext.attached_index,
+                         {"front1": {("backend", "video0")}})
+        self.assertEqual(self.attached(self.front1), ["video0"])
+        # the QubesDB watch confirms the attachment
+        self.stream_to(self.front1)
+        self.assertEqual(self.ext.attached_index,
+                         {"front1": {("backend", "video0")}})
+        self.assertEqual(self.attached(self.front2), [])
+
+    async def test_001_failed_attach(self):
+        self.front1.service_error = subprocess.CalledProcessError(
+            1, "qvc.WebcamAttach", b"", b"failed")
+        with self.assertRaises(qvc.QubesException):
+            await self.attach(self.front1)
+        self.assertEqual(self.ext.attached_index, {})
+        self.assertEqual(self.ext.attachments_cache["backend"]["video0"],
+                         [])
+        self.assertEqual(self.attached(self.front1), [])
+
+    async def test_002_detach(self):
+        await self.attach(self.front1)
+        self.stream_to(self.front1)
+        await self.detach(self.front1)
+        self.assertEqual(self.backend.services, ["qvc.WebcamDetach+video0"])
+        self.assertEqual(self.ext.attached_index, {})
+        self.stream_to()
+        self.assertEqual(self.ext.attached_index, {})
+        self.assertEqual(self.attached(self.front1), [])
+
+    async def test_003_failed_detach(self):
+        await self.attach(self.front1)
+        self.stream_to(self.front1)
+        self.backend.service_error = subprocess.CalledProcessError(
+            1, "qvc.WebcamDetach", b"", b"failed")
+        with self.assertRaises(qvc.QubesException):
+            await self.detach(self.front1)
+        self.assertEqual(self.ext.attached_index,
+                         {"front1": {("backend", "video0")}})
+        self.assertEqual(self.attached(self.front1), ["video0"])
+
+    async def test_004_backend_shutdown(self):
+        self.backend.features["service.qvc-fanout"] = True
+        await self.attach(self.front1)
+        self.stream_to(self.front1)
+        await self.attach(self.front2)
+        self.stream_to(self.front1, self.front2)
+        self.assertEqual(self.ext.attached_index, {
+            "front1": {("backend", "video0")},
+            "front2": {("backend", "video0")},
+        })
+        self.backend.running = False
+        with mock.patch.object(qvc.utils, "device_list_change"):
+            await self.ext.on_domain_shutdown(self.backend,
+                                              "domain-shutdown")
+        await asyncio.sleep(0)
+        self.assertEqual(self.ext.attached_index, {})
+        self.assertNotIn("backend", self.ext.attachments_cache)
+        for frontend in (self.front1, self.front2):
+            self.assertEqual(self.event_names(frontend),
+                             ["device-detach:webcam"])
+            self.assertEqual(self.attached(frontend), [])
+
+
+class TC_02_AttributeCache(ExtensionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.qdb = self.backend.untrusted_qdb
+        self.qdb.set_device("video0", b"front1")
+        self.qdb.set_device("video1")
+
+    def list_devices(self) -> dict:
+        """List the devices of the backend as qvm-device does"""
+        return {
+            device.port_id: (device.name, device.formats,
+                             [vm.name for vm in device.attachments])
+            for device in self.ext.on_device_list_webcam(
+                self.backend, "device-list:webcam")
+        }
+
+    def test_000_repeated_listing(self):
+        expected = {
+            "video0": ("Camera", FORMATS.decode(), ["front1"]),
+            "video1": ("Camera", FORMATS.decode(), []),
+        }
+        # before the QubesDB watch fired, the list is read
+        self.assertEqual(self.list_devices(), expected)
+        self.assertIn("/webcam-devices/", self.qdb.reads)
+        self.ext.current_devices(self.backend)
+        self.list_devices()
+        self.qdb.reads.clear()
+        for _ in range(3):
+            self.assertEqual(self.list_devices(), expected)
+        self.assertEqual(self.qdb.reads, [])
+
+    async def test_001_qdb_change(self):
+        self.ext.current_devices(self.backend)
+        self.list_devices()
+        self.qdb.set_device("video0", b"front2")
+        self.qdb.reads.clear()
+        with mock.patch.object(qvc.utils, "device_list_change"):
+            self.ext.on_qdb_change(self.backend, "domain-qdb-change",
+                                   "/webcam-devices/video0/connected-to")
+        self.assertEqual(list(qvc.attribute_cache["backend"]), ["video1"])
+        self.qdb.reads.clear()
+        self.assertEqual(self.list_devices()["video0"][2], ["front2"])
+        self.assertTrue(self.qdb.reads)
+        self.assertTrue(all(path.startswith("/webcam-devices/video0/")
+                            for path in self.qdb.reads))
+
+    def test_002_attach_invalidates(self):
+        self.ext.current_devices(self.backend)
+        self.list_devices()
+        self.ext.record_attachment("front2", "backend", "video1", True)
+        self.assertEqual(list(qvc.attribute_cache["backend"]), ["video0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
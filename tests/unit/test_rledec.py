@@ -0,0 +1,164 @@
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Unit tests for the row delta and run-length decoder of the receiver"""
+
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "receiver"), os.path.join(ROOT, "sender")]
+
+import i420  # pylint: disable=wrong-import-position
+import rle  # pylint: disable=wrong-import-position
+import rledec  # pylint: disable=wrong-import-position
+
+# an odd height gives the Y plane a padding row
+WIDTH, HEIGHT = 40, 17
+
+
+class TC_00_RoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.encoder = rle.RowEncoder(WIDTH, HEIGHT)
+        self.decoder = rledec.RowDecoder(WIDTH, HEIGHT)
+        self.size = i420.i420_layout(WIDTH, HEIGHT)[2]
+
+    def roundtrip(self, frame: bytes) -> bytes:
+        payload = b"".join(self.encoder.encode(bytes(frame)))
+        self.assertLessEqual(len(payload), self.decoder.max_payload_size)
+        self.decoder.decode(memoryview(payload))
+        self.assertEqual(self.decoder.frame, frame)
+        return payload
+
+    def test_000_mixed_content(self):
+        lines = i420.frame_lines(WIDTH, HEIGHT)
+        frame = bytearray(self.size)
+        for index, (start, end, _plane) in enumerate(lines):
+            if index % 4 == 0:
+                frame[start:end] = bytes(self.rng.getrandbits(8)
+                                         for _ in range(end - start))
+            elif index % 4 == 1:
+                # the same as the line above
+                frame[start:end] = frame[2 * start - end:start]
+            elif index % 4 == 2:
+                frame[start:end] = bytes((index,)) * (end - start)
+        self.roundtrip(frame)
+
+    def test_001_static(self):
+        frame = bytearray(self.rng.getrandbits(8) for _ in range(self.size))
+        self.roundtrip(frame)
+        payload = self.roundtrip(frame)
+        # one run of unchanged lines per plane
+        self.assertEqual(len(payload), 3 * rledec.run_header.size)
+
+    def test_002_changes(self):
+        frame = bytearray(self.rng.getrandbits(8) for _ in range(self.size))
+        self.roundtrip(frame)
+        for offset in (0, self.size // 2, self.size - 1):
+            frame[offset] ^= 0xFF
+            payload = self.roundtrip(frame)
+            self.assertLess(len(payload), self.size)
+
+    def test_003_long_runs(self):
+        # more lines than fit in a single run
+        width, height = 2, 2 * rle.MAX_RUN_LINES
+        encoder = rle.RowEncoder(width, height)
+        decoder = rledec.RowDecoder(width, height)
+        frame = bytes(i420.i420_layout(width, height)[2])
+        for _ in range(2):
+            decoder.decode(memoryview(b"".join(encoder.encode(frame))))
+            self.assertEqual(decoder.frame, frame)
+
+
+class TC_01_Malformed(unittest.TestCase):
+    def setUp(self):
+        self.decoder = rledec.RowDecoder(WIDTH, HEIGHT)
+        self.lines = i420.frame_lines(WIDTH, HEIGHT)
+        # the number of lines in each plane
+        self.planes = [sum(1 for line in self.lines if line[2] == plane)
+                       for plane in range(3)]
+
+    def assertRejected(self, payload: bytes, message: str):
+        # pylint: disable=invalid-name
+        with self.assertRaisesRegex(RuntimeError, message):
+            self.decoder.decode(memoryview(payload))
+
+    def fill(self, count: int, value: int = 0) -> bytes:
+        return rledec.run_header.pack(rledec.RUN_FILL, count) + bytes((value,))
+
+    def valid(self) -> bytes:
+        return b"".join(self.fill(count) for count in self.planes)
+
+    def test_000_valid(self):
+        self.decoder.decode(memoryview(self.valid()))
+        self.decoder.decode(memoryview(b"".join(
+            rledec.run_header.pack(rledec.RUN_SAME, count)
+            for count in self.planes)))
+
+    def test_001_truncated_run_header(self):
+        self.assertRejected(b"", "truncated run header")
+        self.assertRejected(self.valid()[:-1 - rledec.run_header.size],
+                            "truncated run header")
+        self.assertRejected(self.fill(self.planes[0]) + b"\x02",
+                            "truncated run header")
+
+    def test_002_run_out_of_bounds(self):
+        self.assertRejected(self.fill(0), "run out of bounds")
+        self.assertRejected(self.fill(len(self.lines) + 1),
+                            "run out of bounds")
+        self.assertRejected(
+            self.fill(self.planes[0]) + self.fill(self.planes[1]) +
+            self.fill(self.planes[2] + 1), "run out of bounds")
+
+    def test_003_run_crosses_planes(self):
+        self.assertRejected(self.fill(self.planes[0] + 1),
+                            "run crosses planes")
+
+    def test_004_same_in_first_frame(self):
+        self.assertRejected(
+            rledec.run_header.pack(rledec.RUN_SAME, self.planes[0]),
+            "unchanged lines in the first frame")
+
+    def test_005_up_without_line_above(self):
+        self.assertRejected(rledec.run_header.pack(rledec.RUN_UP, 1),
+                            "no line above the run")
+        # the first line of the U plane has no line above it either
+        self.assertRejected(
+            self.fill(self.planes[0]) +
+            rledec.run_header.pack(rledec.RUN_UP, 1),
+            "no line above the run")
+
+    def test_006_truncated_fill_value(self):
+        self.assertRejected(
+            rledec.run_header.pack(rledec.RUN_FILL, self.planes[0]),
+            "truncated fill value")
+
+    def test_007_truncated_lines(self):
+        start, end, _plane = self.lines[0]
+        self.assertRejected(
+            rledec.run_header.pack(rledec.RUN_LITERAL, 1) +
+            bytes(end - start - 1), "truncated lines")
+
+    def test_008_unknown_op(self):
+        self.assertRejected(rledec.run_header.pack(4, 1),
+                            "unknown run op")
+
+    def test_009_trailing_data(self):
+        self.assertRejected(self.valid() + b"\x00", "trailing data")
+
+    def test_010_rejected_frame_is_not_a_reference(self):
+        # a frame that failed to decode cannot be repeated by the next one
+        with self.assertRaises(RuntimeError):
+            self.decoder.decode(memoryview(self.valid() + b"\x00"))
+        self.assertRejected(
+            rledec.run_header.pack(rledec.RUN_SAME, self.planes[0]),
+            "unchanged lines in the first frame")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Unit tests for the tile delta decoder of the receiver"""
+
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "receiver"), os.path.join(ROOT, "sender")]
+
+import i420  # pylint: disable=wrong-import-position
+import tiledec  # pylint: disable=wrong-import-position
+import tiles  # pylint: disable=wrong-import-position
+
+# not a multiple of the tile size, so the edge tiles are clipped
+WIDTH, HEIGHT = 150, 70
+
+
+def random_frame(rng: random.Random) -> bytearray:
+    size = i420.i420_layout(WIDTH, HEIGHT)[2]
+    return bytearray(rng.getrandbits(8) for _ in range(size))
+
+
+class TC_00_RoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.encoder = tiles.TileEncoder(WIDTH, HEIGHT, keyframe_interval=10)
+        self.decoder = tiledec.TileDecoder(WIDTH, HEIGHT)
+
+    def roundtrip(self, frame: bytes) -> bytes:
+        payload = b"".join(self.encoder.encode(bytes(frame)))
+        self.assertLessEqual(len(payload), self.decoder.max_payload_size)
+        self.decoder.decode(memoryview(payload))
+        return payload
+
+    def test_000_keyframe(self):
+        frame = random_frame(self.rng)
+        self.roundtrip(frame)
+        self.assertEqual(self.decoder.frame, frame)
+
+    def test_001_deltas(self):
+        frame = random_frame(self.rng)
+        self.roundtrip(frame)
+        # change the bottom right pixel, which is in a clipped tile, then a
+        # pixel in every plane of the top left tile
+        offsets, strides, _size = i420.i420_layout(WIDTH, HEIGHT)
+        for changes in ([(HEIGHT - 1) * strides[0] + WIDTH - 1],
+                        [0, offsets[1], offsets[2]]):
+            for offset in changes:
+                frame[offset] ^= 0xFF
+            payload = self.roundtrip(frame)
+            self.assertLess(len(payload), len(frame))
+            self.assertEqual(self.decoder.frame, frame)
+
+    def test_002_unchanged(self):
+        frame = random_frame(self.rng)
+        self.roundtrip(frame)
+        payload = self.roundtrip(frame)
+        self.assertEqual(payload, tiledec.frame_header.pack(
+            tiledec.FRAME_DELTA, 0))
+        self.assertEqual(self.decoder.frame, frame)
+
+    def test_003_changed_tiles(self):
+        self.encoder.keyframe_interval = 100
+        frame = random_frame(self.rng)
+        self.roundtrip(frame)
+        offsets, strides, _size = i420.i420_layout(WIDTH, HEIGHT)
+        for _ in range(20):
+            # a few pixels of any plane, and the tiles that contain them
+            pixels = {}
+            for _ in range(self.rng.randrange(1, 4)):
+                plane = self.rng.randrange(3)
+                scale = 1 if plane == 0 else 2
+                x = self.rng.randrange((WIDTH + scale - 1) // scale)
+                y = self.rng.randrange((HEIGHT + scale - 1) // scale)
+                pixels[offsets[plane] + y * strides[plane] + x] = (
+                    x * scale // tiles.TILE_SIZE,
+                    y * scale // tiles.TILE_SIZE,
+                )
+            for offset in pixels:
+                frame[offset] ^= 0xFF
+            expected = set(pixels.values())
+            payload = self.roundtrip(frame)
+            self.assertEqual(self.decoder.frame, frame)
+            self.assertEqual(tiles.frame_header.unpack_from(payload)[1],
+                             len(expected))
+
+
+class TC_01_Malformed(unittest.TestCase):
+    def setUp(self):
+        self.decoder = tiledec.TileDecoder(WIDTH, HEIGHT)
+        self.decoder.decode(memoryview(
+            tiledec.frame_header.pack(tiledec.FRAME_KEY, 0) +
+            bytes(len(self.decoder.frame))))
+
+    def assertRejected(self, payload: bytes, message: str):
+        # pylint: disable=invalid-name
+        with self.assertRaisesRegex(RuntimeError, message):
+            self.decoder.decode(memoryview(payload))
+
+    def tile(self, column: int, row: int) -> bytes:
+        rects = [self.decoder._tile_rect(column, row, plane)
+                 for plane in range(3)]  # pylint: disable=protected-access
+        size = sum(width * height for _left, _top, width, height in rects)
+        return tiledec.tile_header.pack(column, row) + b"\x01" * size
+
+    def delta(self, *chunks: bytes, count=None) -> bytes:
+        if count is None:
+            count = len(chunks)
+        return tiledec.frame_header.pack(tiledec.FRAME_DELTA, count) + \
+            b"".join(chunks)
+
+    def test_000_truncated_frame_header(self):
+        self.assertRejected(b"\x00", "truncated frame header")
+
+    def test_001_keyframe_size(self):
+        header = tiledec.frame_header.pack(tiledec.FRAME_KEY, 0)
+        self.assertRejected(header + bytes(len(self.decoder.frame) - 1),
+                            "wrong keyframe size")
+        self.assertRejected(header + bytes(len(self.decoder.frame) + 1),
+                            "wrong keyframe size")
+
+    def test_002_keyframe_with_tiles(self):
+        self.assertRejected(
+            tiledec.frame_header.pack(tiledec.FRAME_KEY, 1) +
+            bytes(len(self.decoder.frame)), "keyframe with tiles")
+
+    def test_003_unknown_kind(self):
+        self.assertRejected(tiledec.frame_header.pack(2, 0),
+                            "unknown frame kind")
+
+    def test_004_delta_before_keyframe(self):
+        decoder = tiledec.TileDecoder(WIDTH, HEIGHT)
+        with self.assertRaisesRegex(RuntimeError, "before the first keyframe"):
+            decoder.decode(memoryview(self.delta(self.tile(0, 0))))
+
+    def test_005_too_many_tiles(self):
+        count = self.decoder.columns * self.decoder.rows + 1
+        self.assertRejected(self.delta(count=count), "too many tiles")
+
+    def test_006_tile_out_of_bounds(self):
+        self.assertRejected(
+            self.delta(tiledec.tile_header.pack(self.decoder.columns, 0)),
+            "out of bounds")
+        self.assertRejected(
+            self.delta(tiledec.tile_header.pack(0, self.decoder.rows)),
+            "out of bounds")
+
+    def test_007_truncated_tile(self):
+        self.assertRejected(self.delta(count=1), "truncated tile header")
+        self.assertRejected(self.delta(self.tile(1, 1)[:-1]),
+                            "truncated tile")
+        self.assertRejected(self.delta(self.tile(0, 0), count=2),
+                            "truncated tile header")
+
+    def test_008_trailing_data(self):
+        self.assertRejected(self.delta(self.tile(0, 0) + b"\x00", count=1),
+                            "trailing data")
+
+    def test_009_rejected_tiles_do_not_leak(self):
+        # a tile that is cut short must not be partially applied past the
+        # frame, and the frame keeps its size
+        size = len(self.decoder.frame)
+        with self.assertRaises(RuntimeError):
+            self.decoder.decode(memoryview(self.delta(self.tile(2, 1)[:-1])))
+        self.assertEqual(len(self.decoder.frame), size)
+        self.assertEqual(self.decoder.frame, bytes(size))
+
+
+if __name__ == "__main__":
+    unittest.main()
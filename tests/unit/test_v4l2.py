@@ -0,0 +1,116 @@
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Unit tests for the V4L2 format enumeration of the sender"""
+
+import errno
+import json
+import os
+import sys
+import unittest
+from fractions import Fraction
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "sender"),
+                os.path.join(ROOT, "scripts", "webcam-formats"),
+                os.path.join(ROOT, "ci", "test-packages")]
+
+import v4l2  # pylint: disable=wrong-import-position
+import webcam_formats  # pylint: disable=wrong-import-position
+
+#: ioctl exchanges in the format of ``v4l2.py --record``, of a UVC webcam
+#: that offers Motion-JPEG at discrete sizes, including an NTSC rate of
+#: 30000/1001, and YUYV with a stepwise size range and stepwise intervals
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "fixtures", "v4l2-uvc-webcam.json")
+
+EXPECTED = [
+    ("MJPG", True, 1280, 720, Fraction(30)),
+    ("MJPG", True, 1280, 720, Fraction(30000, 1001)),
+    ("MJPG", True, 640, 480, Fraction(30)),
+    ("MJPG", True, 640, 480, Fraction(15)),
+    # the extremes of the stepwise ranges
+    ("YUYV", False, 160, 120, Fraction(30)),
+    ("YUYV", False, 160, 120, Fraction(5)),
+    ("YUYV", False, 1920, 1080, Fraction(5)),
+    ("YUYV", False, 1920, 1080, Fraction(1)),
+]
+
+
+def load_fixture() -> list:
+    with open(FIXTURE, encoding="ascii") as fixture:
+        return json.load(fixture)
+
+
+class TC_00_Enumerate(unittest.TestCase):
+    def test_000_replay(self):
+        formats = v4l2.enumerate_formats(-1, v4l2.IoctlReplayer(
+            load_fixture()))
+        self.assertEqual([tuple(fmt) for fmt in formats], EXPECTED)
+
+    def test_001_record_replayed(self):
+        # recording a replay gives back the same exchanges, in order
+        exchanges = load_fixture()
+        recorder = v4l2.IoctlRecorder(v4l2.IoctlReplayer(exchanges))
+        v4l2.enumerate_formats(-1, recorder)
+        self.assertEqual(recorder.exchanges, exchanges)
+
+    def test_002_errors(self):
+        # errors other than the end of an enumeration are not swallowed
+        exchanges = load_fixture()
+        exchanges[0][2:] = [None, errno.EIO]
+        with self.assertRaises(OSError) as context:
+            v4l2.enumerate_formats(-1, v4l2.IoctlReplayer(exchanges))
+        self.assertEqual(context.exception.errno, errno.EIO)
+
+    def test_003_no_formats(self):
+        self.assertEqual(v4l2.enumerate_formats(-1, v4l2.IoctlReplayer([])),
+                         [])
+
+
+class TC_01_Serialize(unittest.TestCase):
+    def test_000_roundtrip(self):
+        for fmt in v4l2.enumerate_formats(-1, v4l2.IoctlReplayer(
+                load_fixture())):
+            self.assertEqual(v4l2.format_from_str(v4l2.format_to_str(fmt)),
+                             fmt)
+
+    def test_001_fraction(self):
+        fmt = v4l2.FrameFormat("MJPG", True, 1280, 720, Fraction(30000, 1001))
+        self.assertEqual(v4l2.format_to_str(fmt), "1280x720 30000/1001 1 MJPG")
+
+    def test_002_invalid(self):
+        for value in ("1280x720 30 2 MJPG", "1280x720 30 1 MJPEG",
+                      "1280x720 30 1", "1280 30 1 MJPG", "1280x720 x 1 MJPG"):
+            with self.assertRaises(ValueError, msg=value):
+                v4l2.format_from_str(value)
+
+
+class TC_02_WebcamFormats(unittest.TestCase):
+    def test_000_best_format(self):
+        formats = v4l2.enumerate_formats(-1, v4l2.IoctlReplayer(
+            load_fixture()))
+        settings = webcam_formats.WebcamFormats(formats)
+        # 30000/1001 is offered as 30 and not listed twice
+        self.assertEqual(settings.pix_fmt["MJPG"][(1280, 720)], [30])
+        settings.find_best_format()
+        self.assertEqual((settings.selected_format, settings.selected_size,
+                          settings.selected_fps), ("MJPG", (1280, 720), 30))
+
+
+class TC_03_Generation(unittest.TestCase):
+    def test_000_sysfs_path(self):
+        rdev = os.stat(os.devnull).st_rdev
+        generation = v4l2.device_generation(os.devnull)
+        self.assertTrue(generation.startswith(f"{rdev:x}-/sys/devices/"))
+        self.assertEqual(v4l2.device_generation(os.devnull), generation)
+
+    def test_001_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            v4l2.device_generation("/dev/qvc-missing")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,304 @@
+# Copyright (C) 2021 Elliot Killick <elliotkillick@zohomail.eu>
+# Copyright (C) 2021 Demi Marie Obenour <demi@invisiblethingslab.com>
+# Licensed under the MIT License. See LICENSE file for details.
+
+"""Unit tests for the mmap output of the receiver to a V4L2 device"""
+
+import mmap
+import os
+import struct
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "receiver"), os.path.join(ROOT, "sender")]
+
+import i420  # pylint: disable=wrong-import-position
+import receiver  # pylint: disable=wrong-import-position
+import v4l2out  # pylint: disable=wrong-import-position
+
+WIDTH, HEIGHT = 64, 48
+FRAME_SIZE = i420.i420_layout(WIDTH, HEIGHT)[2]
+
+
+class FakeDevice:
+    """A V4L2 output device that records the ioctls it gets"""
+
+    def __init__(self):
+        self.calls = []
+        self.buffer_count = v4l2out.BUFFER_COUNT
+        #: what the device makes of the requested format, None to take it
+        self.adjust_format = None
+        #: the length of the buffers, 0 for the size of the image
+        self.buffer_length = 0
+        self.size = 0
+        self.queued = []
+        self.maps = {}
+
+    def requests(self, request: int) -> list:
+        return [arg for call, arg in self.calls if call == request]
+
+    def ioctl(self, _fd: int, request: int, arg: bytes) -> bytes:
+        self.calls.append((request, arg))
+        if request == v4l2out.VIDIOC_S_FMT:
+            fields = list(v4l2out.v4l2_format.unpack(arg))
+            if self.adjust_format is not None:
+                self.adjust_format(fields)
+            self.size = fields[6]
+            return v4l2out.v4l2_format.pack(*fields)
+        if request == v4l2out.VIDIOC_REQBUFS:
+            fields = list(v4l2out.v4l2_requestbuffers.unpack(arg))
+            if fields[0]:
+                fields[0] = self.buffer_count
+            return v4l2out.v4l2_requestbuffers.pack(*fields)
+        if request == v4l2out.VIDIOC_QUERYBUF:
+            fields = list(v4l2out.v4l2_buffer.unpack(arg))
+            length = self.buffer_length or self.size
+            fields[10] = fields[0] * length  # offset
+            fields[11] = length
+            return v4l2out.v4l2_buffer.pack(*fields)
+        if request == v4l2out.VIDIOC_QBUF:
+            self.queued.append(v4l2out.v4l2_buffer.unpack(arg)[0])
+            return arg
+        if request == v4l2out.VIDIOC_DQBUF:
+            fields = list(v4l2out.v4l2_buffer.unpack(arg))
+            fields[0] = self.queued.pop(0)
+            return v4l2out.v4l2_buffer.pack(*fields)
+        return arg
+
+    def mmap(self, _fd, length, _flags, _prot, offset=0):
+        mapping = mmap.mmap(-1, length)
+        self.maps[offset] = mapping
+        return mapping
+
+
+def frame(value: int) -> bytes:
+    return bytes([value]) * FRAME_SIZE
+
+
+class TC_00_Configure(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+
+    def output(self, **kwargs) -> v4l2out.LoopbackOutput:
+        return v4l2out.LoopbackOutput(
+            3, WIDTH, HEIGHT, FRAME_SIZE, ioctl=self.device.ioctl,
+            mmap_func=self.device.mmap, **kwargs,
+        )
+
+    def test_000_s_fmt(self):
+        self.output(pixelformat=v4l2out.V4L2_PIX_FMT_YUYV,
+                    bytesperline=WIDTH * 2)
+        fmt = v4l2out.v4l2_format.unpack(
+            self.device.requests(v4l2out.VIDIOC_S_FMT)[0])
+        self.assertEqual(fmt[:8], (
+            v4l2out.V4L2_BUF_TYPE_VIDEO_OUTPUT, WIDTH, HEIGHT,
+            v4l2out.V4L2_PIX_FMT_YUYV, v4l2out.V4L2_FIELD_NONE, WIDTH * 2,
+            FRAME_SIZE, v4l2out.V4L2_COLORSPACE_SRGB,
+        ))
+
+    def test_001_s_fmt_adjusted(self):
+        def pad_rows(fields):
+            fields[5] += 8
+            fields[6] += 8 * HEIGHT * 3 // 2
+        self.device.adjust_format = pad_rows
+        with self.assertRaises(v4l2out.UnsupportedFormat):
+            self.output()
+        self.assertFalse(self.device.requests(v4l2out.VIDIOC_REQBUFS))
+
+    def test_002_s_fmt_other_pixelformat(self):
+        def use_yuyv(fields):
+            fields[3] = v4l2out.V4L2_PIX_FMT_YUYV
+        self.device.adjust_format = use_yuyv
+        with self.assertRaises(v4l2out.UnsupportedFormat):
+            self.output()
+
+    def test_003_reqbufs(self):
+        self.device.buffer_count = 2
+        output = self.output()
+        count, buf_type, memory, _, _ = v4l2out.v4l2_requestbuffers.unpack(
+            self.device.requests(v4l2out.VIDIOC_REQBUFS)[0])
+        self.assertEqual((count, buf_type, memory), (
+            v4l2out.BUFFER_COUNT, v4l2out.V4L2_BUF_TYPE_VIDEO_OUTPUT,
+            v4l2out.V4L2_MEMORY_MMAP,
+        ))
+        # the device may give fewer buffers than requested
+        self.assertEqual(len(self.device.requests(v4l2out.VIDIOC_QUERYBUF)),
+                         2)
+        self.assertEqual(sorted(self.device.maps), [0, FRAME_SIZE])
+        output.close()
+
+    def test_004_no_buffers(self):
+        self.device.buffer_count = 0
+        with self.assertRaises(v4l2out.UnsupportedFormat):
+            self.output()
+
+    def test_005_short_buffers(self):
+        self.device.buffer_length = FRAME_SIZE - 1
+        with self.assertRaises(v4l2out.UnsupportedFormat):
+            self.output()
+
+
+class TC_01_Frames(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        self.output = v4l2out.LoopbackOutput(
+            3, WIDTH, HEIGHT, FRAME_SIZE, ioctl=self.device.ioctl,
+            mmap_func=self.device.mmap,
+        )
+
+    def tearDown(self):
+        self.output.close()
+
+    def mapped(self, index: int) -> bytes:
+        return self.device.maps[index * FRAME_SIZE][:FRAME_SIZE]
+
+    def test_000_qbuf(self):
+        self.output.write(frame(1))
+        qbuf = v4l2out.v4l2_buffer.unpack(
+            self.device.requests(v4l2out.VIDIOC_QBUF)[0])
+        index, buf_type, bytesused = qbuf[:3]
+        self.assertEqual((buf_type, bytesused),
+                         (v4l2out.V4L2_BUF_TYPE_VIDEO_OUTPUT, FRAME_SIZE))
+        self.assertEqual(self.mapped(index), frame(1))
+        self.assertEqual(self.device.requests(v4l2out.VIDIOC_STREAMON),
+                         [struct.pack("=I",
+                                      v4l2out.V4L2_BUF_TYPE_VIDEO_OUTPUT)])
+
+    def test_001_streamon_once(self):
+        for value in range(3):
+            self.output.write(frame(value))
+        self.assertEqual(len(self.device.requests(v4l2out.VIDIOC_QBUF)), 3)
+        self.assertEqual(
+            len(self.device.requests(v4l2out.VIDIOC_STREAMON)), 1)
+
+    def test_002_dqbuf(self):
+        for value in range(v4l2out.BUFFER_COUNT):
+            self.output.write(frame(value))
+        self.assertFalse(self.device.requests(v4l2out.VIDIOC_DQBUF))
+        first = self.device.queued[0]
+        # all buffers are queued, the oldest one is reused
+        self.output.write(frame(0xff))
+        self.assertEqual(len(self.device.requests(v4l2out.VIDIOC_DQBUF)), 1)
+        self.assertEqual(self.device.queued[-1], first)
+        self.assertEqual(self.mapped(first), frame(0xff))
+
+    def test_003_short_frame(self):
+        with self.assertRaises(ValueError):
+            self.output.write(frame(1)[:-1])
+        self.assertFalse(self.device.requests(v4l2out.VIDIOC_QBUF))
+
+    def test_004_reconfigure(self):
+        self.output.write(frame(1))
+        old_maps = list(self.device.maps.values())
+        self.device.maps.clear()
+        self.device.calls.clear()
+        width, height = WIDTH // 2, HEIGHT // 2
+        frame_size = i420.i420_layout(width, height)[2]
+        self.output.reconfigure(width, height, frame_size, width)
+        self.assertTrue(all(mapping.closed for mapping in old_maps))
+        requests = [request for request, _ in self.device.calls]
+        self.assertEqual(requests[:3], [
+            v4l2out.VIDIOC_STREAMOFF, v4l2out.VIDIOC_REQBUFS,
+            v4l2out.VIDIOC_S_FMT,
+        ])
+        # the old buffers are freed before the format changes
+        self.assertEqual(v4l2out.v4l2_requestbuffers.unpack(
+            self.device.requests(v4l2out.VIDIOC_REQBUFS)[0])[0], 0)
+        fmt = v4l2out.v4l2_format.unpack(
+            self.device.requests(v4l2out.VIDIOC_S_FMT)[0])
+        self.assertEqual(fmt[1:3] + fmt[5:7],
+                         (width, height, width, frame_size))
+        self.assertEqual(len(self.device.maps), v4l2out.BUFFER_COUNT)
+
+        self.output.write(bytes([2]) * frame_size)
+        self.assertEqual(
+            len(self.device.requests(v4l2out.VIDIOC_STREAMON)), 1)
+        index = v4l2out.v4l2_buffer.unpack(
+            self.device.requests(v4l2out.VIDIOC_QBUF)[0])[0]
+        self.assertEqual(self.device.maps[index * frame_size][:frame_size],
+                         bytes([2]) * frame_size)
+
+    def test_005_close(self):
+        self.output.write(frame(1))
+        self.output.close()
+        self.assertEqual(
+            len(self.device.requests(v4l2out.VIDIOC_STREAMOFF)), 1)
+        self.assertTrue(all(mapping.closed
+                            for mapping in self.device.maps.values()))
+        # closing again does nothing
+        self.output.close()
+        self.assertEqual(
+            len(self.device.requests(v4l2out.VIDIOC_STREAMOFF)), 1)
+
+
+class TC_02_Relay(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        self.output = v4l2out.LoopbackOutput(
+            3, WIDTH, HEIGHT, FRAME_SIZE, ioctl=self.device.ioctl,
+            mmap_func=self.device.mmap,
+        )
+        self.saved_fds = os.dup(0), os.dup(1)
+
+    def tearDown(self):
+        self.output.close()
+        for fd, saved in enumerate(self.saved_fds):
+            os.dup2(saved, fd)
+            os.close(saved)
+
+    def relay(self, stream: bytes) -> bytes:
+        """Relay stream to the output, return what it wrote to the sender"""
+        stream_fd = os.memfd_create("stream")
+        os.write(stream_fd, stream)
+        os.lseek(stream_fd, 0, os.SEEK_SET)
+        os.dup2(stream_fd, 0)
+        os.close(stream_fd)
+        requests_read, requests_write = os.pipe()
+        os.dup2(requests_write, 1)
+        os.close(requests_write)
+        receiver.relay_frames((WIDTH, HEIGHT, 30), receiver.TRANSPORT_RAW,
+                              0, self.output)
+        os.dup2(self.saved_fds[1], 1)
+        with os.fdopen(requests_read, "rb") as requests:
+            return requests.read()
+
+    @staticmethod
+    def format_change(width: int, height: int, fps: int) -> bytes:
+        return receiver.frame_header.pack(
+            0, 0, receiver.FORMAT_CHANGE | receiver.format_struct.size,
+        ) + receiver.format_struct.pack(width, height, fps)
+
+    def test_000_refused_format(self):
+        def refuse_small(fields):
+            fields[1] = WIDTH
+        self.device.adjust_format = refuse_small
+        width, height = WIDTH // 2, HEIGHT // 2
+        small_size = i420.i420_layout(width, height)[2]
+        stream = b"".join([
+            self.format_change(width, height, 30),
+            receiver.frame_header.pack(1, 0, small_size),
+            bytes([1]) * small_size,
+            self.format_change(WIDTH, HEIGHT, 30),
+            receiver.frame_header.pack(2, 0, FRAME_SIZE),
+            frame(2),
+        ])
+        requests = self.relay(stream)
+        # the sender is asked to go back to the format of the device
+        self.assertEqual(requests,
+                         receiver.format_struct.pack(WIDTH, HEIGHT, 30))
+        sizes = [v4l2out.v4l2_format.unpack(fmt)[1:3]
+                 for fmt in self.device.requests(v4l2out.VIDIOC_S_FMT)]
+        self.assertEqual(sizes, [(WIDTH, HEIGHT), (width, height),
+                                 (WIDTH, HEIGHT)])
+        # the frame of the refused format is dropped
+        qbufs = self.device.requests(v4l2out.VIDIOC_QBUF)
+        self.assertEqual(len(qbufs), 1)
+        index = v4l2out.v4l2_buffer.unpack(qbufs[0])[0]
+        self.assertEqual(self.device.maps[index * FRAME_SIZE][:FRAME_SIZE],
+                         frame(2))
+
+
+if __name__ == "__main__":
+    unittest.main()